@@ -58,8 +58,6 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django.middleware.cache.UpdateCacheMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
 ]
 
 ROOT_URLCONF = 'AoE_Openings.urls'
@@ -123,19 +121,57 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+#Per process LRU in front of a cache shared by all processes, see opening_stats/cache_backends.py
 CACHES = {
   'default': {
-    'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-    'LOCATION': 'cache_table',
+    'BACKEND': 'opening_stats.cache_backends.TieredCache',
+    'LOCATION': 'opening_stats',
     'TIMEOUT' : 900, #15 minutes maybe increase further
     'OPTIONS' : {
-      'MAX_ENTRIES': 2000
+      'SHARED': 'shared',
+      'L1_MAX_BYTES': 64 * 1024 * 1024,
+      'L1_TIMEOUT': 60,
     }
+  },
+  'shared': {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.getenv("CACHE_DIR", os.path.join(BASE_DIR, 'cache')),
+    'TIMEOUT' : 900,
+    'OPTIONS' : {
+      'MAX_ENTRIES': 20000
+    }
+  },
+  #version tokens of in-memory data, see opening_stats/versions.py. Its own directory so they are
+  #never culled or cleared with the shared cache, and no L1 in front
+  'versions': {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.getenv("VERSIONS_CACHE_DIR", os.path.join(BASE_DIR, 'cache_versions')),
+    'TIMEOUT' : None,
   }
 }
 
+#Lifetime of cached GET responses, see opening_stats/response_cache.py
 CACHE_MIDDLEWARE_SECONDS = 900 #15 minutes, maybe increase further
 
+#Threads per queue worker running the matchups of an advanced query as parallel queries (PostgreSQL),
+#0 runs them as one aggregate. Measure with `manage.py benchmark advanced` before enabling: on PostgreSQL 16 with
+#200k matches and a single core the fan-out ran 0.9-1.2x for 1 matchup, 0.5x for 10 and 0.4-0.7x for 50
+ADVANCED_QUERY_THREADS = 0
+
+#Long-polling clients of /api/v1/advanced/wait/ each hold a worker while they wait (up to AdvancedWait.MAX_TIMEOUT),
+#keep this well below the workers per process with sync workers, or use a threaded worker class (gunicorn gthread)
+ADVANCED_WAIT_MAX_WAITERS = 4
+
+#'numpy' answers the rollup endpoints from in-memory arrays (opening_stats/cubes.py), needs NumPy installed.
+#Compare with `manage.py benchmark engine`
+OPENING_STATS_ENGINE = os.getenv("OPENING_STATS_ENGINE", "sql")
+
+#'bitmap' answers advanced queries without a left player in the request from in-memory roaring bitmaps
+#(opening_stats/match_index.py), needs pyroaring installed. 'queue' sends every one to the queue workers.
+#Refresh the saved copy with `manage.py build_match_index`
+ADVANCED_QUERY_ENGINE = os.getenv("ADVANCED_QUERY_ENGINE", "queue")
+MATCH_INDEX_PATH = os.getenv("MATCH_INDEX_PATH", os.path.join(BASE_DIR, 'match_index.bin'))
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
 
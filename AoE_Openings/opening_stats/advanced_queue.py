@@ -0,0 +1,230 @@
+import concurrent.futures
+import datetime
+import functools
+import math
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction, close_old_connections, OperationalError
+from django.db.models import Q
+import django.utils.timezone
+from opening_stats.models import Matches, AdvancedQueryQueue, AdvancedQueryResults
+from . import utils, query_builder, notify, match_index
+
+# Worker side of the advanced query queue. Any number of workers, in one or
+# many processes/hosts, can run process_next concurrently: rows are claimed
+# with SELECT ... FOR UPDATE SKIP LOCKED so two workers never pick the same
+# pending row, and a claimed row carries the worker id in claimed_by while a
+# heartbeat thread keeps bumping last_checkin. A row whose last_checkin is
+# older than the lease belongs to a worker that died and is handed out again.
+# Idle workers block on the notify queue channel instead of polling.
+#
+# With threads > 0 each matchup of a request is run as its own query,
+# filtered down to the rows that can match it, on a thread pool whose threads
+# keep their db connections between queries. The per-matchup dicts are merged
+# in order into the same result the single wide aggregate produces.
+
+LEASE_SECONDS = 60
+HEARTBEAT_SECONDS = 10
+#upper bound on an idle wait, so expired leases are noticed without a notification
+IDLE_WAIT_SECONDS = 30
+QUERY_THREADS = getattr(settings, 'ADVANCED_QUERY_THREADS', 0)
+
+_executors = {}
+
+def default_worker_id():
+  return f'{socket.gethostname()}:{os.getpid()}'
+
+def pending_queue():
+  return AdvancedQueryQueue.objects.filter(stale=False, result__isnull=True)
+
+def claim_next(worker_id, lease_seconds=LEASE_SECONDS):
+  expired = django.utils.timezone.now() - datetime.timedelta(seconds=lease_seconds)
+  with transaction.atomic():
+    #waits for an import between apply_import and commit, the claimed row then either is staled by it or sees its matches
+    match_index.lock(shared=True)
+    #locks are released on commit, claimed_by/last_checkin keep other workers away after that
+    adv_query = pending_queue()\
+        .filter(Q(claimed_by__isnull=True) | Q(last_checkin__lt=expired))\
+        .select_for_update(skip_locked=True)\
+        .order_by('id')\
+        .first()
+    if adv_query is None:
+      return None
+    adv_query.claimed_by = worker_id
+    adv_query.last_checkin = django.utils.timezone.now()
+    adv_query.save(update_fields=['claimed_by', 'last_checkin'])
+  return adv_query
+
+class Heartbeat(threading.Thread):
+  #bumps last_checkin of a claimed row until stopped, runs on its own db connection
+  def __init__(self, adv_query_id, worker_id, interval=HEARTBEAT_SECONDS):
+    super().__init__(daemon=True)
+    self.adv_query_id = adv_query_id
+    self.worker_id = worker_id
+    self.interval = interval
+    self.stopped = threading.Event()
+
+  def run(self):
+    try:
+      while not self.stopped.wait(self.interval):
+        AdvancedQueryQueue.objects\
+            .filter(pk=self.adv_query_id, claimed_by=self.worker_id)\
+            .update(last_checkin=django.utils.timezone.now())
+    finally:
+      connection.close()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stopped.set()
+    self.join()
+
+def run_query_single(data, queryset=None):
+  #every matchup as a column of one aggregate over all filtered matches
+  queryset = Matches.objects.all() if queryset is None else queryset
+  return queryset\
+      .filter(query_builder.build_filter(data, elo_string="average_elo"))\
+      .aggregate(**query_builder.advanced_aggregates(data))
+
+def run_matchup(base_filter, matchup, queryset=None):
+  #thread pool connections are reused, drop them if broken or past CONN_MAX_AGE
+  close_old_connections()
+  name, suffix, left_first, left_second = matchup
+  queryset = Matches.objects.all() if queryset is None else queryset
+  return queryset\
+      .filter(base_filter & (left_first | left_second))\
+      .aggregate(**query_builder.advanced_matchup_aggregates(name, suffix, left_first, left_second))
+
+def _executor(threads):
+  #created on first use so forked workers each get their own threads
+  if threads not in _executors:
+    _executors[threads] = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='advanced-query')
+  return _executors[threads]
+
+def run_query(data, threads=QUERY_THREADS, queryset=None):
+  if threads < 1:
+    return run_query_single(data, queryset)
+  base_filter = query_builder.build_filter(data, elo_string="average_elo")
+  matchups = list(query_builder.advanced_matchups(data))
+  if len(matchups) < 2:
+    results = [run_matchup(base_filter, matchup, queryset) for matchup in matchups]
+  else:
+    results = _executor(threads).map(functools.partial(run_matchup, base_filter, queryset=queryset), matchups)
+  matches = {}
+  for result in results:
+    matches.update(result)
+  return matches
+
+def complete(adv_query_id, worker_id, matches):
+  with transaction.atomic():
+    result = AdvancedQueryResults(data=matches)
+    result.save()
+    #only store the result if the row wasnt reclaimed by another worker in the meantime
+    updated = AdvancedQueryQueue.objects\
+        .filter(pk=adv_query_id, claimed_by=worker_id, result__isnull=True)\
+        .update(result=result, time_completed=django.utils.timezone.now())
+    if not updated:
+      result.delete()
+    else:
+      notify.notify(notify.RESULT_CHANNEL, adv_query_id)
+  return bool(updated)
+
+def answer_or_enqueue(data):
+  #answered and stored right away from the match index when it can, otherwise utils.EnqueueOrCheckAdvancedRequest
+  query = utils.data_dict_to_query_string(data)
+  if match_index.enabled() and not AdvancedQueryQueue.objects.filter(query=query, stale=False).exists():
+    with transaction.atomic():
+      match_index.lock(shared=True)
+      #the data a queue worker would see, parsed back from the stored query
+      matches = match_index.run_query(utils.query_string_to_data_dict(query))
+      if matches is not None:
+        result = AdvancedQueryResults.objects.create(data=matches)
+        AdvancedQueryQueue.objects.create(query=query, result=result, time_completed=django.utils.timezone.now())
+        return result.id
+  return utils.EnqueueOrCheckAdvancedRequest(data)
+
+# Imports only invalidate what they touched. Each imported match falls in a
+# (patch, ladder, map, elo bucket) partition; queue rows whose filters miss
+# every touched partition are left alone. Every value of a result is a Count
+# over matching rows, so completed results that overlap are brought up to
+# date by adding the counts over just the new matches. Rows being processed
+# right now started before the import and are marked stale instead.
+def match_partition(match):
+  elo = utils.ELO_DELTA * math.floor(match.average_elo/utils.ELO_DELTA)
+  return (match.patch_number, match.ladder_id, match.map_id, elo)
+
+def overlaps(data, partitions):
+  ladder_ids, patch_ids, map_ids, exclude_civ_mirrors, min_elo, max_elo = query_builder.normalize_filter_parameters(data)
+  for patch_number, ladder_id, map_id, elo in partitions:
+    if ((not patch_ids or patch_number in patch_ids)
+        and (not ladder_ids or ladder_id in ladder_ids)
+        and (not map_ids or map_id in map_ids)
+        and elo <= max_elo and elo + utils.ELO_DELTA > min_elo):
+      return True
+  return False
+
+def add_matches_to_result(adv_query, data, new_matches):
+  with transaction.atomic():
+    result = AdvancedQueryResults.objects.select_for_update().get(pk=adv_query.result_id)
+    delta = run_query(data, threads=0, queryset=new_matches)
+    if delta.keys() != result.data.keys():
+      return False
+    result.data = {key:value + delta[key] for key, value in result.data.items()}
+    result.save()
+    AdvancedQueryQueue.objects.filter(pk=adv_query.id).update(time_completed=django.utils.timezone.now())
+  return True
+
+def apply_import(match_ids, partitions):
+  #patch_number lets PostgreSQL scan only the imported patches' partitions of matches (partitions.py)
+  new_matches = Matches.objects.filter(patch_number__in={partition[0] for partition in partitions}, id__in=match_ids)
+  updated, staled = 0, []
+  for adv_query in AdvancedQueryQueue.objects.filter(stale=False).only('id', 'query', 'result', 'claimed_by'):
+    data = utils.query_string_to_data_dict(adv_query.query)
+    if not overlaps(data, partitions):
+      continue
+    if adv_query.result_id is not None:
+      if add_matches_to_result(adv_query, data, new_matches):
+        updated += 1
+        continue
+    elif adv_query.claimed_by is None:
+      #still waiting, claim_next waits for this import to commit so it will be computed with the new matches
+      continue
+    staled.append(adv_query.id)
+  AdvancedQueryQueue.objects.filter(id__in=staled).update(stale=True)
+  return updated, len(staled)
+
+def process_next(worker_id=None, lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS, threads=QUERY_THREADS):
+  worker_id = worker_id or default_worker_id()
+  start = time.time()
+  adv_query = claim_next(worker_id, lease_seconds)
+  if adv_query is None:
+    #Nothing to process, queue is empty
+    return False
+  data = utils.query_string_to_data_dict(adv_query.query)
+  with Heartbeat(adv_query.id, worker_id, heartbeat_seconds):
+    matches = run_query(data, threads)
+  complete(adv_query.id, worker_id, matches)
+  end = time.time()
+  print(f'{worker_id} processed {adv_query.id} in {end - start}')
+  return True
+
+def run_worker(worker_id=None, lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS, threads=QUERY_THREADS):
+  worker_id = worker_id or default_worker_id()
+  while True:
+    after = notify.position()
+    try:
+      found = process_next(worker_id, lease_seconds, heartbeat_seconds, threads)
+    except OperationalError as e:
+      #lost connection, lock timeout etc, a claimed row is picked up again once its lease expires
+      print(f'{worker_id} failed: {e}')
+      connection.close()
+      found = False
+    if not found:
+      #sleep until something is enqueued
+      notify.wait(after, [notify.QUEUE_CHANNEL], IDLE_WAIT_SECONDS)
@@ -0,0 +1,163 @@
+from django.db.models import F, Sum, Case, When
+from . import utils, query_builder
+
+# GROUP BY based aggregation for the rollup tables. Instead of one
+# Sum(Case(When())) column per opening (or opening pair), each endpoint runs a
+# single values().annotate() query over the filtered rows and the mirror and
+# basic-vs-followup rules are folded in Python. The fold functions return the
+# same dict the old .aggregate() calls did, including None for empty sums and
+# the key order, so count_response_to_dict and the frontend are unaffected.
+
+def civ_rows(queryset):
+  return list(queryset.values('civilization')
+              .annotate(wins=Sum('victory_count'), losses=Sum('loss_count'))
+              .order_by()
+              .values_list('civilization', 'wins', 'losses'))
+
+def opening_rows(queryset):
+  return list(queryset.values('opening1_id', 'opening2_id')
+              .annotate(opening1_wins=Sum('opening1_victory_count'),
+                        opening1_losses=Sum('opening1_loss_count'),
+                        opening2_wins=Sum('opening2_victory_count'),
+                        opening2_losses=Sum('opening2_loss_count'))
+              .order_by()
+              .values_list('opening1_id', 'opening2_id', 'opening1_wins', 'opening1_losses', 'opening2_wins', 'opening2_losses'))
+
+def civ_opening_rows(queryset, data):
+  #opening_rows of civ_opening_elo_wins with the civ filters, None for a side without rows that count
+  rows, side1, side2 = query_builder.civ_filters(data)
+  def side_sum(side, column):
+    return Sum(Case(When(side, then=F(column)))) if side else Sum(column)
+  return list(queryset.filter(rows)
+              .values('opening1_id', 'opening2_id')
+              .annotate(opening1_wins=side_sum(side1, 'opening1_victory_count'),
+                        opening1_losses=side_sum(side1, 'opening1_loss_count'),
+                        opening2_wins=side_sum(side2, 'opening2_victory_count'),
+                        opening2_losses=side_sum(side2, 'opening2_loss_count'))
+              .order_by()
+              .values_list('opening1_id', 'opening2_id', 'opening1_wins', 'opening1_losses', 'opening2_wins', 'opening2_losses'))
+
+def tech_rows(queryset):
+  return list(queryset.values('opening_id', 'tech_id')
+              .annotate(total_time=Sum(F('average_time') * F('count')), total_count=Sum('count'))
+              .order_by()
+              .values_list('opening_id', 'tech_id', 'total_time', 'total_count'))
+
+def _add(total, value):
+  #SQL SUM semantics, None until the first matching row, None values are skipped
+  if value is None:
+    return total
+  return value if total is None else total + value
+
+def _games(wins, losses):
+  #None for a side civ_opening_rows left out
+  return None if wins is None else wins + losses
+
+def _player_games(opening1_wins, opening1_losses, opening2_wins, opening2_losses):
+  #games of both sides, twice the row's games unless a civ filter left a side out
+  games1, games2 = _games(opening1_wins, opening1_losses), _games(opening2_wins, opening2_losses)
+  if games1 is None and games2 is None:
+    return None
+  return (games1 or 0) + (games2 or 0)
+
+def _half(player_games):
+  #total is player games / 2, the play rates divide by total*2
+  if player_games is None:
+    return None
+  return player_games // 2 if player_games % 2 == 0 else player_games / 2
+
+def fold_civ_win_rates(rows):
+  totals = {}
+  total = None
+  for civ_id, wins, losses in rows:
+    totals[civ_id] = (wins, wins + losses)
+    total = _add(total, wins)
+  result = {'total':total}
+  for civ_id, name in utils.CIV_IDS_TO_NAMES.items():
+    wins, games = totals.get(civ_id, (None, None))
+    result[f'{name}_wins'] = wins
+    result[f'{name}_total'] = games
+  return result
+
+def fold_opening_win_rates(rows, opening_ids):
+  basic = len(utils.Basic_Strategies)
+  last_two = len(utils.OPENINGS) - 2
+  def is_basic(opening_id):
+    return opening_id < basic or opening_id >= last_two
+
+  by_opening = {}
+  total = None
+  for row in rows:
+    opening1, opening2, opening1_wins, opening1_losses, opening2_wins, opening2_losses = row
+    if is_basic(opening1) and is_basic(opening2):
+      total = _add(total, _player_games(opening1_wins, opening1_losses, opening2_wins, opening2_losses))
+    by_opening.setdefault(opening1, []).append(row)
+    if opening2 != opening1:
+      by_opening.setdefault(opening2, []).append(row)
+
+  result = {'total':_half(total)}
+  for opening_id in query_builder.opening_strategies(opening_ids, len(utils.OPENINGS)):
+    games = wins = losses = None
+    for opening1, opening2, opening1_wins, opening1_losses, opening2_wins, opening2_losses in by_opening.get(opening_id, ()):
+      if opening1 == opening_id and opening2 == opening_id:
+        #need to count each player twice In the case of mirrors, ignore mirror wins
+        games = _add(_add(games, _games(opening1_wins, opening1_losses)), _games(opening2_wins, opening2_losses))
+        wins = _add(wins, 0)
+        losses = _add(losses, 0)
+      elif opening1 == opening_id and is_basic(opening2):
+        games = _add(games, _games(opening1_wins, opening1_losses))
+        wins = _add(wins, opening1_wins)
+        losses = _add(losses, opening1_losses)
+      elif opening2 == opening_id and is_basic(opening1):
+        games = _add(games, _games(opening2_wins, opening2_losses))
+        wins = _add(wins, opening2_wins)
+        losses = _add(losses, opening2_losses)
+    opening_name = utils.OPENINGS[opening_id][0]
+    result[f'{opening_name}_total'] = games
+    result[f'{opening_name}_wins'] = wins
+    result[f'{opening_name}_losses'] = losses
+  return result
+
+def fold_opening_matchups(rows, opening_ids):
+  basic = len(utils.Basic_Strategies)
+  by_pair = {}
+  total = None
+  for opening1, opening2, opening1_wins, opening1_losses, opening2_wins, opening2_losses in rows:
+    if opening1 < basic and opening2 < basic:
+      total = _add(total, _player_games(opening1_wins, opening1_losses, opening2_wins, opening2_losses))
+    by_pair[(opening1, opening2)] = (opening1_wins, opening1_losses, opening2_wins, opening2_losses)
+
+  result = {'total':_half(total)}
+  strategies = query_builder.opening_strategies(opening_ids, basic)
+  for i in strategies:
+    opening1_name = utils.OPENINGS[i][0]
+    for j in strategies[strategies.index(i):]:
+      opening2_name = utils.OPENINGS[j][0]
+      games = wins = None
+      if (i, j) in by_pair:
+        opening1_wins, opening1_losses, opening2_wins, opening2_losses = by_pair[(i, j)]
+        games = _add(games, _games(opening1_wins, opening1_losses))
+        wins = _add(wins, opening1_wins)
+      if i != j and (j, i) in by_pair:
+        opening1_wins, opening1_losses, opening2_wins, opening2_losses = by_pair[(j, i)]
+        games = _add(games, _games(opening2_wins, opening2_losses))
+        wins = _add(wins, opening2_wins)
+      result[f'{opening1_name}_vs_{opening2_name}_total'] = games
+      result[f'{opening1_name}_vs_{opening2_name}_wins'] = wins
+  return result
+
+def fold_opening_techs(rows, tech_ids_to_names, opening_ids):
+  by_key = {}
+  total = None
+  for opening_id, tech_id, total_time, total_count in rows:
+    by_key[(opening_id, tech_id)] = (total_time, total_count)
+    total = _add(total, total_count)
+
+  result = {'total':total}
+  strategies = query_builder.opening_strategies(opening_ids, len(utils.Basic_Strategies))
+  for tech_id, tech_name in tech_ids_to_names.items():
+    for opening_id in strategies:
+      opening_name = utils.OPENINGS[opening_id][0]
+      total_time, total_count = by_key.get((opening_id, tech_id), (None, None))
+      result[f'{opening_name}__{tech_name}__{tech_id}'] = total_time / total_count if total_count else None
+  return result
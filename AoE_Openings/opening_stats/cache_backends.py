@@ -0,0 +1,143 @@
+import collections
+import pickle
+import threading
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# Two tier cache backend. L1 is a per-process LRU bounded by the pickled size
+# of its entries, shared by every thread of the process like LocMemCache. L2
+# is another configured cache alias shared between processes (file based,
+# memcached, ...). Reads go L1 -> L2 and L2 hits are copied into L1; writes go
+# to both. L1 entries live at most L1_TIMEOUT seconds so changes written to L2
+# by another process are seen after that.
+#
+#   'default': {
+#     'BACKEND': 'opening_stats.cache_backends.TieredCache',
+#     'LOCATION': 'opening_stats',
+#     'OPTIONS': {'SHARED': 'shared', 'L1_MAX_BYTES': 64 * 1024 * 1024, 'L1_TIMEOUT': 60},
+#   }
+
+_stores = {}
+_locks = {}
+_stats = {}
+
+class TieredCache(BaseCache):
+  pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+  def __init__(self, name, params):
+    super().__init__(params)
+    options = params.get('OPTIONS', {})
+    self._shared_alias = options['SHARED']
+    self._max_bytes = options.get('L1_MAX_BYTES', 32 * 1024 * 1024)
+    self._l1_timeout = options.get('L1_TIMEOUT', 60)
+    #key -> (pickled, expiry), most recently used last, plus total bytes under 'bytes' in stats
+    self._store = _stores.setdefault(name, collections.OrderedDict())
+    self._lock = _locks.setdefault(name, threading.Lock())
+    self._stats = _stats.setdefault(name, collections.Counter())
+
+  @property
+  def shared(self):
+    return caches[self._shared_alias]
+
+  def _l1_expiry(self, timeout):
+    expiry = self.get_backend_timeout(timeout)
+    l1_expiry = time.time() + self._l1_timeout
+    return l1_expiry if expiry is None else min(expiry, l1_expiry)
+
+  def _l1_delete(self, key):
+    entry = self._store.pop(key, None)
+    if entry is not None:
+      self._stats['bytes'] -= len(entry[0])
+
+  def _l1_set(self, key, pickled, expiry):
+    with self._lock:
+      self._l1_delete(key)
+      if len(pickled) > self._max_bytes:
+        return
+      self._store[key] = (pickled, expiry)
+      self._stats['bytes'] += len(pickled)
+      while self._stats['bytes'] > self._max_bytes:
+        evicted, (evicted_pickled, _) = self._store.popitem(last=False)
+        self._stats['bytes'] -= len(evicted_pickled)
+        self._stats['evictions'] += 1
+
+  def _l1_get(self, key):
+    with self._lock:
+      entry = self._store.get(key)
+      if entry is None:
+        return None
+      if entry[1] <= time.time():
+        self._l1_delete(key)
+        return None
+      self._store.move_to_end(key)
+      return entry[0]
+
+  def get(self, key, default=None, version=None):
+    l1_key = self.make_key(key, version=version)
+    self.validate_key(l1_key)
+    pickled = self._l1_get(l1_key)
+    if pickled is not None:
+      self._stats['l1_hits'] += 1
+      return pickle.loads(pickled)
+    sentinel = object()
+    value = self.shared.get(key, sentinel, version=version)
+    if value is sentinel:
+      self._stats['misses'] += 1
+      return default
+    self._stats['l2_hits'] += 1
+    self._l1_set(l1_key, pickle.dumps(value, self.pickle_protocol), self._l1_expiry(DEFAULT_TIMEOUT))
+    return value
+
+  def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+    l1_key = self.make_key(key, version=version)
+    self.validate_key(l1_key)
+    self.shared.set(key, value, timeout=self._shared_timeout(timeout), version=version)
+    self._stats['sets'] += 1
+    self._l1_set(l1_key, pickle.dumps(value, self.pickle_protocol), self._l1_expiry(timeout))
+
+  def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+    added = self.shared.add(key, value, timeout=self._shared_timeout(timeout), version=version)
+    if added:
+      self._l1_set(self.make_key(key, version=version), pickle.dumps(value, self.pickle_protocol), self._l1_expiry(timeout))
+    return added
+
+  def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+    return self.shared.touch(key, timeout=self._shared_timeout(timeout), version=version)
+
+  def delete(self, key, version=None):
+    l1_key = self.make_key(key, version=version)
+    self.validate_key(l1_key)
+    with self._lock:
+      self._l1_delete(l1_key)
+    return self.shared.delete(key, version=version)
+
+  def has_key(self, key, version=None):
+    l1_key = self.make_key(key, version=version)
+    self.validate_key(l1_key)
+    return self._l1_get(l1_key) is not None or self.shared.has_key(key, version=version)
+
+  def incr(self, key, delta=1, version=None):
+    #incremented in L2 so every process counts together, other processes may
+    #read the old value from their L1 for up to L1_TIMEOUT
+    with self._lock:
+      self._l1_delete(self.make_key(key, version=version))
+    return self.shared.incr(key, delta, version=version)
+
+  def clear(self):
+    with self._lock:
+      self._store.clear()
+      self._stats['bytes'] = 0
+    self.shared.clear()
+
+  def _shared_timeout(self, timeout):
+    #DEFAULT_TIMEOUT means this cache's TIMEOUT, not the shared cache's
+    return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+  def stats(self):
+    with self._lock:
+      stats = dict(self._stats, entries=len(self._store), max_bytes=self._max_bytes)
+    lookups = stats.get('l1_hits', 0) + stats.get('l2_hits', 0) + stats.get('misses', 0)
+    stats['hit_rate'] = (stats.get('l1_hits', 0) + stats.get('l2_hits', 0)) / lookups if lookups else None
+    return stats
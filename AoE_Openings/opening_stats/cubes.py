@@ -0,0 +1,124 @@
+import threading
+import time
+
+from django.conf import settings
+from opening_stats.models import CivEloWins, OpeningEloWins, CivOpeningEloWins, OpeningEloTechs
+from . import aggregation, query_builder, rollups, versions
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Optional in-memory engine for the rollup endpoints, enabled with
+# OPENING_STATS_ENGINE = 'numpy' when NumPy is installed. Each process loads
+# civ_elo_wins, opening_elo_wins and opening_elo_techs into column arrays,
+# with the group by columns (civ, opening pair, opening and tech) coded
+# 0..n-1, and answers the standard filters with vectorized masks and
+# bincount sums. civ_rows/opening_rows/tech_rows return the same rows as the
+# GROUP BY queries in aggregation, so the fold functions are shared, and
+# fall back to those queries when the engine is off. Opening rows with civ
+# filters always come from civ_opening_elo_wins, which is not loaded.
+#
+# Imports and rebuilds change the data version (rollups.data_changed); each
+# process checks it at most every CHECK_SECONDS and reloads when it moved.
+
+CHECK_SECONDS = 10
+
+def enabled():
+  return numpy is not None and getattr(settings, 'OPENING_STATS_ENGINE', 'sql') == 'numpy'
+
+class Table:
+  def __init__(self, queryset, group_columns, value_columns):
+    rows = list(queryset.order_by('id').values_list('ladder_id', 'patch_number', 'map_id', 'elo', *group_columns, *value_columns))
+    columns = list(zip(*rows)) if rows else [()] * (4 + len(group_columns) + len(value_columns))
+    self.ladder_id, self.patch_number, self.map_id, self.elo = (numpy.array(column, dtype=numpy.int64) for column in columns[:4])
+    groups = numpy.array(columns[4:4 + len(group_columns)], dtype=numpy.int64).reshape(len(group_columns), len(rows)).T
+    #groups[code] is the group by key of every row with that code
+    if rows:
+      self.groups, codes = numpy.unique(groups, axis=0, return_inverse=True)
+      self.codes = codes.reshape(-1)
+    else:
+      self.groups, self.codes = groups, numpy.zeros(0, dtype=numpy.int64)
+    self.values = [numpy.array(column, dtype=numpy.float64) for column in columns[4 + len(group_columns):]]
+
+  def group_column(self, index):
+    #per row value of one group by column
+    return self.groups[self.codes, index]
+
+  def mask(self, data):
+    ladder_ids, patch_ids, map_ids, exclude_civ_mirrors, min_elo, max_elo = query_builder.normalize_filter_parameters(data)
+    mask = (self.elo >= min_elo) & (self.elo <= max_elo)
+    if ladder_ids:
+      mask &= numpy.isin(self.ladder_id, ladder_ids)
+    if patch_ids:
+      mask &= numpy.isin(self.patch_number, patch_ids)
+    if map_ids:
+      mask &= numpy.isin(self.map_id, map_ids)
+    return mask
+
+  def group_sums(self, mask, values):
+    #[(group key..., sum...)] for groups with at least one row in mask, like GROUP BY
+    codes = self.codes[mask]
+    counts = numpy.bincount(codes, minlength=len(self.groups))
+    sums = [numpy.bincount(codes, weights=value[mask], minlength=len(self.groups)) for value in values]
+    present = numpy.nonzero(counts)[0]
+    return [tuple(self.groups[code].tolist()) + tuple(total[code] for total in sums) for code in present]
+
+class Cubes:
+  def __init__(self, version):
+    self.version = version
+    self.civs = Table(CivEloWins.objects, ['civilization'], ['victory_count', 'loss_count'])
+    self.openings = Table(OpeningEloWins.objects, ['opening1_id', 'opening2_id'],
+                          ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count'])
+    self.techs = Table(OpeningEloTechs.objects, ['opening_id', 'tech_id'], ['average_time', 'count'])
+    self.techs_total_time = self.techs.values[0] * self.techs.values[1]
+    self.techs_tech_id = self.techs.group_column(1)
+
+  def civ_rows(self, data):
+    rows = self.civs.group_sums(self.civs.mask(data), self.civs.values)
+    return [(civ, int(wins), int(losses)) for civ, wins, losses in rows]
+
+  def opening_rows(self, data):
+    rows = self.openings.group_sums(self.openings.mask(data), self.openings.values)
+    return [(opening1, opening2) + tuple(int(count) for count in counts) for opening1, opening2, *counts in rows]
+
+  def tech_rows(self, data, tech_ids):
+    mask = self.techs.mask(data) & numpy.isin(self.techs_tech_id, list(tech_ids))
+    rows = self.techs.group_sums(mask, [self.techs_total_time, self.techs.values[1]])
+    return [(opening_id, tech_id, float(total_time), int(total_count)) for opening_id, tech_id, total_time, total_count in rows]
+
+_lock = threading.Lock()
+_cubes = None
+_checked_at = 0
+
+def get():
+  global _cubes, _checked_at
+  now = time.monotonic()
+  cubes = _cubes
+  if cubes is not None and now - _checked_at < CHECK_SECONDS:
+    return cubes
+  with _lock:
+    _checked_at = now
+    version = versions.get(rollups.DATA_VERSION_KEY)
+    if _cubes is None or _cubes.version != version:
+      _cubes = Cubes(version)
+    return _cubes
+
+def civ_rows(data):
+  if enabled():
+    return get().civ_rows(data)
+  return aggregation.civ_rows(CivEloWins.objects.filter(query_builder.build_filter(data)))
+
+def opening_rows(data):
+  if query_builder.has_civ_filter(data):
+    return aggregation.civ_opening_rows(CivOpeningEloWins.objects.filter(query_builder.build_filter(data)), data)
+  if enabled():
+    return get().opening_rows(data)
+  return aggregation.opening_rows(OpeningEloWins.objects.filter(query_builder.build_filter(data)))
+
+def tech_rows(data, tech_ids):
+  if enabled():
+    return get().tech_rows(data, tech_ids)
+  return aggregation.tech_rows(OpeningEloTechs.objects.filter(query_builder.build_filter(data))
+                               .filter(query_builder.opening_tech_filter(tech_ids)))
@@ -0,0 +1,165 @@
+import json
+
+from django.db import transaction
+from rest_framework.exceptions import ParseError
+from opening_stats.models import Matches, MatchPlayerActions, Players, Patches
+from . import utils, rollups, reference, advanced_queue, validation, partitions, match_index
+
+# Match import pipeline. import_batch validates (validation.py) and bulk
+# inserts one batch of players, patches, matches and actions and folds it into
+# the rollup tables and the advanced query results, all in one transaction. ImportMatches runs
+# the whole upload as a single batch. ImportMatchesStream reads an NDJSON body
+# one line at a time, one record per line:
+#
+#   {"player": {"id": 1}}
+#   {"patch": {"id": 56}}
+#   {"match": {...}}
+#   {"match_player_action": {...}}
+#
+# and imports every BATCH_MATCHES matches or BATCH_ACTIONS actions, so memory
+# and transaction length stay bounded however large the upload is. Actions
+# must come after the line of their match.
+
+BATCH_MATCHES = 1000
+BATCH_ACTIONS = 50000
+#rows per INSERT statement
+BULK_BATCH_SIZE = 1000
+
+#record kind of an NDJSON line -> import_batch argument
+RECORD_KINDS = {
+  'player':'players',
+  'patch':'patches',
+  'match':'matches',
+  'match_player_action':'match_player_actions',
+}
+
+def import_batch(players, patches, matches, match_player_actions):
+  civs_data_dict = {}
+  openings_data_dict = {}
+  civ_openings_data_dict = {}
+  techs_data_dict = {}
+
+  #types and ranges, no queries
+  player_rows = validation.PLAYERS.validate(players, 'players')
+  patch_rows = validation.PATCHES.validate(patches, 'patches')
+  match_rows = validation.MATCHES.validate(matches, 'matches')
+  action_rows = validation.MATCH_PLAYER_ACTIONS.validate(match_player_actions, 'match_player_actions')
+
+  #new patches get their own partitions before their rows arrive, committed on their own (partitions.py)
+  partitions.ensure({match['patch_number'] for match in match_rows})
+
+  with transaction.atomic():
+    Players.objects.bulk_create((Players(**player) for player in player_rows), ignore_conflicts=True)
+    Patches.objects.bulk_create((Patches(**patch) for patch in patch_rows), ignore_conflicts=True)
+    if any(patch['id'] not in reference.get().patch_ids for patch in patch_rows):
+      transaction.on_commit(reference.invalidate)
+    transaction.on_commit(rollups.data_changed)
+
+    #references, one query per foreign key, a failure rolls the batch back
+    validation.check_foreign_keys(validation.MATCHES, match_rows, 'matches')
+    validation.check_unique_ids(validation.MATCHES, match_rows, 'matches')
+    matches = Matches.objects.bulk_create((Matches(**match) for match in match_rows), batch_size=BULK_BATCH_SIZE)
+    del match_rows
+
+    print("Building match data_dicts")
+    #openings of both players classified once for every rollup
+    records = utils.build_match_index(matches)
+    touched_partitions = set()
+    for match in matches:
+      openings = records[match.id].openings
+      utils.build_civ_elo_win_for_match(match, civs_data_dict)
+      utils.build_opening_elo_win_for_match(match, openings_data_dict, openings)
+      utils.build_civ_opening_elo_win_for_match(match, civ_openings_data_dict, openings)
+      touched_partitions.add(advanced_queue.match_partition(match))
+
+    print("Updating civ wins and losses")
+    total = len(civs_data_dict)
+    print("Rows to modify: " + str(total))
+    rollups.upsert_civ_elo_wins(civs_data_dict)
+    del civs_data_dict
+
+    print("Updating opening matchups")
+    total = len(openings_data_dict)
+    print("Rows to modify: " + str(total))
+    rollups.upsert_opening_elo_wins(openings_data_dict)
+    rollups.upsert_opening_meta_snapshot(openings_data_dict, len(utils.Basic_Strategies))
+    del openings_data_dict
+
+    print("Updating civ opening matchups")
+    total = len(civ_openings_data_dict)
+    print("Rows to modify: " + str(total))
+    rollups.upsert_civ_opening_elo_wins(civ_openings_data_dict)
+    del civ_openings_data_dict
+
+    print('Creating actions!')
+    validation.check_foreign_keys(validation.MATCH_PLAYER_ACTIONS, action_rows, 'match_player_actions',
+                                  known={'match':{match.id for match in matches}})
+    validation.check_unique_together(validation.MATCH_PLAYER_ACTIONS, action_rows, 'match_player_actions')
+    copy_patch_numbers(action_rows, matches)
+    actions = MatchPlayerActions.objects.bulk_create((MatchPlayerActions(**action) for action in action_rows), batch_size=BULK_BATCH_SIZE)
+    del action_rows
+
+    print('Creating opening elo techs dict')
+    techs = set(reference.get().techs_by_id)
+    tech_actions = [action for action in actions if action.event_type == 3 and action.event_id in techs]
+    #matches of earlier stream batches, the only query here and usually none
+    missing = {action.match_id for action in tech_actions} - records.keys()
+    if missing:
+      records.update(utils.build_match_index(Matches.objects.filter(id__in=missing).only(*utils.MATCH_RECORD_FIELDS)))
+    for action in tech_actions:
+      utils.build_opening_elo_techs_for_record_and_action(records[action.match_id], action, techs_data_dict)
+
+    print("Updating elo techs")
+    total = len(techs_data_dict)
+    print("Rows to modify: " + str(total))
+    rollups.upsert_opening_elo_techs(techs_data_dict)
+
+    #held to commit, synchronous advanced answers and queue claims either see this import or get updated by it
+    match_index.lock()
+    match_index.log_import(match.id for match in matches)
+    # Update or invalidate advanced queries that overlap the new matches
+    updated, staled = advanced_queue.apply_import([match.id for match in matches], touched_partitions)
+    print(f"Advanced queries updated: {updated}, invalidated: {staled}")
+  return {'players':len(players), 'patches':len(patches), 'matches':len(matches), 'match_player_actions':len(actions)}
+
+def copy_patch_numbers(action_rows, matches):
+  #an action's partition is its match's patch, matches of earlier stream batches are looked up in one query
+  patch_numbers = {match.id:match.patch_number for match in matches}
+  missing = {action['match_id'] for action in action_rows} - patch_numbers.keys()
+  if missing:
+    patch_numbers.update(Matches.objects.filter(id__in=missing).values_list('id', 'patch_number'))
+  for action in action_rows:
+    action['patch_number'] = patch_numbers[action['match_id']]
+
+def read_ndjson(stream):
+  #yields (kind, record) for every non empty line of a binary stream
+  for line_number, line in enumerate(iter(stream.readline, b''), 1):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      obj = json.loads(line)
+    except ValueError as e:
+      raise ParseError(f'line {line_number}: invalid JSON, {e}')
+    if not isinstance(obj, dict) or len(obj) != 1:
+      raise ParseError(f'line {line_number}: expected an object with a single record')
+    (kind, record), = obj.items()
+    if kind not in RECORD_KINDS:
+      raise ParseError(f'line {line_number}: unknown record kind {kind}')
+    yield kind, record
+
+def import_stream(records, totals, batch_matches=BATCH_MATCHES, batch_actions=BATCH_ACTIONS):
+  #totals is updated as batches commit, so callers can report progress when a later batch fails
+  batch = {name:[] for name in RECORD_KINDS.values()}
+  def flush():
+    for name, count in import_batch(**batch).items():
+      totals[name] = totals.get(name, 0) + count
+    for records in batch.values():
+      records.clear()
+  for kind, record in records:
+    batch[RECORD_KINDS[kind]].append(record)
+    if len(batch['matches']) >= batch_matches or len(batch['match_player_actions']) >= batch_actions:
+      flush()
+  if any(batch.values()):
+    flush()
+  return totals
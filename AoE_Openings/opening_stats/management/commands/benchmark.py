@@ -0,0 +1,501 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from rest_framework.renderers import JSONRenderer
+from django.db.models import Max, Count
+from opening_stats import utils, query_builder, aggregation, rollups, advanced_queue, reference, response_cache, views, validation, importer, cubes, match_index
+from opening_stats.models import Matches, MatchPlayerActions, CivEloWins, OpeningEloWins, CivOpeningEloWins, OpeningEloTechs
+from opening_stats.serializers import MatchesSerializer, MatchPlayerActionsSerializer
+import json
+import random
+import time
+import urllib
+
+# Micro-benchmarks for the hot paths of the opening stats app. Each suite is a
+# function taking the command and its parsed options, registered in SUITES.
+#   python manage.py benchmark <suite> [--iterations N] [--rows N]
+
+def time_call(function, iterations):
+  start = time.perf_counter()
+  for i in range(iterations):
+    function()
+  return (time.perf_counter() - start) / iterations
+
+def report(command, name, seconds, baseline=None):
+  line = f'{name:<40} {seconds * 1e6:>12.1f} us'
+  if baseline:
+    line += f'  ({baseline / seconds:.1f}x)'
+  command.stdout.write(line)
+
+STANDARD_PARAMETERS = {
+  'min_elo':1000,
+  'max_elo':2000,
+  'exclude_mirrors':True,
+  'include_ladder_ids':[3, 4],
+  'include_patch_ids':[1, 2],
+  'include_map_ids':[9, 29, 33],
+  'include_opening_ids':[-1],
+}
+
+def bench_query_builder(command, options):
+  #building the Q/aggregate trees per request against the memoized ones; the expressions they
+  #replaced are checked in tests.py (QueryBuilderTests)
+  iterations = options['iterations']
+  data = STANDARD_PARAMETERS
+  cases = [
+    ('opening_win_rates',
+     lambda: (query_builder.build_filter(data), query_builder.opening_win_rate_aggregates(data['include_opening_ids']))),
+    ('opening_matchups',
+     lambda: (query_builder.build_filter(data), query_builder.opening_matchup_aggregates(data['include_opening_ids']))),
+  ]
+  for name, builder in cases:
+    command.stdout.write(f'{name} ({iterations} iterations)')
+    def cold():
+      query_builder.cache_clear()
+      builder()
+    cold_time = time_call(cold, iterations)
+    report(command, '  query_builder, cold', cold_time)
+    builder()
+    report(command, '  query_builder, memoized', time_call(builder, iterations), cold_time)
+
+def bench_aggregation(command, options):
+  #runs against the configured database, so use a populated one
+  iterations = options['iterations']
+  data = dict(STANDARD_PARAMETERS, include_ladder_ids=[-1], include_map_ids=[-1], min_elo=0, max_elo=9000)
+  openings = OpeningEloWins.objects.filter(query_builder.build_filter(data))
+  civs = CivEloWins.objects.filter(query_builder.build_filter(data))
+  cases = [
+    ('civ_win_rates',
+     lambda: civs.aggregate(**query_builder.civ_win_rate_aggregates()),
+     lambda: aggregation.fold_civ_win_rates(aggregation.civ_rows(civs))),
+    ('opening_win_rates',
+     lambda: openings.aggregate(**query_builder.opening_win_rate_aggregates([-1])),
+     lambda: aggregation.fold_opening_win_rates(aggregation.opening_rows(openings), [-1])),
+  ]
+  #matchup width grows quadratically with the number of openings requested
+  for count in (len(utils.Basic_Strategies), len(utils.OPENINGS) // 2, len(utils.OPENINGS)):
+    opening_ids = list(range(count))
+    cases.append((f'opening_matchups ({count} openings)',
+                  lambda opening_ids=opening_ids: openings.aggregate(**query_builder.opening_matchup_aggregates(opening_ids)),
+                  lambda opening_ids=opening_ids: aggregation.fold_opening_matchups(aggregation.opening_rows(openings), opening_ids)))
+  for name, case_path, group_by_path in cases:
+    command.stdout.write(f'{name} ({iterations} iterations)')
+    case_time = time_call(case_path, iterations)
+    report(command, '  Sum(Case(When())) aggregate', case_time)
+    report(command, '  GROUP BY + fold', time_call(group_by_path, iterations), case_time)
+
+def bench_meta_snapshot(command, options):
+  #runs against the configured database, so use a populated one
+  iterations = options['iterations']
+  patch = reference.get().latest_patch_id
+  def aggregate(bucket_size):
+    matches = OpeningEloWins.objects\
+        .filter(elo__gte=500, elo__lte=2500, patch_number=patch, ladder_id=3)\
+        .aggregate(**query_builder.meta_snapshot_aggregates(500, 2500, bucket_size))
+    return JSONRenderer().render({'patch':patch, 'meta_list':utils.count_response_to_dict(matches)})
+  for bucket_size in (200, 100, 50):
+    command.stdout.write(f'meta_snapshot bucket_size={bucket_size} ({iterations} iterations)')
+    cube = lambda: views.MetaSnapshot().content(bucket_size, patch)
+    assert aggregate(bucket_size) == cube()
+    case_time = time_call(lambda: aggregate(bucket_size), iterations)
+    report(command, '  Sum(Case(When())) over opening_elo_wins', case_time)
+    report(command, '  opening_meta_snapshot range read', time_call(cube, iterations), case_time)
+
+def bench_engine(command, options):
+  #runs against the configured database, so use a populated one; needs NumPy
+  iterations = options['iterations']
+  engine = cubes.Cubes(0)
+  tech_ids = sorted(reference.get().techs_by_id)
+  cases = [
+    ('all matches', dict(STANDARD_PARAMETERS, include_ladder_ids=[-1], include_patch_ids=[-1], include_map_ids=[-1], min_elo=0, max_elo=9000)),
+    ('1000-2000 elo, two patches', dict(STANDARD_PARAMETERS, include_ladder_ids=[-1], include_map_ids=[-1])),
+  ]
+  for label, data in cases:
+    query = lambda model: model.objects.filter(query_builder.build_filter(data))
+    sql = [
+      ('civ_rows', lambda: aggregation.civ_rows(query(CivEloWins)), lambda: engine.civ_rows(data)),
+      ('opening_rows', lambda: aggregation.opening_rows(query(OpeningEloWins)), lambda: engine.opening_rows(data)),
+      ('tech_rows', lambda: aggregation.tech_rows(query(OpeningEloTechs).filter(query_builder.opening_tech_filter(tech_ids))),
+       lambda: engine.tech_rows(data, tech_ids)),
+    ]
+    for name, sql_path, engine_path in sql:
+      expected, actual = sorted(sql_path()), sorted(engine_path())
+      assert [row[:-2] for row in expected] == [row[:-2] for row in actual], name
+      for expected_row, actual_row in zip(expected, actual):
+        assert all(abs(a - b) <= 1e-6 * max(1, abs(a)) for a, b in zip(expected_row[-2:], actual_row[-2:])), name
+      command.stdout.write(f'{name}, {label} ({iterations} iterations, {len(expected)} groups)')
+      sql_time = time_call(sql_path, iterations)
+      report(command, '  GROUP BY query', sql_time)
+      report(command, '  numpy masks + bincount', time_call(engine_path, iterations), sql_time)
+
+def civ_opening_rows_from_matches(data):
+  #what answering a civ filter took without civ_opening_elo_wins: classify the matches, filter and sum in Python
+  include_civ_ids, exclude_civ_ids, clamp_civ_ids = query_builder.normalize_civ_parameters(data)
+  data_dict = {}
+  for match in Matches.objects.filter(query_builder.build_filter(dict(data, min_elo=0, max_elo=9000), elo_string='average_elo')).iterator():
+    utils.build_civ_opening_elo_win_for_match(match, data_dict)
+  def counts(civ):
+    return (not include_civ_ids or civ in include_civ_ids) and civ not in exclude_civ_ids
+  rows = {}
+  for (opening1, civ1, opening2, civ2, map_id, ladder_id, patch_number, elo), value in data_dict.items():
+    if not data['min_elo'] <= elo <= data['max_elo'] or (clamp_civ_ids and not {civ1, civ2} <= set(clamp_civ_ids)):
+      continue
+    if not counts(civ1) and not counts(civ2):
+      continue
+    row = rows.setdefault((opening1, opening2), [None] * 4)
+    for side, civ in ((1, civ1), (2, civ2)):
+      if counts(civ):
+        for i, column in enumerate((f'opening{side}_victory_count', f'opening{side}_loss_count'), 2 * side - 2):
+          row[i] = (row[i] or 0) + value[column]
+  return [key + tuple(row) for key, row in rows.items()]
+
+def bench_civ_openings(command, options):
+  #runs against the configured database after rebuild_rollups, so use a populated one
+  iterations = options['iterations']
+  civs = list(Matches.objects.values('player1_civilization').annotate(games=Count('id')).order_by('-games')
+              .values_list('player1_civilization', flat=True)[:4])
+  data = dict(STANDARD_PARAMETERS, include_ladder_ids=[-1], include_map_ids=[-1])
+  #without civ filters the civ columns sum back to opening_elo_wins
+  openings = aggregation.opening_rows(OpeningEloWins.objects.filter(query_builder.build_filter(data)))
+  assert sorted(openings) == sorted(aggregation.civ_opening_rows(CivOpeningEloWins.objects.filter(query_builder.build_filter(data)), data))
+  cases = [
+    ('include 1 civ', dict(data, include_civ_ids=civs[:1])),
+    ('exclude 2 civs', dict(data, exclude_civ_ids=civs[:2])),
+    ('clamp to 4 civs', dict(data, clamp_civ_ids=civs)),
+    ('include 1 civ, clamp to 4 civs', dict(data, include_civ_ids=civs[:1], clamp_civ_ids=civs)),
+  ]
+  for name, case in cases:
+    rows = sorted(cubes.opening_rows(case))
+    assert rows == sorted(civ_opening_rows_from_matches(case)), name
+    command.stdout.write(f'{name} ({iterations} iterations, {len(rows)} groups)')
+    scan_time = time_call(lambda: aggregation.fold_opening_win_rates(civ_opening_rows_from_matches(case), [-1]), iterations)
+    report(command, '  Matches scan + classify', scan_time)
+    report(command, '  civ_opening_elo_wins GROUP BY + fold',
+           time_call(lambda: aggregation.fold_opening_win_rates(cubes.opening_rows(case), [-1]), iterations), scan_time)
+
+def synthetic_rollup_deltas(count):
+  random.seed(0)
+  civs, openings, techs = {}, {}, {}
+  while len(civs) < count:
+    key = (random.randrange(1, 46), random.choice([9, 29, 33]), random.choice([3, 4]), random.randrange(1, 4),
+           utils.ELO_DELTA * random.randrange(10, 50))
+    civs[key] = {'victory_count':random.randrange(5), 'loss_count':random.randrange(5)}
+    openings[(key[0] % len(utils.OPENINGS), key[0] % len(utils.OPENINGS)) + key[1:]] = \
+        {'opening1_victory_count':1, 'opening1_loss_count':2, 'opening2_victory_count':2, 'opening2_loss_count':1}
+    techs[(key[0] % len(utils.OPENINGS), 101) + key[1:]] = {'average_time':random.randrange(500000, 900000), 'research_count':3}
+  return civs, openings, techs
+
+def bench_import(command, options):
+  #writes to the configured database inside a transaction that is rolled back
+  civs, openings, techs = synthetic_rollup_deltas(options['rows'])
+  cases = [('civ_elo_wins', rollups.upsert_civ_elo_wins, civs),
+           ('opening_elo_wins', rollups.upsert_opening_elo_wins, openings),
+           ('opening_elo_techs', rollups.upsert_opening_elo_techs, techs)]
+  with transaction.atomic():
+    for name, upsert, deltas in cases:
+      #first pass inserts every key, second pass hits the conflict/update path
+      for label in ('insert', 'update'):
+        start = time.perf_counter()
+        rows = upsert(deltas)
+        elapsed = time.perf_counter() - start
+        command.stdout.write(f'{name:<20} {label:<8} {rows:>8} rows {rows / elapsed:>12.0f} rows/s')
+    transaction.set_rollback(True)
+
+def synthetic_upload(count):
+  #copies of stored matches and their actions under new ids, as an uploader would send them
+  next_id = Matches.objects.order_by('-id').values_list('id', flat=True).first() + 1
+  sources = list(Matches.objects.order_by('id')[:count])
+  matches, actions = [], []
+  for i in range(count):
+    source = sources[i % len(sources)]
+    match = dict(MatchesSerializer(source).data, id=next_id + i)
+    matches.append(match)
+    for action in MatchPlayerActionsSerializer(MatchPlayerActions.objects.filter(match_id=source.id), many=True).data:
+      actions.append(dict({key:value for key, value in action.items() if key != 'id'}, match=match['id']))
+  return json.loads(json.dumps({'matches':matches, 'match_player_actions':actions}, default=str))
+
+def bench_ingest(command, options):
+  #validates and inserts a synthetic upload inside transactions that are rolled back
+  upload = synthetic_upload(options['rows'])
+  def serializers():
+    matches_serializer = MatchesSerializer(data=upload['matches'], many=True)
+    matches_serializer.is_valid(raise_exception=True)
+    matches_serializer.save()
+    actions_serializer = MatchPlayerActionsSerializer(data=upload['match_player_actions'], many=True)
+    actions_serializer.is_valid(raise_exception=True)
+    patch_numbers = {match.id:match.patch_number for match in matches_serializer.instance}
+    MatchPlayerActions.objects.bulk_create(MatchPlayerActions(**action, patch_number=patch_numbers[action['match'].id])
+                                           for action in actions_serializer.validated_data)
+  def schema():
+    match_rows = validation.MATCHES.validate(upload['matches'], 'matches')
+    action_rows = validation.MATCH_PLAYER_ACTIONS.validate(upload['match_player_actions'], 'match_player_actions')
+    validation.check_foreign_keys(validation.MATCHES, match_rows, 'matches')
+    matches = Matches.objects.bulk_create((Matches(**match) for match in match_rows), batch_size=importer.BULK_BATCH_SIZE)
+    validation.check_foreign_keys(validation.MATCH_PLAYER_ACTIONS, action_rows, 'match_player_actions',
+                                  known={'match':{match.id for match in matches}})
+    validation.check_unique_together(validation.MATCH_PLAYER_ACTIONS, action_rows, 'match_player_actions')
+    importer.copy_patch_numbers(action_rows, matches)
+    MatchPlayerActions.objects.bulk_create((MatchPlayerActions(**action) for action in action_rows), batch_size=importer.BULK_BATCH_SIZE)
+  def rolled_back(function):
+    with transaction.atomic():
+      start = time.perf_counter()
+      function()
+      elapsed = time.perf_counter() - start
+      transaction.set_rollback(True)
+    return elapsed
+  rows = len(upload['matches']) + len(upload['match_player_actions'])
+  command.stdout.write(f'{len(upload["matches"])} matches, {len(upload["match_player_actions"])} actions')
+  serializer_time = rolled_back(serializers)
+  command.stdout.write(f'  {"ModelSerializer + save()":<32} {serializer_time:>8.3f} s {rows / serializer_time:>10.0f} rows/s')
+  schema_time = rolled_back(schema)
+  command.stdout.write(f'  {"validation.Schema + bulk_create":<32} {schema_time:>8.3f} s {rows / schema_time:>10.0f} rows/s  ({serializer_time / schema_time:.1f}x)')
+
+def legacy_classify_match_player(match, player):
+  #per-bit walk over the boolean flag columns the build_* helpers used before the bitmask classifier
+  valid_openings = []
+  for opening_index, opening_info in enumerate(utils.OPENINGS):
+    valid_opening = False
+    for inclusion in opening_info[1]:
+      valid_inclusion = True
+      for i in range(32):
+        if inclusion & 2**i and getattr(match, f'player{player}_opening_flag{i}') == False:
+          valid_inclusion = False
+          break
+      valid_opening |= valid_inclusion
+    exclusions = opening_info[2] if len(opening_info[2]) else [utils.OpeningType.Unused.value]
+    for exclusion in exclusions:
+      if not valid_opening:
+        break
+      for i in range(32):
+        if exclusion & 2**i and getattr(match, f'player{player}_opening_flag{i}') == True:
+          valid_opening = False
+          break
+    if valid_opening:
+      valid_openings.append(opening_index)
+  if not len(valid_openings):
+    valid_openings.append(len(utils.OPENINGS)-1)
+  return tuple(valid_openings)
+
+def bench_classifier(command, options):
+  matches = list(Matches.objects.all()[:options['rows']])
+  if not matches:
+    command.stderr.write('No matches in the database to classify')
+    return
+  for match in matches:
+    for player in range(1,3):
+      assert legacy_classify_match_player(match, player) == utils.classify_match_player(match, player), match.id
+  def classify_all(classify):
+    return lambda: [classify(match, player) for match in matches for player in range(1,3)]
+  iterations = max(1, options['iterations'] // 20)
+  command.stdout.write(f'classify {len(matches)} matches ({iterations} iterations)')
+  legacy_time = time_call(classify_all(legacy_classify_match_player), iterations)
+  report(command, '  per-bit walk', legacy_time)
+  report(command, '  bitmask', time_call(classify_all(utils.classify_match_player), iterations), legacy_time)
+  command.stdout.write(f'  distinct flag words: {utils.classify_opening_flag_word.cache_info().currsize}')
+
+def wide_advanced_query(count):
+  #count matchups cycling through opening pairs, as parsed from a queue row
+  data = {'min_elo':'0', 'max_elo':'9000', 'include_patch_ids':[-1], 'include_ladder_ids':[-1], 'include_map_ids':[-1]}
+  pairs = [(i, j) for i in range(len(utils.OPENINGS)) for j in range(len(utils.OPENINGS))]
+  for row, (i, j) in enumerate(pairs[:count]):
+    data[f'include_opening_ids_{2*row}'] = [i]
+    data[f'include_opening_ids_{2*row+1}'] = [j]
+  return data
+
+def bench_advanced(command, options):
+  #end to end latency of one queue query, runs against the configured database
+  iterations = max(1, options['iterations'] // 20)
+  for count in (1, 10, utils.ADVANCED_QUERY_COUNT):
+    data = wide_advanced_query(count)
+    single = advanced_queue.run_query_single(data)
+    assert single == advanced_queue.run_query(data), count
+    command.stdout.write(f'{count} matchups ({iterations} iterations)')
+    single_time = time_call(lambda: advanced_queue.run_query_single(data), iterations)
+    report(command, '  single aggregate', single_time)
+    for threads in (1, 4, 8):
+      report(command, f'  fan-out, {threads} threads', time_call(lambda: advanced_queue.run_query(data, threads), iterations), single_time)
+
+#indexes added by migration 0017, and the ones it replaced
+PATCH_INDEXES = ['civ_elo_wins_patch_idx', 'opening_elo_wins_patch_idx', 'opening_elo_techs_patch_idx',
+                 'matches_patch_elo_idx', 'matches_player1_patch_idx', 'matches_player2_patch_idx', 'matches_time_idx']
+REPLACED_INDEXES = [('matches', 'player1_id'), ('matches', 'player2_id')]
+
+def capture_queries(function):
+  #[(sql, params)] of every query function runs on this thread's connection
+  queries = []
+  def capture(execute, sql, params, many, context):
+    queries.append((sql, params))
+    return execute(sql, params, many, context)
+  with connection.execute_wrapper(capture):
+    function()
+  return queries
+
+def plan_scans(node):
+  #every scan node of an EXPLAIN (FORMAT JSON) plan
+  if 'Scan' in node['Node Type']:
+    yield node
+  for child in node.get('Plans', []):
+    yield from plan_scans(child)
+
+def explain(sql, params):
+  #(scans, rows read, buffers), rows and buffers are None where the database only gives the plan
+  with connection.cursor() as cursor:
+    if connection.vendor == 'postgresql':
+      cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+      plan = cursor.fetchone()[0][0]['Plan']
+      scans = list(plan_scans(plan))
+      rows = sum((scan['Actual Rows'] + scan.get('Rows Removed by Filter', 0) + scan.get('Rows Removed by Index Recheck', 0))
+                 * scan['Actual Loops'] for scan in scans)
+      names = [f"{scan['Node Type']} {scan.get('Index Name', scan.get('Relation Name', ''))}".strip() for scan in scans]
+      return ', '.join(names), rows, plan['Shared Hit Blocks'] + plan['Shared Read Blocks']
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return ', '.join(row[-1] for row in cursor.fetchall()), None, None
+
+def index_endpoints():
+  #(name, function) running the SQL path of each endpoint for a typical request on the busiest recent patch
+  patch = CivEloWins.objects.aggregate(patch=Max('patch_number'))['patch'] or reference.get().latest_patch_id
+  data = dict(STANDARD_PARAMETERS, include_patch_ids=[patch], include_map_ids=[-1])
+  query = lambda model: model.objects.filter(query_builder.build_filter(data))
+  tech_ids = sorted(reference.get().techs_by_id)
+  advanced = dict(wide_advanced_query(4), min_elo='1000', max_elo='2000', include_patch_ids=[patch], include_ladder_ids=[3, 4])
+  player = Matches.objects.filter(patch_number=patch).values_list('player1_id', flat=True).first() or 0
+  player_advanced = dict(advanced, left_player_id=str(player))
+  def player_matchups():
+    #the queries of advanced_queue.run_matchup, which can't run inside the benchmark's transaction
+    base_filter = query_builder.build_filter(player_advanced, elo_string="average_elo")
+    return [Matches.objects.filter(base_filter & (left_first | left_second))
+            .aggregate(**query_builder.advanced_matchup_aggregates(name, suffix, left_first, left_second))
+            for name, suffix, left_first, left_second in query_builder.advanced_matchups(player_advanced)]
+  return [
+    ('civ_win_rates', lambda: aggregation.civ_rows(query(CivEloWins))),
+    ('opening_win_rates, opening_matchups', lambda: aggregation.opening_rows(query(OpeningEloWins))),
+    ('opening_techs', lambda: aggregation.tech_rows(query(OpeningEloTechs).filter(query_builder.opening_tech_filter(tech_ids)))),
+    ('info, last_uploaded_match', lambda: Matches.objects.latest('time')),
+    ('advanced, single aggregate', lambda: advanced_queue.run_query_single(advanced)),
+    ('advanced, left player matchups', player_matchups),
+  ]
+
+def measure_endpoints(iterations):
+  #{name: ([(scans, rows, buffers)...], seconds)}
+  return {name: ([explain(sql, params) for sql, params in capture_queries(function)], time_call(function, iterations))
+          for name, function in index_endpoints()}
+
+def bench_indexes(command, options):
+  #plans with and without the 0017 indexes, dropped in a rolled back transaction;
+  #DROP INDEX locks the tables until then, so run it against a copy of the database
+  iterations = options['iterations']
+  after = measure_endpoints(iterations)
+  with transaction.atomic():
+    with connection.cursor() as cursor:
+      for name in PATCH_INDEXES:
+        cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
+      for table, column in REPLACED_INDEXES:
+        cursor.execute(f'CREATE INDEX {connection.ops.quote_name(f"{table}_{column}_before")} ON {table} ({column})')
+    before = measure_endpoints(iterations)
+    transaction.set_rollback(True)
+  for name, (after_plans, after_time) in after.items():
+    before_plans, before_time = before[name]
+    command.stdout.write(f'{name} ({iterations} iterations)')
+    for label, plans in (('before', before_plans), ('after', after_plans)):
+      for scans, rows, buffers in plans:
+        line = f'  {label:<7}{scans}'
+        if rows is not None:
+          line += f'  [{rows} rows read, {buffers} buffers]'
+        command.stdout.write(line)
+    report(command, '  without 0017 indexes', before_time)
+    report(command, '  with 0017 indexes', after_time, before_time)
+
+def bench_match_index(command, options):
+  #bitmap answers against the queue's aggregate, runs against the configured database; needs pyroaring
+  iterations = options['iterations']
+  start = time.perf_counter()
+  index = match_index.build()
+  command.stdout.write(f'built from {len(index.bitmap(match_index.ALL))} matches in {time.perf_counter() - start:.2f}s')
+  patch = Matches.objects.aggregate(patch=Max('patch_number'))['patch']
+  cases = [
+    ('1 matchup', wide_advanced_query(1)),
+    ('10 matchups', wide_advanced_query(10)),
+    (f'{utils.ADVANCED_QUERY_COUNT} matchups, filtered',
+     dict(wide_advanced_query(utils.ADVANCED_QUERY_COUNT), min_elo='1000', max_elo='2000', include_patch_ids=[patch],
+          include_ladder_ids=[3, 4], exclude_civ_mirrors='True', exclude_opening_mirrors='True')),
+    ('civs and openings', dict(wide_advanced_query(0), include_civ_ids_0=[3], include_opening_ids_0=[2],
+                               include_civ_ids_1=[5], include_opening_ids_1=[-1], include_civ_ids_2=[4], include_opening_ids_3=[7])),
+  ]
+  for name, data in cases:
+    assert index.run_query(data) == advanced_queue.run_query_single(data), name
+    command.stdout.write(f'{name} ({iterations} iterations)')
+    queue_time = time_call(lambda: advanced_queue.run_query_single(data), iterations)
+    report(command, '  Matches aggregate', queue_time)
+    report(command, '  bitmaps', time_call(lambda: index.run_query(data), iterations), queue_time)
+
+def synthetic_request_log(count):
+  #GET requests the way the frontend and users produce them: ids in any order,
+  #duplicates, the latest patch implicit or explicit, parameters the endpoint ignores
+  random.seed(0)
+  latest_patch = reference.get().latest_patch_id
+  endpoints = [('civ_win_rates', views.CIV_WIN_RATE_PARAMETERS),
+               ('opening_win_rates', views.OPENING_PARAMETERS),
+               ('opening_matchups', views.OPENING_PARAMETERS),
+               ('opening_techs', views.OPENING_TECH_PARAMETERS)]
+  log = []
+  for i in range(count):
+    name, keys = random.choice(endpoints)
+    parameters = []
+    maps = random.choice([[], [9], [9, 29], [9, 29, 33]])
+    if maps:
+      maps = random.sample(maps, len(maps)) + random.choice([[], maps[:1]])
+      parameters.append(('include_map_ids', ','.join(map(str, maps))))
+    if random.random() < 0.5:
+      parameters.append(('include_patch_ids', str(latest_patch)))
+    parameters.append(('min_elo', str(random.choice([0, 1000]))))
+    if random.random() < 0.3:
+      parameters.append(('include_opening_ids', '1,3'))
+    if name == 'opening_techs' and random.random() < 0.3:
+      parameters.append(('include_tech_ids', '101,102,103'))
+    random.shuffle(parameters)
+    log.append((name, keys, '&'.join(f'{key}={value}' for key, value in parameters)))
+  return log
+
+def bench_cache_keys(command, options):
+  #hit rate of an unbounded cache over a request log = 1 - distinct keys / requests
+  log = synthetic_request_log(options['rows'])
+  factory = RequestFactory()
+  url_keys, parsed_keys, canonical_keys = set(), set(), set()
+  for name, keys, query_string in log:
+    url_keys.add(f'/api/v1/{name}/?{query_string}')
+    data, error = utils.parse_standard_query_parameters(factory.get(f'/api/v1/{name}/?{query_string}'), True)
+    #every parameter as sent, in any order
+    raw = dict(urllib.parse.parse_qsl(query_string))
+    parsed_keys.add((name, tuple(sorted(raw.items()))))
+    if name == 'opening_techs' and data['include_tech_ids'][0] == -1:
+      data['include_tech_ids'] = [101, 102, 103]
+    canonical_keys.add(response_cache.cache_key(name, data, keys))
+  command.stdout.write(f'{len(log)} requests')
+  for label, keys in (('raw url (cache middleware)', url_keys), ('parameters as sent', parsed_keys), ('canonical parameters', canonical_keys)):
+    command.stdout.write(f'  {label:<30} {len(keys):>6} entries  hit rate {1 - len(keys) / len(log):.1%}')
+
+SUITES = {
+  'advanced':bench_advanced,
+  'aggregation':bench_aggregation,
+  'cache_keys':bench_cache_keys,
+  'civ_openings':bench_civ_openings,
+  'classifier':bench_classifier,
+  'engine':bench_engine,
+  'import':bench_import,
+  'indexes':bench_indexes,
+  'ingest':bench_ingest,
+  'match_index':bench_match_index,
+  'meta_snapshot':bench_meta_snapshot,
+  'query_builder':bench_query_builder,
+}
+
+class Command(BaseCommand):
+  help = 'Run micro-benchmarks for the opening stats hot paths'
+
+  def add_arguments(self, parser):
+    parser.add_argument('suite', choices=sorted(SUITES))
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--rows', type=int, default=10000)
+
+  def handle(self, **options):
+    SUITES[options['suite']](self, options)
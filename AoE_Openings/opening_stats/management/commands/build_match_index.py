@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from opening_stats import match_index
+import time
+
+
+class Command(BaseCommand):
+  help = 'Build the advanced query match index from all matches and save it to MATCH_INDEX_PATH'
+
+  def handle(self, **options):
+    if match_index.BitMap is None:
+      raise CommandError('pyroaring is not installed')
+    start = time.time()
+    index = match_index.build()
+    index.catch_up()
+    index.save(settings.MATCH_INDEX_PATH)
+    self.stdout.write(f'{len(index.bitmap(match_index.ALL))} matches, {len(index.bitmaps)} bitmaps, '
+                      f'saved to {settings.MATCH_INDEX_PATH} in {time.time() - start:.1f}s')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from opening_stats import partitions
+
+
+class Command(BaseCommand):
+  help = 'Detach the matches and match_player_actions partitions of an old patch (PostgreSQL)'
+
+  def add_arguments(self, parser):
+    parser.add_argument('patch_number', type=int)
+    parser.add_argument('--drop', action='store_true', help='Drop the detached tables instead of keeping them')
+
+  def handle(self, **options):
+    patch_number = options['patch_number']
+    if not partitions.partitioned():
+      raise CommandError('matches is not partitioned, see migration 0018')
+    if patch_number not in partitions.existing():
+      raise CommandError(f'no partition for patch {patch_number}')
+    partitions.detach(patch_number, drop=options['drop'])
+    #the rollup tables keep the patch's counts until the next rebuild_rollups
+    verb = 'dropped' if options['drop'] else 'detached'
+    self.stdout.write(f'{verb} {", ".join(partitions.partition_name(table, patch_number) for table in partitions.TABLES)}')
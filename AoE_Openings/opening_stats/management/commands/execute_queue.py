@@ -1,13 +1,56 @@
-from django.core.management.base import BaseCommand
-from opening_stats.utils import ProcessNextElementInAdvancedQueue
+from django.core.management.base import BaseCommand, CommandError
+from django import db
+from opening_stats import advanced_queue
+import multiprocessing
+import signal
+import sys
 import time
 
 
+def worker_main(lease_seconds, heartbeat_seconds, threads):
+  #worker id is taken from the child's pid
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  advanced_queue.run_worker(lease_seconds=lease_seconds, heartbeat_seconds=heartbeat_seconds, threads=threads)
+
 class Command(BaseCommand):
+  help = 'Process the advanced query queue with one or more worker processes'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--lease', type=float, default=advanced_queue.LEASE_SECONDS,
+                        help='Seconds without a heartbeat before a claimed query is handed to another worker')
+    parser.add_argument('--heartbeat', type=float, default=advanced_queue.HEARTBEAT_SECONDS)
+    parser.add_argument('--threads', type=int, default=advanced_queue.QUERY_THREADS,
+                        help='Threads per worker running the matchups of a query in parallel, 0 runs them as one query')
+
   def handle(self, **options):
-    while True:
-      found = ProcessNextElementInAdvancedQueue();
-      if not found:
-        # If nothing in queue wait half a second before trying again to not bog down the system
-        time.sleep(0.5)
+    workers, lease, heartbeat, threads = options['workers'], options['lease'], options['heartbeat'], options['threads']
+    if workers < 1:
+      raise CommandError('--workers must be at least 1')
+    if heartbeat >= lease:
+      raise CommandError('--heartbeat must be shorter than --lease')
+    if workers == 1:
+      advanced_queue.run_worker(lease_seconds=lease, heartbeat_seconds=heartbeat, threads=threads)
+      return
 
+    #stop the workers too when the supervisor is terminated
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    #children must not share the parent's db connection
+    db.connections.close_all()
+    context = multiprocessing.get_context('fork')
+    processes = {}
+    try:
+      while True:
+        #(re)start any worker that is not running, rows of a dead worker are reclaimed after the lease
+        for i in range(workers):
+          if i not in processes or not processes[i].is_alive():
+            if i in processes:
+              self.stderr.write(f'worker {i} exited with {processes[i].exitcode}, restarting')
+            processes[i] = context.Process(target=worker_main, args=(lease, heartbeat, threads), daemon=True)
+            processes[i].start()
+        time.sleep(1)
+    finally:
+      for process in processes.values():
+        process.terminate()
+      for process in processes.values():
+        process.join()
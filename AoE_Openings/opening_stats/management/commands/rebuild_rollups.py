@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from opening_stats import rebuild
+import os
+
+
+class Command(BaseCommand):
+  help = 'Rebuild civ_elo_wins, opening_elo_wins, civ_opening_elo_wins, opening_elo_techs and opening_meta_snapshot from all matches'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--partitions', type=int, default=None,
+                        help='Match id ranges to split the work into, spread over the patches, 4 per worker by default')
+
+  def handle(self, **options):
+    workers, partitions = options['workers'], options['partitions']
+    if workers < 1:
+      raise CommandError('--workers must be at least 1')
+    if partitions is not None and partitions < 1:
+      raise CommandError('--partitions must be at least 1')
+    counts = rebuild.rebuild_rollups(workers, partitions, log=self.stdout.write)
+    self.stdout.write('rows: civ_elo_wins %d, opening_elo_wins %d, civ_opening_elo_wins %d, opening_elo_techs %d' % counts)
@@ -0,0 +1,255 @@
+import collections
+import itertools
+import os
+import pickle
+import tempfile
+import threading
+
+from django import db
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max
+from opening_stats.models import Matches, MatchIndexLog
+from . import utils, query_builder
+
+try:
+  from pyroaring import BitMap
+except ImportError:
+  BitMap = None
+
+# Optional inverted index over matches for the advanced queries, enabled with
+# ADVANCED_QUERY_ENGINE = 'bitmap' when pyroaring is installed. It keeps one
+# roaring bitmap of match ids per patch, map, ladder, average elo (and elo
+# bucket), civ and opening flag bit of each player slot, victory of each slot,
+# plus civ mirrors. A matchup of advanced_queue.run_query becomes unions and
+# intersections of those and three cardinalities, so advanced_queue.
+# answer_or_enqueue answers most requests in the request instead of queueing
+# them. Requests with a left player are not indexed and still go through the
+# queue.
+#
+# Every import writes the ids it added to match_index_log, and each process
+# replays the entries after its own position before answering, so an answer
+# always covers every committed import. A reset entry (matches deleted or a
+# patch detached) rebuilds the index from the matches table. A process loads
+# the copy saved at MATCH_INDEX_PATH in a background thread, or builds and
+# saves one, and queues requests until it is ready:
+#   python manage.py build_match_index
+
+FIELDS = ['id', 'patch_number', 'map_id', 'ladder_id', 'average_elo', 'player1_civilization', 'player2_civilization',
+          'player1_opening_flags', 'player2_opening_flags', 'player1_victory', 'player2_victory']
+#bumped when the saved layout changes, older files are rebuilt
+FORMAT = 1
+LOAD_CHUNK = 10000
+#pg_advisory_xact_lock key shared by imports, synchronous answers and queue claims
+LOCK_KEY = 0x6d61746368
+ALL = ('all',)
+MIRROR = ('mirror',)
+
+def enabled():
+  return BitMap is not None and getattr(settings, 'ADVANCED_QUERY_ENGINE', 'queue') == 'bitmap'
+
+def lock(shared=False):
+  #imports take it from apply_import to commit, answers while they read the index and store the result and
+  #queue claims while they claim a row, so an answer or claimed row either sees an import's matches or is
+  #updated or staled by its apply_import (PostgreSQL)
+  if connection.vendor == 'postgresql':
+    with connection.cursor() as cursor:
+      cursor.execute(f'SELECT pg_advisory_xact_lock{"_shared" if shared else ""}(%s)', [LOCK_KEY])
+
+def log_import(match_ids):
+  MatchIndexLog.objects.create(match_ids=list(match_ids))
+
+def _bits(word):
+  #indexes of the set bits of word
+  while word:
+    low = word & -word
+    yield low.bit_length() - 1
+    word ^= low
+
+class MatchIndex:
+  def __init__(self, log_id=0):
+    #last match_index_log entry replayed
+    self.log_id = log_id
+    self.bitmaps = collections.defaultdict(BitMap)
+    #elo bucket -> average elos seen in it
+    self.elos = collections.defaultdict(set)
+
+  def add(self, rows):
+    #rows of FIELDS values, adding a match twice changes nothing
+    pending = collections.defaultdict(list)
+    for match_id, patch_number, map_id, ladder_id, elo, civ1, civ2, flags1, flags2, victory1, victory2 in rows:
+      keys = [ALL, ('patch', patch_number), ('map', map_id), ('ladder', ladder_id),
+              ('civ', 1, civ1), ('civ', 2, civ2), ('victory', 1, victory1), ('victory', 2, victory2)]
+      if type(elo) == int:
+        bucket = utils.ELO_DELTA * (elo // utils.ELO_DELTA)
+        keys += [('elo', elo), ('elo_bucket', bucket)]
+        self.elos[bucket].add(elo)
+      if civ1 == civ2:
+        keys.append(MIRROR)
+      keys += [('flag', 1, bit) for bit in _bits(flags1)]
+      keys += [('flag', 2, bit) for bit in _bits(flags2)]
+      for key in keys:
+        pending[key].append(match_id)
+    for key, match_ids in pending.items():
+      self.bitmaps[key].update(match_ids)
+
+  def catch_up(self):
+    #replays the log after log_id, False if a reset entry means the index has to be rebuilt
+    entries = list(MatchIndexLog.objects.filter(id__gt=self.log_id).order_by('id').values_list('id', 'match_ids', 'reset'))
+    if any(reset for _, _, reset in entries):
+      return False
+    match_ids = [match_id for _, ids, _ in entries for match_id in ids]
+    for start in range(0, len(match_ids), LOAD_CHUNK):
+      self.add(Matches.objects.filter(id__in=match_ids[start:start + LOAD_CHUNK]).values_list(*FIELDS))
+    if entries:
+      self.log_id = entries[-1][0]
+    return True
+
+  def bitmap(self, key):
+    return self.bitmaps.get(key) or BitMap()
+
+  def union(self, keys):
+    bitmaps = [self.bitmaps[key] for key in keys if key in self.bitmaps]
+    return BitMap.union(*bitmaps) if bitmaps else BitMap()
+
+  def elo_range(self, min_elo, max_elo):
+    #whole buckets inside the range, single elos at its edges
+    keys = []
+    for bucket, elos in self.elos.items():
+      if bucket >= min_elo and bucket + utils.ELO_DELTA - 1 <= max_elo:
+        keys.append(('elo_bucket', bucket))
+      elif bucket <= max_elo and bucket + utils.ELO_DELTA - 1 >= min_elo:
+        keys += [('elo', elo) for elo in elos if min_elo <= elo <= max_elo]
+    return self.union(keys)
+
+  def base(self, data):
+    #query_builder.build_filter(data, elo_string="average_elo")
+    ladder_ids, patch_ids, map_ids, exclude_civ_mirrors, min_elo, max_elo = query_builder.normalize_filter_parameters(data)
+    matches = self.elo_range(min_elo, max_elo)
+    for name, ids in (('ladder', ladder_ids), ('patch', patch_ids), ('map', map_ids)):
+      if ids:
+        matches &= self.union((name, i) for i in ids)
+    if exclude_civ_mirrors:
+      matches -= self.bitmap(MIRROR)
+    return matches
+
+  def has_bits(self, slot, word):
+    #flags & word == word
+    return BitMap.intersection(self.bitmap(ALL), *(self.bitmap(('flag', slot, bit)) for bit in _bits(word)))
+
+  def opening(self, slot, opening_id):
+    #query_builder.player_opening_q
+    inclusions, exclusion_mask = utils.OPENING_MASKS[opening_id]
+    matches = BitMap.union(*(self.has_bits(slot, inclusion) for inclusion in inclusions)) if inclusions else self.bitmap(ALL)
+    return matches - self.union(('flag', slot, bit) for bit in _bits(exclusion_mask))
+
+  def player(self, slot, opening_ids, civ_ids):
+    #query_builder.player_q without a profile id, None if nothing is selected
+    if not opening_ids and not civ_ids:
+      return None
+    matches = self.bitmap(ALL)
+    for opening_id in opening_ids:
+      matches = matches & self.opening(slot, opening_id)
+    if civ_ids:
+      matches = matches & self.union(('civ', slot, civ) for civ in civ_ids)
+    return matches
+
+  def run_query(self, data):
+    #same dict as advanced_queue.run_query
+    base = self.base(data)
+    exclude_opening_mirrors = data.get('exclude_opening_mirrors') == 'True'
+    matches = {}
+    for name, suffix, left_openings, left_civs, right_openings, right_civs in query_builder.advanced_matchup_rows(data):
+      left = {slot:self.player(slot, left_openings, left_civs) for slot in range(1,3)}
+      right = {slot:self.player(slot, right_openings, right_civs) for slot in range(1,3)}
+      if exclude_opening_mirrors:
+        for slot in range(1,3):
+          left_opening = self.player(slot, left_openings, [])
+          if left_opening is not None:
+            right[slot] = (self.bitmap(ALL) if right[slot] is None else right[slot]) - left_opening
+      first = base & _and(left[1], right[2])
+      second = base & _and(left[2], right[1])
+      matches[f'{name}_total_{suffix}'] = len(first | second)
+      matches[f'{name}_wins_{suffix}'] = len((first & self.bitmap(('victory', 1, 1))) | (second & self.bitmap(('victory', 2, 1))))
+      matches[f'{name}_losses_{suffix}'] = len((first & self.bitmap(('victory', 1, 0))) | (second & self.bitmap(('victory', 2, 0))))
+    return matches
+
+  def save(self, path):
+    #written next to path and renamed over it, readers never see a partial file
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(os.path.abspath(path)), delete=False) as f:
+      pickle.dump({'format':FORMAT, 'log_id':self.log_id, 'bitmaps':dict(self.bitmaps), 'elos':dict(self.elos)},
+                  f, pickle.HIGHEST_PROTOCOL)
+    os.replace(f.name, path)
+
+  @classmethod
+  def load(cls, path):
+    #None if there is no usable saved copy
+    try:
+      with open(path, 'rb') as f:
+        state = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+      return None
+    if state.get('format') != FORMAT:
+      return None
+    index = cls(state['log_id'])
+    index.bitmaps.update(state['bitmaps'])
+    index.elos.update(state['elos'])
+    return index
+
+def _and(a, b):
+  return a if b is None else b if a is None else a & b
+
+def build():
+  #every match; the log position is taken first, replaying entries the scan already saw changes nothing
+  index = MatchIndex(MatchIndexLog.objects.aggregate(last=Max('id'))['last'] or 0)
+  rows = Matches.objects.values_list(*FIELDS).iterator(chunk_size=LOAD_CHUNK)
+  while True:
+    chunk = list(itertools.islice(rows, LOAD_CHUNK))
+    if not chunk:
+      break
+    index.add(chunk)
+  return index
+
+_lock = threading.RLock()
+_index = None
+_loader = None
+
+def _load():
+  global _index
+  try:
+    path = settings.MATCH_INDEX_PATH
+    index = MatchIndex.load(path)
+    if index is None or not index.catch_up():
+      index = build()
+      index.save(path)
+      index.catch_up()
+    with _lock:
+      _index = index
+  except Exception as e:
+    print(f'match index failed to load: {e}')
+  finally:
+    db.connections.close_all()
+
+def get():
+  #this process' index, None while it is loaded in the background
+  global _loader
+  with _lock:
+    if _index is None and (_loader is None or not _loader.is_alive()):
+      _loader = threading.Thread(target=_load, daemon=True, name='match-index-loader')
+      _loader.start()
+    return _index
+
+def run_query(data):
+  #advanced_queue.run_query from the index, None if it can't answer (disabled, still loading, left player)
+  global _index
+  if not enabled() or int(data.get('left_player_id', 0)):
+    return None
+  with _lock:
+    index = get()
+    if index is None:
+      return None
+    if not index.catch_up():
+      _index = None
+      get()
+      return None
+    return index.run_query(data)
@@ -0,0 +1,45 @@
+# Generated by Django 4.0 on 2026-10-18 07:33
+
+from django.db import migrations, models
+from django.db.models import Case, When, Value
+
+
+def pack_opening_flags(apps, schema_editor):
+    Matches = apps.get_model('opening_stats', 'Matches')
+    updates = {}
+    for player in range(1, 3):
+        word = Value(0, output_field=models.BigIntegerField())
+        for i in range(32):
+            word = word + Case(When(**{f'player{player}_opening_flag{i}': True}, then=Value(2**i)),
+                               default=Value(0), output_field=models.BigIntegerField())
+        updates[f'player{player}_opening_flags'] = word
+    Matches.objects.update(**updates)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opening_stats', '0012_patches_description'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matches',
+            name='player1_opening_flags',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='matches',
+            name='player2_opening_flags',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(pack_opening_flags, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='matches',
+            index=models.Index(fields=['patch_number', 'player1_opening_flags'], name='matches_patch_n_d5fc83_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='matches',
+            index=models.Index(fields=['patch_number', 'player2_opening_flags'], name='matches_patch_n_31c0f1_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0 on 2026-10-18 07:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opening_stats', '0013_matches_player_opening_flags'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='advancedqueryqueue',
+            name='claimed_by',
+            field=models.CharField(max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0 on 2026-10-18 07:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opening_stats', '0014_advancedqueryqueue_claimed_by'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='advancedqueryqueue',
+            index=models.Index(fields=['stale', 'result', 'id'], name='advanced_qu_stale_bb37a6_idx'),
+        ),
+    ]
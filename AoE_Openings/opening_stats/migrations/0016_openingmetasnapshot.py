@@ -0,0 +1,53 @@
+# Generated by Django 4.0 on 2026-10-18 07:52
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+#len(utils.Basic_Strategies) when this migration was written
+BASIC_STRATEGIES = 5
+
+
+def build_opening_meta_snapshot(apps, schema_editor):
+    OpeningEloWins = apps.get_model('opening_stats', 'OpeningEloWins')
+    OpeningMetaSnapshot = apps.get_model('opening_stats', 'OpeningMetaSnapshot')
+    counts = {}
+    for column in ('opening1_id', 'opening2_id'):
+        rows = OpeningEloWins.objects\
+            .filter(opening2_id__lt=BASIC_STRATEGIES)\
+            .values('patch_number', 'ladder_id', 'elo', column)\
+            .annotate(games=Sum(F('opening1_victory_count') + F('opening1_loss_count')))\
+            .order_by()\
+            .values_list('patch_number', 'ladder_id', 'elo', column, 'games')
+        for patch_number, ladder_id, elo, opening_id, games in rows:
+            key = (patch_number, ladder_id, elo, opening_id)
+            counts[key] = counts.get(key, 0) + games
+    OpeningMetaSnapshot.objects.bulk_create(
+        (OpeningMetaSnapshot(patch_number=k[0], ladder_id=k[1], elo=k[2], opening_id=k[3], count=v)
+         for k, v in counts.items() if v),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opening_stats', '0015_advancedqueryqueue_position_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpeningMetaSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patch_number', models.IntegerField()),
+                ('ladder_id', models.IntegerField()),
+                ('elo', models.IntegerField()),
+                ('opening_id', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'opening_meta_snapshot',
+                'unique_together': {('patch_number', 'ladder_id', 'elo', 'opening_id')},
+            },
+        ),
+        migrations.RunPython(build_opening_meta_snapshot, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.0 on 2026-10-18 08:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opening_stats', '0016_openingmetasnapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='civelowins',
+            index=models.Index(fields=['patch_number', 'ladder_id', 'elo', 'map_id'], include=('civilization', 'victory_count', 'loss_count'), name='civ_elo_wins_patch_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='openingelowins',
+            index=models.Index(fields=['patch_number', 'ladder_id', 'elo', 'map_id'], include=('opening1_id', 'opening2_id', 'opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count'), name='opening_elo_wins_patch_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='openingelotechs',
+            index=models.Index(fields=['patch_number', 'ladder_id', 'elo', 'map_id'], include=('opening_id', 'tech_id', 'average_time', 'count'), name='opening_elo_techs_patch_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='matches',
+            index=models.Index(fields=['patch_number', 'ladder_id', 'average_elo', 'map_id'], name='matches_patch_elo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='matches',
+            index=models.Index(fields=['player1', 'patch_number', 'average_elo'], name='matches_player1_patch_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='matches',
+            index=models.Index(fields=['player2', 'patch_number', 'average_elo'], name='matches_player2_patch_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='matches',
+            index=models.Index(fields=['time'], name='matches_time_idx'),
+        ),
+        #the player indexes above lead with the foreign key, drop the single column ones
+        migrations.AlterField(
+            model_name='matches',
+            name='player1',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='%(class)s_player1', to='opening_stats.players'),
+        ),
+        migrations.AlterField(
+            model_name='matches',
+            name='player2',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='%(class)s_player2', to='opening_stats.players'),
+        ),
+    ]
@@ -0,0 +1,116 @@
+# Generated by Django 4.0 on 2026-10-18 08:30
+
+import re
+
+from django.db import migrations, models
+from django.db.migrations.exceptions import IrreversibleError
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+TABLES = ['matches', 'match_player_actions']
+
+
+def copy_patch_numbers(apps, schema_editor):
+    Matches = apps.get_model('opening_stats', 'Matches')
+    MatchPlayerActions = apps.get_model('opening_stats', 'MatchPlayerActions')
+    MatchPlayerActions.objects.update(
+        patch_number=Subquery(Matches.objects.filter(id=OuterRef('match_id')).values('patch_number')[:1]))
+
+
+def recreate_tables(schema_editor, partitioned):
+    #moves the rows of both tables into new ones, list partitioned on patch_number with one partition per patch, or plain
+    qn = schema_editor.quote_name
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT id FROM patches UNION SELECT DISTINCT patch_number FROM matches')
+        patch_numbers = sorted(row[0] for row in cursor.fetchall())
+        for table in TABLES:
+            old = f'{table}_old'
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(
+                "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = %s::regclass AND contype IN ('u', 'f') ORDER BY conname", [table])
+            constraints = cursor.fetchall()
+            cursor.execute(
+                "SELECT indexdef FROM pg_indexes "
+                "WHERE schemaname = current_schema() AND tablename = %s "
+                "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass) ORDER BY indexname", [table, table])
+            indexes = [row[0] for row in cursor.fetchall()]
+
+            cursor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(old)}')
+            if partitioned:
+                cursor.execute(f'CREATE TABLE {qn(table)} (LIKE {qn(old)} INCLUDING DEFAULTS) PARTITION BY LIST (patch_number)')
+            else:
+                cursor.execute(f'CREATE TABLE {qn(table)} (LIKE {qn(old)} INCLUDING DEFAULTS)')
+            #the serial id keeps its sequence and values
+            if sequence is not None:
+                cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {qn(table)}.id')
+            if partitioned:
+                for patch_number in patch_numbers:
+                    cursor.execute(f'CREATE TABLE {qn(f"{table}_p{patch_number}")} PARTITION OF {qn(table)} FOR VALUES IN ({int(patch_number)})')
+                cursor.execute(f'CREATE TABLE {qn(f"{table}_default")} PARTITION OF {qn(table)} DEFAULT')
+            cursor.execute(f'INSERT INTO {qn(table)} SELECT * FROM {qn(old)}')
+            #with its partitions
+            cursor.execute(f'DROP TABLE {qn(old)}')
+
+            #unique keys of a partitioned table must contain the partition key
+            if partitioned:
+                cursor.execute(f'ALTER TABLE {qn(table)} ADD PRIMARY KEY (id, patch_number)')
+            else:
+                cursor.execute(f'ALTER TABLE {qn(table)} ADD PRIMARY KEY (id)')
+            for name, definition in constraints:
+                if definition.startswith('UNIQUE ('):
+                    if partitioned and 'patch_number' not in definition:
+                        definition = definition.replace(')', ', patch_number)', 1)
+                    elif not partitioned:
+                        definition = definition.replace(', patch_number)', ')', 1)
+                cursor.execute(f'ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} {definition}')
+            for definition in indexes:
+                cursor.execute(re.sub(r' ON (?:ONLY )?\S+ ', f' ON {qn(table)} ', definition, count=1))
+            cursor.execute(f'ANALYZE {qn(table)}')
+
+
+def partition_tables(apps, schema_editor):
+    #PostgreSQL only
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    recreate_tables(schema_editor, partitioned=True)
+
+
+def unpartition_tables(apps, schema_editor):
+    #back to plain tables with id primary keys, which a match id imported for two patches since would break
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT id FROM matches GROUP BY id HAVING count(*) > 1 ORDER BY id LIMIT 20')
+        duplicated = [row[0] for row in cursor.fetchall()]
+    if duplicated:
+        raise IrreversibleError(f'Match ids {duplicated} are in more than one patch, delete all but one row of each first')
+    recreate_tables(schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opening_stats', '0017_patch_leading_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='matchplayeractions',
+            name='match',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='opening_stats.matches'),
+        ),
+        migrations.AddField(
+            model_name='matchplayeractions',
+            name='patch_number',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.RunPython(copy_patch_numbers, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='matchplayeractions',
+            name='patch_number',
+            field=models.IntegerField(),
+        ),
+        migrations.RunPython(partition_tables, unpartition_tables),
+    ]
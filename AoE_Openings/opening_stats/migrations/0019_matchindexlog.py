@@ -0,0 +1,25 @@
+# Generated by Django 4.0 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opening_stats', '0018_partition_matches_by_patch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchIndexLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField(auto_now_add=True)),
+                ('match_ids', models.JSONField(default=list)),
+                ('reset', models.BooleanField(default=False)),
+            ],
+            options={
+                'db_table': 'match_index_log',
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.0 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+KEYS = ('opening1_id', 'opening1_civilization', 'opening2_id', 'opening2_civilization',
+        'map_id', 'ladder_id', 'patch_number', 'elo')
+
+
+def build_civ_opening_elo_wins(apps, schema_editor):
+    #openings are classified by app code, from the player flag columns that exist since 0013
+    from opening_stats import utils
+    Matches = apps.get_model('opening_stats', 'Matches')
+    CivOpeningEloWins = apps.get_model('opening_stats', 'CivOpeningEloWins')
+    data_dict = {}
+    for match in Matches.objects.all().iterator(chunk_size=2000):
+        if type(match.average_elo) == str:
+            continue
+        utils.build_civ_opening_elo_win_for_match(match, data_dict)
+    CivOpeningEloWins.objects.bulk_create(
+        (CivOpeningEloWins(**dict(zip(KEYS, k)), **v) for k, v in data_dict.items()),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opening_stats', '0019_matchindexlog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CivOpeningEloWins',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('opening1_id', models.IntegerField()),
+                ('opening1_civilization', models.IntegerField()),
+                ('opening2_id', models.IntegerField()),
+                ('opening2_civilization', models.IntegerField()),
+                ('map_id', models.IntegerField()),
+                ('ladder_id', models.IntegerField()),
+                ('patch_number', models.IntegerField()),
+                ('elo', models.IntegerField()),
+                ('opening1_victory_count', models.IntegerField(default=0)),
+                ('opening1_loss_count', models.IntegerField(default=0)),
+                ('opening2_victory_count', models.IntegerField(default=0)),
+                ('opening2_loss_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'civ_opening_elo_wins',
+                'unique_together': {('opening1_id', 'opening1_civilization', 'opening2_id', 'opening2_civilization', 'map_id', 'ladder_id', 'patch_number', 'elo')},
+                'indexes': [models.Index(fields=['patch_number', 'ladder_id', 'elo', 'map_id'], include=('opening1_id', 'opening1_civilization', 'opening2_id', 'opening2_civilization', 'opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count'), name='civ_opening_elo_wins_patch_idx')],
+            },
+        ),
+        migrations.RunPython(build_civ_opening_elo_wins, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0 on 2026-10-18 14:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    #btree indexes on the packed words cannot serve the hasbits/hasnobits lookups
+
+    dependencies = [
+        ('opening_stats', '0020_civopeningelowins'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='matches',
+            name='matches_patch_n_d5fc83_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='matches',
+            name='matches_patch_n_31c0f1_idx',
+        ),
+    ]
@@ -8,6 +8,27 @@
 import uuid
 from django.db import models
 
+#Bitmask lookups for the packed opening flag columns
+# field__hasbits=mask  -> every bit of mask is set
+# field__hasnobits=mask -> no bit of mask is set
+@models.BigIntegerField.register_lookup
+class HasBits(models.Lookup):
+    lookup_name = 'hasbits'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'({lhs} & {rhs}) = {rhs}', lhs_params + rhs_params + rhs_params
+
+@models.BigIntegerField.register_lookup
+class HasNoBits(models.Lookup):
+    lookup_name = 'hasnobits'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'({lhs} & {rhs}) = 0', lhs_params + rhs_params
+
 class AdvancedQueryResults(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     data = models.JSONField(null=False)
@@ -16,6 +37,8 @@ class AdvancedQueryQueue(models.Model):
     time = models.DateTimeField(auto_now_add=True)
     time_completed = models.DateTimeField(null=True)
     last_checkin = models.DateTimeField(auto_now_add=True)
+    #worker currently processing the row, reclaimable once last_checkin is older than the lease
+    claimed_by = models.CharField(max_length=255, null=True)
     stale = models.BooleanField(default=False, null=True)
     result = models.ForeignKey('AdvancedQueryResults', on_delete=models.CASCADE, null=True)
     query = models.TextField()
@@ -24,18 +47,25 @@ class AdvancedQueryQueue(models.Model):
         db_table = 'advanced_query_queue'
         indexes = [
           models.Index(fields=['stale','query']),
+          #queue position is a count over this prefix
+          models.Index(fields=['stale','result','id']),
           ]
 
 class MatchPlayerActions(models.Model):
-    match = models.ForeignKey('Matches', on_delete=models.CASCADE)
+    #no database constraint, PostgreSQL can't reference the partitioned matches table (see partitions.py)
+    match = models.ForeignKey('Matches', on_delete=models.CASCADE, db_constraint=False)
     player = models.ForeignKey('Players', on_delete=models.CASCADE)
     event_type = models.IntegerField()
     event_id = models.IntegerField()
     time = models.IntegerField()
     duration = models.IntegerField()
+    #the match's patch_number, the partition key
+    patch_number = models.IntegerField()
 
     class Meta:
+        #list partitioned on patch_number on PostgreSQL, see partitions.py
         db_table = 'match_player_actions'
+        #on PostgreSQL the constraint also has patch_number, which the match determines
         unique_together = [['match', 'player', 'event_type', 'event_id']]
 
 
@@ -46,7 +76,8 @@ class Matches(models.Model):
     patch_id = models.FloatField()
     ladder_id = models.IntegerField(blank=True, null=True)
     patch_number = models.IntegerField()
-    player1 = models.ForeignKey('Players', on_delete=models.CASCADE, related_name='%(class)s_player1')
+    #indexed by the (player, patch_number, average_elo) indexes in Meta
+    player1 = models.ForeignKey('Players', on_delete=models.CASCADE, related_name='%(class)s_player1', db_index=False)
     player1_opening_flag0 = models.BooleanField()
     player1_opening_flag1 = models.BooleanField()
     player1_opening_flag2 = models.BooleanField()
@@ -79,10 +110,12 @@ class Matches(models.Model):
     player1_opening_flag29 = models.BooleanField()
     player1_opening_flag30 = models.BooleanField()
     player1_opening_flag31 = models.BooleanField()
+    #flags 0-31 packed into one word, bit i is player1_opening_flag<i>
+    player1_opening_flags = models.BigIntegerField(default=0)
     player1_civilization = models.IntegerField()
     player1_victory = models.IntegerField()
     player1_parser_version = models.IntegerField()
-    player2 = models.ForeignKey('Players', on_delete=models.CASCADE, related_name='%(class)s_player2')
+    player2 = models.ForeignKey('Players', on_delete=models.CASCADE, related_name='%(class)s_player2', db_index=False)
     player2_opening_flag0 = models.BooleanField()
     player2_opening_flag1 = models.BooleanField()
     player2_opening_flag2 = models.BooleanField()
@@ -115,12 +148,23 @@ class Matches(models.Model):
     player2_opening_flag29 = models.BooleanField()
     player2_opening_flag30 = models.BooleanField()
     player2_opening_flag31 = models.BooleanField()
+    #flags 0-31 packed into one word, bit i is player2_opening_flag<i>
+    player2_opening_flags = models.BigIntegerField(default=0)
     player2_civilization = models.IntegerField()
     player2_victory = models.IntegerField()
     player2_parser_version = models.IntegerField()
 
     class Meta:
+        #list partitioned on patch_number on PostgreSQL, see partitions.py
         db_table = 'matches'
+        indexes = [
+          #advanced queries: equality/IN columns first, the elo range last but one
+          models.Index(fields=['patch_number', 'ladder_id', 'average_elo', 'map_id'], name='matches_patch_elo_idx'),
+          models.Index(fields=['player1', 'patch_number', 'average_elo'], name='matches_player1_patch_idx'),
+          models.Index(fields=['player2', 'patch_number', 'average_elo'], name='matches_player2_patch_idx'),
+          #LastUploadedMatch
+          models.Index(fields=['time'], name='matches_time_idx'),
+          ]
 
 
 class Openings(models.Model):
@@ -176,6 +220,11 @@ class CivEloWins(models.Model):
   class Meta:
     db_table = 'civ_elo_wins'
     unique_together = [['civilization', 'map_id', 'ladder_id', 'patch_number', 'elo']]
+    indexes = [
+      #covers the standard filters and the GROUP BY in aggregation.civ_rows
+      models.Index(fields=['patch_number', 'ladder_id', 'elo', 'map_id'], include=['civilization', 'victory_count', 'loss_count'],
+                   name='civ_elo_wins_patch_idx'),
+      ]
 
 class OpeningEloWins(models.Model):
   opening1_id = models.IntegerField()
@@ -192,6 +241,38 @@ class OpeningEloWins(models.Model):
   class Meta:
     db_table = 'opening_elo_wins'
     unique_together = [['opening1_id', 'opening2_id', 'map_id', 'ladder_id', 'patch_number', 'elo']]
+    indexes = [
+      #covers the standard filters and the GROUP BY in aggregation.opening_rows
+      models.Index(fields=['patch_number', 'ladder_id', 'elo', 'map_id'],
+                   include=['opening1_id', 'opening2_id', 'opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count'],
+                   name='opening_elo_wins_patch_idx'),
+      ]
+
+#opening_elo_wins with the civ of each side, for the civ filters of the opening endpoints
+class CivOpeningEloWins(models.Model):
+  opening1_id = models.IntegerField()
+  opening1_civilization = models.IntegerField()
+  opening2_id = models.IntegerField()
+  opening2_civilization = models.IntegerField()
+  map_id = models.IntegerField()
+  ladder_id = models.IntegerField()
+  patch_number = models.IntegerField()
+  elo = models.IntegerField()
+  opening1_victory_count = models.IntegerField(default=0)
+  opening1_loss_count = models.IntegerField(default=0)
+  opening2_victory_count = models.IntegerField(default=0)
+  opening2_loss_count = models.IntegerField(default=0)
+
+  class Meta:
+    db_table = 'civ_opening_elo_wins'
+    unique_together = [['opening1_id', 'opening1_civilization', 'opening2_id', 'opening2_civilization', 'map_id', 'ladder_id', 'patch_number', 'elo']]
+    indexes = [
+      #covers the standard filters, the civ conditions and the GROUP BY in aggregation.civ_opening_rows
+      models.Index(fields=['patch_number', 'ladder_id', 'elo', 'map_id'],
+                   include=['opening1_id', 'opening1_civilization', 'opening2_id', 'opening2_civilization', 'opening1_victory_count',
+                            'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count'],
+                   name='civ_opening_elo_wins_patch_idx'),
+      ]
 
 class OpeningEloTechs(models.Model):
   opening_id = models.IntegerField()
@@ -206,4 +287,30 @@ class OpeningEloTechs(models.Model):
   class Meta:
     db_table = 'opening_elo_techs'
     unique_together = [['opening_id', 'tech_id', 'map_id', 'ladder_id', 'patch_number', 'elo']]
+    indexes = [
+      #covers the standard filters, the tech_id IN list and the GROUP BY in aggregation.tech_rows
+      models.Index(fields=['patch_number', 'ladder_id', 'elo', 'map_id'], include=['opening_id', 'tech_id', 'average_time', 'count'],
+                   name='opening_elo_techs_patch_idx'),
+      ]
 
+#games per basic opening and elo, summed over maps, for MetaSnapshot
+class OpeningMetaSnapshot(models.Model):
+  patch_number = models.IntegerField()
+  ladder_id = models.IntegerField()
+  elo = models.IntegerField()
+  opening_id = models.IntegerField()
+  count = models.IntegerField(default=0)
+
+  class Meta:
+    db_table = 'opening_meta_snapshot'
+    unique_together = [['patch_number', 'ladder_id', 'elo', 'opening_id']]
+
+#match ids of each import, replayed by the in-memory match index (match_index.py)
+class MatchIndexLog(models.Model):
+  time = models.DateTimeField(auto_now_add=True)
+  match_ids = models.JSONField(default=list)
+  #matches were removed, indexes are rebuilt from the matches table
+  reset = models.BooleanField(default=False)
+
+  class Meta:
+    db_table = 'match_index_log'
@@ -0,0 +1,101 @@
+import collections
+import select
+import threading
+import time
+
+from django.db import connection, transaction
+
+# Wakeups for the advanced query queue. Producers call notify(channel,
+# payload) inside their transaction; on PostgreSQL this is a pg_notify, which
+# is delivered on commit to every process. Each process that waits runs one
+# forwarder thread holding a dedicated LISTEN connection and republishes what
+# it receives to in-process waiters, so any number of worker loops and
+# long-poll requests share a single connection. On other backends only
+# notifications raised in the same process are seen, so wait() falls back to
+# returning every LOCAL_POLL_SECONDS and callers re-check the database.
+
+QUEUE_CHANNEL = 'advanced_queue'    #payload: queue row id of a new request
+RESULT_CHANNEL = 'advanced_result'  #payload: queue row id that got its result
+CHANNELS = (QUEUE_CHANNEL, RESULT_CHANNEL)
+
+LOCAL_POLL_SECONDS = 0.5
+RECONNECT_SECONDS = 5
+EVENT_BUFFER = 1024
+
+_condition = threading.Condition()
+_events = collections.deque(maxlen=EVENT_BUFFER)
+_sequence = 0
+_forwarder = None
+
+def uses_postgres():
+  return connection.vendor == 'postgresql'
+
+def _publish(channel, payload):
+  global _sequence
+  with _condition:
+    _sequence += 1
+    _events.append((_sequence, channel, payload))
+    _condition.notify_all()
+
+def notify(channel, payload=''):
+  if uses_postgres():
+    with connection.cursor() as cursor:
+      cursor.execute('SELECT pg_notify(%s, %s)', [channel, str(payload)])
+  else:
+    transaction.on_commit(lambda: _publish(channel, str(payload)))
+
+class _Forwarder(threading.Thread):
+  def __init__(self):
+    super().__init__(daemon=True, name='notify-forwarder')
+    self.listening = threading.Event()
+
+  def run(self):
+    while True:
+      conn = None
+      try:
+        conn = connection.get_new_connection(connection.get_connection_params())
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+          for channel in CHANNELS:
+            cursor.execute(f'LISTEN {connection.ops.quote_name(channel)}')
+        self.listening.set()
+        while True:
+          select.select([conn], [], [], RECONNECT_SECONDS)
+          #poll every round so a dropped connection raises here
+          conn.poll()
+          while conn.notifies:
+            notification = conn.notifies.pop(0)
+            _publish(notification.channel, notification.payload)
+      except Exception as e:
+        self.listening.clear()
+        print(f'notify forwarder lost its connection: {e}')
+        if conn is not None:
+          conn.close()
+        time.sleep(RECONNECT_SECONDS)
+
+def _ensure_forwarder():
+  #started lazily so forked workers each get their own
+  global _forwarder
+  if not uses_postgres():
+    return False
+  with _condition:
+    if _forwarder is None or not _forwarder.is_alive():
+      _forwarder = _Forwarder()
+      _forwarder.start()
+  return _forwarder.listening.is_set()
+
+def position():
+  #take this before checking the database, then wait(position, ...) misses nothing in between
+  _ensure_forwarder()
+  with _condition:
+    return _sequence
+
+def wait(after, channels, timeout):
+  #returns (new position, [(channel, payload)...]) of events after `after`, empty on timeout
+  if not _ensure_forwarder():
+    timeout = min(timeout, LOCAL_POLL_SECONDS)
+  def pending():
+    return [(channel, payload) for sequence, channel, payload in _events if sequence > after and channel in channels]
+  with _condition:
+    events = _condition.wait_for(pending, timeout)
+    return _sequence, events
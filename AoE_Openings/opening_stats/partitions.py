@@ -0,0 +1,73 @@
+import re
+
+from django.db import connection, transaction
+from opening_stats.models import MatchIndexLog
+
+# List partitioning of matches and match_player_actions on patch_number
+# (PostgreSQL, set up by migration 0018): one partition per patch, named
+# <table>_p<patch_number>, plus <table>_default for anything else. Inserts
+# into the parent tables are routed by PostgreSQL; the importer calls
+# ensure() before its transaction so a new patch gets its own partitions
+# instead of filling the default one, which would block creating them later. Queries filtering
+# on patch_number only scan the partitions of those patches, and an old
+# patch can be detached or dropped without touching the others:
+#   python manage.py detach_patch 56 [--drop]
+# On other databases the tables are plain and this module does nothing.
+
+TABLES = ['matches', 'match_player_actions']
+RE_PARTITION = re.compile(r'_p(\d+)$')
+
+#patches known to have partitions, only grows on commit
+_known = set()
+
+def partition_name(table, patch_number):
+  return f'{table}_p{int(patch_number)}'
+
+def partitioned():
+  if connection.vendor != 'postgresql':
+    return False
+  with connection.cursor() as cursor:
+    cursor.execute('SELECT count(*) FROM pg_partitioned_table WHERE partrelid = %s::regclass', [TABLES[0]])
+    return cursor.fetchone()[0] > 0
+
+def existing():
+  #patch numbers with a partition of matches
+  with connection.cursor() as cursor:
+    cursor.execute(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = %s::regclass', [TABLES[0]])
+    names = [row[0] for row in cursor.fetchall()]
+  return {int(match.group(1)) for match in map(RE_PARTITION.search, names) if match}
+
+def ensure(patch_numbers):
+  #creates the partitions missing for patch_numbers, returns the new patches
+  #CREATE ... PARTITION OF locks the parent tables, call this before the import's transaction so the lock is only
+  #held for this short one instead of the whole batch
+  missing = set(patch_numbers) - _known
+  if not missing or not partitioned():
+    return []
+  known = existing()
+  _known.update(known)
+  created = sorted(missing - known)
+  qn = connection.ops.quote_name
+  with transaction.atomic(), connection.cursor() as cursor:
+    for patch_number in created:
+      for table in TABLES:
+        #IF NOT EXISTS, another import may have created it since existing()
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {qn(partition_name(table, patch_number))} PARTITION OF {qn(table)} '
+                       f'FOR VALUES IN ({int(patch_number)})')
+    transaction.on_commit(lambda: _known.update(created))
+  return created
+
+def detach(patch_number, drop=False):
+  #the patch's rows leave matches and match_player_actions, kept as standalone tables unless dropped
+  qn = connection.ops.quote_name
+  with transaction.atomic(), connection.cursor() as cursor:
+    for table in reversed(TABLES):
+      name = qn(partition_name(table, patch_number))
+      cursor.execute(f'ALTER TABLE {qn(table)} DETACH PARTITION {name}')
+      if drop:
+        cursor.execute(f'DROP TABLE {name}')
+    #match indexes rebuild without the patch, see match_index.py
+    MatchIndexLog.objects.create(reset=True)
+  _known.discard(patch_number)
@@ -0,0 +1,292 @@
+import functools
+
+from django.db.models import F, Case, When, Q, Sum, Count, FloatField
+from . import utils
+
+# Structured replacements for the eval'd query strings utils used to build,
+# checked against a plain Python version of them in tests.py. Everything
+# here returns Q objects or dicts of aggregate expressions that can be handed
+# straight to .filter() / .aggregate(), and is memoized on a normalized,
+# hashable version of the request parameters. Django copies expressions when
+# resolving them so the cached trees are safe to share between requests, but
+# callers must not mutate the returned dicts.
+
+FILTER_CACHE_SIZE = 1024
+AGGREGATE_CACHE_SIZE = 256
+
+def _normalize_ids(ids):
+  #-1 is the "no selection" sentinel used by parse_standard_query_parameters
+  if not ids or ids[0] == -1:
+    return ()
+  return tuple(sorted(set(ids)))
+
+#every request parameter build_filter reads
+FILTER_PARAMETERS = ('include_ladder_ids', 'include_patch_ids', 'include_map_ids', 'exclude_civ_mirrors', 'min_elo', 'max_elo')
+
+def normalize_filter_parameters(data):
+  return (_normalize_ids(data.get('include_ladder_ids')),
+          _normalize_ids(data.get('include_patch_ids')),
+          _normalize_ids(data.get('include_map_ids')),
+          data.get('exclude_civ_mirrors') == 'True',
+          int(data['min_elo']),
+          int(data['max_elo']))
+
+def build_filter(data, table_prefix="", elo_string="elo"):
+  return _build_filter(normalize_filter_parameters(data), table_prefix, elo_string)
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def _build_filter(key, table_prefix, elo_string):
+  ladder_ids, patch_ids, map_ids, exclude_civ_mirrors, min_elo, max_elo = key
+  q = Q(**{f'{table_prefix}{elo_string}__gte':min_elo, f'{table_prefix}{elo_string}__lte':max_elo})
+  if ladder_ids:
+    q &= Q(**{f'{table_prefix}ladder_id__in':ladder_ids})
+  if patch_ids:
+    q &= Q(**{f'{table_prefix}patch_number__in':patch_ids})
+  if map_ids:
+    q &= Q(**{f'{table_prefix}map_id__in':map_ids})
+  if exclude_civ_mirrors:
+    q &= ~Q(**{f'{table_prefix}player1_civilization':F(f'{table_prefix}player2_civilization')})
+  return q
+
+# Civ filters of the opening endpoints, read from civ_opening_elo_wins.
+# include_civ_ids and exclude_civ_ids decide which sides of a row count, the
+# player whose opening is reported; clamp_civ_ids keeps only games where both
+# players used one of its civs.
+CIV_PARAMETERS = ('include_civ_ids', 'exclude_civ_ids', 'clamp_civ_ids')
+
+def normalize_civ_parameters(data):
+  return tuple(_normalize_ids(data.get(key)) for key in CIV_PARAMETERS)
+
+def has_civ_filter(data):
+  return any(normalize_civ_parameters(data))
+
+def civ_filters(data):
+  #(rows, side1, side2): Q over rows, Q for each side counting, an empty Q is no condition
+  return _civ_filters(normalize_civ_parameters(data))
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def _civ_filters(key):
+  include_civ_ids, exclude_civ_ids, clamp_civ_ids = key
+  sides = []
+  for side in range(1,3):
+    q = Q()
+    if include_civ_ids:
+      q &= Q(**{f'opening{side}_civilization__in':include_civ_ids})
+    if exclude_civ_ids:
+      q &= ~Q(**{f'opening{side}_civilization__in':exclude_civ_ids})
+    sides.append(q)
+  rows = Q()
+  if clamp_civ_ids:
+    rows &= Q(opening1_civilization__in=clamp_civ_ids, opening2_civilization__in=clamp_civ_ids)
+  if sides[0]:
+    #rows with at least one side counting
+    rows &= sides[0] | sides[1]
+  return rows, sides[0], sides[1]
+
+def opening_strategies(opening_ids, default):
+  #If user defined openings, then use those, otherwise use the default range
+  if len(opening_ids) and opening_ids[0] != -1:
+    return tuple(opening_ids)
+  return tuple(range(default))
+
+@functools.lru_cache(maxsize=1)
+def civ_win_rate_aggregates():
+  #data only has games with a conclusion so only saves wins and its ezpz
+  aggregates = {'total':Sum("victory_count")}
+  for civ_id, name in utils.CIV_IDS_TO_NAMES.items():
+    aggregates[f'{name}_wins'] = Sum(Case(When(civilization=civ_id, then=F("victory_count"))))
+    aggregates[f'{name}_total'] = Sum(Case(When(civilization=civ_id, then=F("victory_count") + F("loss_count"))))
+  return aggregates
+
+def opening_win_rate_aggregates(opening_ids):
+  return _opening_win_rate_aggregates(opening_strategies(opening_ids, len(utils.OPENINGS)))
+
+@functools.lru_cache(maxsize=AGGREGATE_CACHE_SIZE)
+def _opening_win_rate_aggregates(strategies):
+  #Have to compare counts against basic strategies to enforce uniqueness
+  basic = len(utils.Basic_Strategies)
+  last_two = len(utils.OPENINGS) - 2
+  opening1_basic = Q(opening1_id__lt=basic) | Q(opening1_id__gte=last_two)
+  opening2_basic = Q(opening2_id__lt=basic) | Q(opening2_id__gte=last_two)
+  opening1_games = F("opening1_victory_count") + F("opening1_loss_count")
+  opening2_games = F("opening2_victory_count") + F("opening2_loss_count")
+  aggregates = {'total':Sum(Case(When(opening1_basic & opening2_basic, then=opening1_games)))}
+  for opening_id in strategies:
+    opening_name = utils.OPENINGS[opening_id][0]
+    mirror = Q(opening1_id=opening_id) & Q(opening2_id=opening_id)
+    as_opening1 = Q(opening1_id=opening_id) & opening2_basic
+    as_opening2 = Q(opening2_id=opening_id) & opening1_basic
+    #need to count each player twice In the case of mirrors
+    aggregates[f'{opening_name}_total'] = Sum(Case(
+        When(mirror, then=opening1_games + opening2_games),
+        When(as_opening1, then=opening1_games),
+        When(as_opening2, then=opening2_games)))
+    #ignore mirror wins
+    aggregates[f'{opening_name}_wins'] = Sum(Case(
+        When(mirror, then=0),
+        When(as_opening1, then=F("opening1_victory_count")),
+        When(as_opening2, then=F("opening2_victory_count"))))
+    aggregates[f'{opening_name}_losses'] = Sum(Case(
+        When(mirror, then=0),
+        When(as_opening1, then=F("opening1_loss_count")),
+        When(as_opening2, then=F("opening2_loss_count"))))
+  return aggregates
+
+def opening_matchup_aggregates(opening_ids):
+  return _opening_matchup_aggregates(opening_strategies(opening_ids, len(utils.Basic_Strategies)))
+
+@functools.lru_cache(maxsize=AGGREGATE_CACHE_SIZE)
+def _opening_matchup_aggregates(strategies):
+  basic = len(utils.Basic_Strategies)
+  aggregates = {'total':Sum(Case(When(Q(opening1_id__lt=basic) & Q(opening2_id__lt=basic),
+                                      then=F("opening1_victory_count") + F("opening1_loss_count"))))}
+  for i in strategies:
+    opening1_name = utils.OPENINGS[i][0]
+    for j in strategies[strategies.index(i):]:
+      opening2_name = utils.OPENINGS[j][0]
+      total_whens = [When(Q(opening1_id=i) & Q(opening2_id=j), then=F("opening1_victory_count") + F("opening1_loss_count"))]
+      wins_whens = [When(Q(opening1_id=i) & Q(opening2_id=j), then=F("opening1_victory_count"))]
+      if i != j:
+        total_whens.append(When(Q(opening2_id=i) & Q(opening1_id=j), then=F("opening2_victory_count") + F("opening2_loss_count")))
+        wins_whens.append(When(Q(opening2_id=i) & Q(opening1_id=j), then=F("opening2_victory_count")))
+      aggregates[f'{opening1_name}_vs_{opening2_name}_total'] = Sum(Case(*total_whens))
+      aggregates[f'{opening1_name}_vs_{opening2_name}_wins'] = Sum(Case(*wins_whens))
+  return aggregates
+
+@functools.lru_cache(maxsize=AGGREGATE_CACHE_SIZE)
+def meta_snapshot_aggregates(min_elo, max_elo, bucket_size):
+  basic = len(utils.Basic_Strategies)
+  aggregates = {}
+  for i in range(min_elo, max_elo, bucket_size):
+    for j in range(basic):
+      #have to double count mirrors
+      aggregates[f'{utils.Basic_Strategies[j][0]}_{i}'] = Sum(Case(
+          When(Q(elo=i) & Q(opening1_id=j) & Q(opening2_id=j),
+               then=F("opening1_victory_count") + F("opening1_loss_count") + F("opening2_victory_count") + F("opening2_loss_count")),
+          When(Q(elo=i) & Q(opening1_id=j) & Q(opening2_id__lt=basic),
+               then=F("opening1_victory_count") + F("opening1_loss_count")),
+          When(Q(elo=i) & Q(opening2_id=j) & Q(opening1_id__lt=basic),
+               then=F("opening1_victory_count") + F("opening1_loss_count"))))
+  return aggregates
+
+def opening_tech_filter(tech_ids):
+  return Q(tech_id__in=tuple(tech_ids))
+
+def opening_tech_aggregates(tech_ids_to_names, opening_ids):
+  return _opening_tech_aggregates(tuple(tech_ids_to_names.items()), opening_strategies(opening_ids, len(utils.Basic_Strategies)))
+
+@functools.lru_cache(maxsize=AGGREGATE_CACHE_SIZE)
+def _opening_tech_aggregates(tech_ids_to_names, strategies):
+  #Get a count of games
+  aggregates = {'total':Sum("count")}
+  for tech_id, tech_name in tech_ids_to_names:
+    for opening_id in strategies:
+      opening_name = utils.OPENINGS[opening_id][0]
+      aggregates[f'{opening_name}__{tech_name}__{tech_id}'] = \
+          Sum(Case(When(opening_id=opening_id, tech_id=tech_id, then=F("average_time")*F("count")))) / \
+          Sum(Case(When(opening_id=opening_id, tech_id=tech_id, then="count")), output_field=FloatField())
+  return aggregates
+
+def player_opening_q(player, opening_id):
+  #any inclusion fully set and no exclusion bit set on the packed flags
+  inclusions, exclusion_mask = utils.OPENING_MASKS[opening_id]
+  field = f'player{player}_opening_flags'
+  q = Q()
+  for inclusion in inclusions:
+    q |= Q(**{f'{field}__hasbits':inclusion})
+  return q & Q(**{f'{field}__hasnobits':exclusion_mask})
+
+def player_q(player, opening_ids, civ_ids, profile_id):
+  #-1 means no selection, returns None if nothing is selected for the player
+  opening_ids = [] if opening_ids == [-1] else opening_ids
+  civ_ids = [] if civ_ids == [-1] else civ_ids
+  if not len(opening_ids) and not len(civ_ids) and not profile_id:
+    return None
+  q = Q()
+  if profile_id:
+    q &= Q(**{f'player{player}_id':profile_id})
+  for opening_id in opening_ids:
+    q &= player_opening_q(player, opening_id)
+  if civ_ids:
+    q &= Q(**{f'player{player}_civilization__in':civ_ids})
+  return q
+
+def _and(*qs):
+  qs = [q for q in qs if q is not None]
+  return functools.reduce(lambda a, b: a & b, qs) if qs else None
+
+def _single(data, key):
+  #enforce that all lists are length 1! - cant just use the validator, need to enforce
+  return data.get(key, [])[:1]
+
+def advanced_matchup_rows(data):
+  #yields (name, suffix, left openings, left civs, right openings, right civs) per matchup row, [] for no selection
+  profile_id = int(data.get('left_player_id', 0))
+  for i in range(0, utils.ADVANCED_QUERY_COUNT*2, 2):
+    keys = [f'include_opening_ids_{i}', f'include_civ_ids_{i}', f'include_opening_ids_{i+1}', f'include_civ_ids_{i+1}']
+    #Skip row if it doesnt have any data
+    if not any(key in data for key in keys):
+      continue
+    left_openings, left_civs, right_openings, right_civs = [_single(data, key) for key in keys]
+    if left_openings == left_civs == right_openings == right_civs == [-1]:
+      #if neither has any selections, skip
+      continue
+    left_civs = [] if left_civs == [-1] else left_civs
+    left_openings = [] if left_openings == [-1] else left_openings
+    right_civs = [] if right_civs == [-1] else right_civs
+    right_openings = [] if right_openings == [-1] else right_openings
+    #nothing selected for either player
+    if not (left_openings or left_civs or profile_id or right_openings or right_civs):
+      continue
+    name = utils.civ_and_opening_ids_to_string(left_civs, left_openings) + '__vs__' + \
+           utils.civ_and_opening_ids_to_string(right_civs, right_openings)
+    yield name, f'___{i}', left_openings, left_civs, right_openings, right_civs
+
+def advanced_matchups(data):
+  #yields (name, suffix, left as player 1 condition, left as player 2 condition) per matchup row
+  profile_id = int(data.get('left_player_id', 0))
+  exclude_opening_mirrors = data.get('exclude_opening_mirrors') == 'True'
+  for name, suffix, left_openings, left_civs, right_openings, right_civs in advanced_matchup_rows(data):
+    left = {player:player_q(player, left_openings, left_civs, profile_id) for player in range(1,3)}
+    right = {player:player_q(player, right_openings, right_civs, 0) for player in range(1,3)}
+    # Remove opening mirrors
+    if exclude_opening_mirrors:
+      for player in range(1,3):
+        left_opening = player_q(player, left_openings, [], 0)
+        if left_opening is not None:
+          right[player] = _and(right[player], ~left_opening)
+    yield name, suffix, _and(left[1], right[2]), _and(left[2], right[1])
+
+def advanced_matchup_aggregates(name, suffix, left_first, left_second):
+  return {
+    f'{name}_total_{suffix}':Count(Case(When(left_first, then=1), When(left_second, then=1))),
+    f'{name}_wins_{suffix}':Count(Case(When(left_first & Q(player1_victory=True), then=1),
+                                       When(left_second & Q(player2_victory=True), then=1))),
+    f'{name}_losses_{suffix}':Count(Case(When(left_first & Q(player1_victory=False), then=1),
+                                         When(left_second & Q(player2_victory=False), then=1))),
+  }
+
+def advanced_aggregates(data):
+  aggregates = {}
+  for matchup in advanced_matchups(data):
+    aggregates.update(advanced_matchup_aggregates(*matchup))
+  return aggregates
+
+def cache_info():
+  return {
+    'filter':_build_filter.cache_info(),
+    'civ_win_rates':civ_win_rate_aggregates.cache_info(),
+    'opening_win_rates':_opening_win_rate_aggregates.cache_info(),
+    'opening_matchups':_opening_matchup_aggregates.cache_info(),
+    'meta_snapshot':meta_snapshot_aggregates.cache_info(),
+    'opening_techs':_opening_tech_aggregates.cache_info(),
+  }
+
+def cache_clear():
+  _build_filter.cache_clear()
+  _civ_filters.cache_clear()
+  civ_win_rate_aggregates.cache_clear()
+  _opening_win_rate_aggregates.cache_clear()
+  _opening_matchup_aggregates.cache_clear()
+  meta_snapshot_aggregates.cache_clear()
+  _opening_tech_aggregates.cache_clear()
@@ -0,0 +1,145 @@
+import gc
+import multiprocessing
+import time
+
+from django import db
+from django.db.models import Max, Min
+from opening_stats.models import Matches, MatchPlayerActions, CivEloWins, OpeningEloWins, CivOpeningEloWins, OpeningEloTechs
+from . import utils, rollups, reference
+
+# Parallel full rebuild of the rollup tables. Matches are split per patch,
+# so each task reads a single table partition on PostgreSQL (partitions.py),
+# and each patch into id ranges; each range is aggregated in a single pass
+# (build_partition) by a worker process into partial data dicts, the same
+# dicts the build_* functions in utils fill, and the parent merges them
+# (counts are summed, average tech times weighted by their count) and loads
+# the result with rollups.replace_table. Partitions only read, so a worker
+# that dies only loses its own range.
+#   python manage.py rebuild_rollups --workers 8
+
+def id_ranges(partitions, patch_number=None):
+  #[(first, last)...] inclusive ranges covering every match id, of one patch if given
+  matches = Matches.objects.all() if patch_number is None else Matches.objects.filter(patch_number=patch_number)
+  bounds = matches.aggregate(first=Min('id'), last=Max('id'))
+  if bounds['first'] is None:
+    return []
+  first, last = bounds['first'], bounds['last']
+  step = max(1, -(-(last - first + 1) // partitions))
+  return [(start, min(start + step - 1, last)) for start in range(first, last + 1, step)]
+
+def build_partition(patch_number, id_range, techs):
+  #returns (civs, openings, civ openings, techs) data dicts for matches of patch_number with ids in id_range
+  first, last = id_range
+  civs_data_dict, openings_data_dict, civ_openings_data_dict, techs_data_dict = {}, {}, {}, {}
+  # One pass: matches in id order merge joined with their tech actions in
+  # match id order, each table read once and each match classified once for
+  # all four rollups
+  matches = Matches.objects\
+      .filter(patch_number=patch_number, id__gte=first, id__lte=last)\
+      .order_by('id')\
+      .iterator()
+  actions = MatchPlayerActions.objects\
+      .filter(patch_number=patch_number, match_id__gte=first, match_id__lte=last, event_type=3, event_id__in=techs)\
+      .order_by('match_id', 'id')\
+      .only('match_id', 'player_id', 'event_id', 'time')\
+      .iterator()
+  action = next(actions, None)
+  count = 0
+  for match in matches:
+    if count % 5000 == 0:
+      gc.collect()
+    count += 1
+    if type(match.average_elo) == str:
+      #at least one element has a string elo???? throw it away
+      continue
+    record = utils.match_record(match)
+    utils.build_civ_elo_win_for_match(match, civs_data_dict)
+    utils.build_opening_elo_win_for_match(match, openings_data_dict, record.openings)
+    utils.build_civ_opening_elo_win_for_match(match, civ_openings_data_dict, record.openings)
+    #actions of skipped matches
+    while action is not None and action.match_id < match.id:
+      action = next(actions, None)
+    while action is not None and action.match_id == match.id:
+      utils.build_opening_elo_techs_for_record_and_action(record, action, techs_data_dict)
+      action = next(actions, None)
+  return civs_data_dict, openings_data_dict, civ_openings_data_dict, techs_data_dict
+
+def _worker_init():
+  #forked children must not use the parent's db connections
+  db.connections.close_all()
+
+def _build_partition_in_worker(args):
+  try:
+    return build_partition(*args)
+  finally:
+    db.connections.close_all()
+
+def merge_counts(total, partial):
+  for key, value in partial.items():
+    if key not in total:
+      total[key] = value
+    else:
+      for column, count in value.items():
+        total[key][column] += count
+
+def merge_techs(total, partial):
+  for key, value in partial.items():
+    if key not in total:
+      total[key] = value
+    else:
+      merged = total[key]
+      count = merged['research_count'] + value['research_count']
+      merged['average_time'] = (merged['average_time'] * merged['research_count'] + value['average_time'] * value['research_count']) / count
+      merged['research_count'] = count
+
+def load_civ_elo_wins(data_dict):
+  rollups.replace_table(CivEloWins, rollups.CIV_ELO_WINS_KEYS + ['victory_count', 'loss_count'],
+                        (k + (v['victory_count'], v['loss_count']) for k, v in data_dict.items()))
+
+def load_opening_elo_wins(data_dict):
+  value_columns = ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']
+  rollups.replace_table(OpeningEloWins, rollups.OPENING_ELO_WINS_KEYS + value_columns,
+                        (k + tuple(v[column] for column in value_columns) for k, v in data_dict.items()))
+
+def load_civ_opening_elo_wins(data_dict):
+  value_columns = ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']
+  rollups.replace_table(CivOpeningEloWins, rollups.CIV_OPENING_ELO_WINS_KEYS + value_columns,
+                        (k + tuple(v[column] for column in value_columns) for k, v in data_dict.items()))
+
+def load_opening_elo_techs(data_dict):
+  rollups.replace_table(OpeningEloTechs, rollups.OPENING_ELO_TECHS_KEYS + ['average_time', 'count'],
+                        (k + (v['average_time'], v['research_count']) for k, v in data_dict.items()))
+
+def rebuild_rollups(workers, partitions=None, log=print):
+  start = time.time()
+  patch_numbers = list(Matches.objects.order_by('patch_number').values_list('patch_number', flat=True).distinct())
+  per_patch = max(1, (partitions or workers * 4) // max(1, len(patch_numbers)))
+  techs = sorted(reference.get().techs_by_id)
+  tasks = [(patch_number, id_range, techs) for patch_number in patch_numbers for id_range in id_ranges(per_patch, patch_number)]
+  civs_data_dict, openings_data_dict, civ_openings_data_dict, techs_data_dict = {}, {}, {}, {}
+  def merge(partial):
+    merge_counts(civs_data_dict, partial[0])
+    merge_counts(openings_data_dict, partial[1])
+    merge_counts(civ_openings_data_dict, partial[2])
+    merge_techs(techs_data_dict, partial[3])
+
+  if workers == 1:
+    for task in tasks:
+      merge(build_partition(*task))
+  else:
+    db.connections.close_all()
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers, initializer=_worker_init) as pool:
+      #merged as they finish, only the merged dicts and a few partials are in memory at once
+      for done, partial in enumerate(pool.imap_unordered(_build_partition_in_worker, tasks), 1):
+        merge(partial)
+        log(f'({done} / {len(tasks)}) partitions')
+  log(f'aggregated {len(tasks)} partitions in {time.time() - start:.1f}s')
+
+  load_civ_elo_wins(civs_data_dict)
+  load_opening_elo_wins(openings_data_dict)
+  load_civ_opening_elo_wins(civ_openings_data_dict)
+  load_opening_elo_techs(techs_data_dict)
+  rollups.rebuild_opening_meta_snapshot(len(utils.Basic_Strategies))
+  log(f'rebuild_rollups - elapsed time {time.time() - start:.1f}s')
+  return len(civs_data_dict), len(openings_data_dict), len(civ_openings_data_dict), len(techs_data_dict)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from opening_stats.models import Techs, Maps, Ladders, Patches
+from . import versions
+
+# In-memory copy of the small constant tables (patches, ladders, maps, techs).
+# Each worker process loads them once and serves every request from memory.
+# A version token (versions.py) changes when ImportMatches inserts new
+# patches; workers compare against it at most every CHECK_SECONDS and reload
+# when it moved, and reload after MAX_AGE_SECONDS
+# regardless to pick up changes made through fixtures or the admin.
+
+VERSION_KEY = 'opening_stats:reference_version'
+CHECK_SECONDS = 10
+MAX_AGE_SECONDS = 3600
+
+class Registry:
+  def __init__(self, version):
+    self.version = version
+    self.loaded_at = time.monotonic()
+    self.patches = list(Patches.objects.all().values().order_by('-id'))
+    self.patch_ids = frozenset(patch['id'] for patch in self.patches)
+    self.latest_patch_id = self.patches[0]['id'] if self.patches else None
+    self.ladders = list(Ladders.objects.order_by('name').values())
+    self.maps = list(Maps.objects.order_by('name').values())
+    self.techs = list(Techs.objects.order_by('name').values())
+    self.techs_by_id = {tech['id']:tech for tech in self.techs}
+
+_lock = threading.Lock()
+_registry = None
+_checked_at = 0
+
+def get():
+  global _registry, _checked_at
+  now = time.monotonic()
+  registry = _registry
+  if registry is not None and now - _checked_at < CHECK_SECONDS:
+    return registry
+  with _lock:
+    _checked_at = now
+    version = versions.get(VERSION_KEY)
+    if (_registry is None
+        or _registry.version != version
+        or now - _registry.loaded_at > MAX_AGE_SECONDS):
+      _registry = Registry(version)
+    return _registry
+
+def invalidate():
+  #reload here right away, other workers on their next version check
+  global _registry
+  versions.changed(VERSION_KEY)
+  with _lock:
+    _registry = None
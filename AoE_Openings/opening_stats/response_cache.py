@@ -0,0 +1,49 @@
+import collections
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_response_headers
+from . import utils
+
+# View level response cache for the GET endpoints, replacing the per-site
+# cache middleware. Entries are keyed on the endpoint name and a hash of the
+# canonical request parameters (utils.canonical_query_parameters) limited to
+# the ones the endpoint reads, rather than the raw URL, so parameter order,
+# duplicates, defaults and ignored parameters do not split entries. The
+# rendered JSON is cached and responses keep the Expires/Cache-Control
+# headers the middleware set.
+
+KEY_PREFIX = 'opening_stats:response'
+
+_stats = collections.Counter()
+
+def cache_key(name, data, keys=None):
+  return f'{KEY_PREFIX}:{name}:{utils.query_parameters_hash(utils.canonical_query_parameters(data, keys))}'
+
+def cached_response(name, data, build_content, keys=None, timeout=None):
+  #keys: the parameters build_content depends on, all of data if None
+  timeout = settings.CACHE_MIDDLEWARE_SECONDS if timeout is None else timeout
+  key = cache_key(name, data, keys)
+  content = cache.get(key)
+  if content is None:
+    _stats[f'{name}_misses'] += 1
+    content = build_content()
+    cache.set(key, content, timeout)
+  else:
+    _stats[f'{name}_hits'] += 1
+  response = HttpResponse(content)
+  patch_response_headers(response, timeout)
+  return response
+
+def stats():
+  endpoints = {}
+  for counter, count in _stats.items():
+    name, kind = counter.rsplit('_', 1)
+    endpoints.setdefault(name, {'hits':0, 'misses':0})[kind] = count
+  for endpoint in endpoints.values():
+    endpoint['hit_rate'] = endpoint['hits'] / (endpoint['hits'] + endpoint['misses'])
+  result = {'endpoints':endpoints}
+  if hasattr(cache, 'stats'):
+    result['cache'] = cache.stats()
+  return result
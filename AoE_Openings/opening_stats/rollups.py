@@ -0,0 +1,208 @@
+import re
+
+from django.db import connection, transaction, OperationalError
+from django.db.models import F, Sum
+from opening_stats.models import CivEloWins, OpeningEloWins, CivOpeningEloWins, OpeningEloTechs, OpeningMetaSnapshot
+from . import versions
+
+# Set based maintenance of the rollup tables. The build_*_for_match helpers in
+# utils produce dicts keyed on the unique_together columns of each table;
+# these functions apply a whole dict of deltas with multi-row
+# INSERT ... ON CONFLICT DO UPDATE statements instead of one UPDATE per key.
+# The statement is supported by both PostgreSQL and SQLite (>= 3.24).
+
+UPSERT_BATCH_SIZE = 1000
+DATA_VERSION_KEY = 'opening_stats:data_version'
+
+CIV_ELO_WINS_KEYS = ['civilization', 'map_id', 'ladder_id', 'patch_number', 'elo']
+OPENING_ELO_WINS_KEYS = ['opening1_id', 'opening2_id', 'map_id', 'ladder_id', 'patch_number', 'elo']
+CIV_OPENING_ELO_WINS_KEYS = ['opening1_id', 'opening1_civilization', 'opening2_id', 'opening2_civilization', 'map_id', 'ladder_id', 'patch_number', 'elo']
+OPENING_ELO_TECHS_KEYS = ['opening_id', 'tech_id', 'map_id', 'ladder_id', 'patch_number', 'elo']
+OPENING_META_SNAPSHOT_KEYS = ['patch_number', 'ladder_id', 'elo', 'opening_id']
+
+def data_changed():
+  #whenever the rollup tables change, in-memory copies (cubes) reload on it
+  versions.changed(DATA_VERSION_KEY)
+
+def _upsert(model, key_columns, value_columns, update_expressions, rows):
+  qn = connection.ops.quote_name
+  table = qn(model._meta.db_table)
+  columns = key_columns + value_columns
+  fields = [model._meta.get_field(column) for column in columns]
+  batch_size = max(1, min(UPSERT_BATCH_SIZE, connection.ops.bulk_batch_size(fields, rows)))
+  row_sql = '(' + ', '.join(['%s'] * len(columns)) + ')'
+  names = {column:qn(column) for column in columns}
+  updates = ', '.join(f'{qn(column)} = {expression.format(table=table, column=qn(column), **names)}'
+                      for column, expression in update_expressions.items())
+  #sort on the key so concurrent imports lock rows in the same order
+  rows = sorted(rows)
+  with transaction.atomic(), connection.cursor() as cursor:
+    for start in range(0, len(rows), batch_size):
+      batch = rows[start:start + batch_size]
+      cursor.execute(
+          f'INSERT INTO {table} ({", ".join(qn(column) for column in columns)}) '
+          f'VALUES {", ".join([row_sql] * len(batch))} '
+          f'ON CONFLICT ({", ".join(qn(column) for column in key_columns)}) DO UPDATE SET {updates}',
+          [value for row in batch for value in row])
+  return len(rows)
+
+ADD_EXCLUDED = '{table}.{column} + EXCLUDED.{column}'
+
+def upsert_civ_elo_wins(data_dict):
+  rows = [k + (v['victory_count'], v['loss_count']) for k, v in data_dict.items()]
+  return _upsert(CivEloWins, CIV_ELO_WINS_KEYS, ['victory_count', 'loss_count'],
+                 {'victory_count':ADD_EXCLUDED, 'loss_count':ADD_EXCLUDED}, rows)
+
+def upsert_opening_elo_wins(data_dict):
+  value_columns = ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']
+  rows = [k + tuple(v[column] for column in value_columns) for k, v in data_dict.items()]
+  return _upsert(OpeningEloWins, OPENING_ELO_WINS_KEYS, value_columns,
+                 {column:ADD_EXCLUDED for column in value_columns}, rows)
+
+def upsert_civ_opening_elo_wins(data_dict):
+  value_columns = ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']
+  rows = [k + tuple(v[column] for column in value_columns) for k, v in data_dict.items()]
+  return _upsert(CivOpeningEloWins, CIV_OPENING_ELO_WINS_KEYS, value_columns,
+                 {column:ADD_EXCLUDED for column in value_columns}, rows)
+
+def upsert_opening_elo_techs(data_dict):
+  rows = [k + (v['average_time'], v['research_count']) for k, v in data_dict.items()]
+  #weighted merge of the averages, SET expressions all see the pre-update row
+  return _upsert(OpeningEloTechs, OPENING_ELO_TECHS_KEYS, ['average_time', 'count'], {
+      'average_time':'({table}.{column} * {table}.{count} + EXCLUDED.{column} * EXCLUDED.{count}) / ({table}.{count} + EXCLUDED.{count})',
+      'count':ADD_EXCLUDED,
+    }, rows)
+
+# opening_meta_snapshot is a cube over opening_elo_wins: games each basic
+# opening played against another basic opening per (patch, ladder, elo),
+# summed over maps, mirrors counted for both sides. It is derived from the
+# same deltas as opening_elo_wins, so imports keep both in step.
+def meta_snapshot_deltas(rows, basic):
+  #rows of (opening1_id, opening2_id, ladder_id, patch_number, elo, games), basic = len(utils.Basic_Strategies)
+  deltas = {}
+  for opening1, opening2, ladder_id, patch_number, elo, games in rows:
+    #opening1 <= opening2, so this leaves basic vs basic only
+    if opening2 >= basic or not games:
+      continue
+    for opening_id in (opening1, opening2):
+      key = (patch_number, ladder_id, elo, opening_id)
+      deltas[key] = deltas.get(key, 0) + games
+  return deltas
+
+def upsert_opening_meta_snapshot(opening_elo_wins_dict, basic):
+  rows = ((k[0], k[1], k[3], k[4], k[5], v['opening1_victory_count'] + v['opening1_loss_count'])
+          for k, v in opening_elo_wins_dict.items())
+  deltas = meta_snapshot_deltas(rows, basic)
+  return _upsert(OpeningMetaSnapshot, OPENING_META_SNAPSHOT_KEYS, ['count'], {'count':ADD_EXCLUDED},
+                 [k + (v,) for k, v in deltas.items()])
+
+def rebuild_opening_meta_snapshot(basic):
+  rows = OpeningEloWins.objects\
+      .values('opening1_id', 'opening2_id', 'ladder_id', 'patch_number', 'elo')\
+      .annotate(games=Sum(F('opening1_victory_count') + F('opening1_loss_count')))\
+      .order_by()\
+      .values_list('opening1_id', 'opening2_id', 'ladder_id', 'patch_number', 'elo', 'games')
+  deltas = meta_snapshot_deltas(rows.iterator(), basic)
+  replace_table(OpeningMetaSnapshot, OPENING_META_SNAPSHOT_KEYS + ['count'], (k + (v,) for k, v in deltas.items()))
+  return len(deltas)
+
+# Full rebuilds replace a whole table. On PostgreSQL the rows are COPYed into
+# a shadow table with the same columns and defaults, the primary key, unique
+# constraints and indexes are created after the load, and the shadow is
+# renamed over the live table in one short transaction. Readers see the old
+# rows until the swap commits and the new ones after, never an empty or
+# partial table, and the old table is dropped instead of leaving dead rows.
+# Constraints and indexes get their original names back after the swap.
+# Elsewhere the table is emptied and bulk inserted in one transaction.
+
+LOAD_BATCH_SIZE = 10000
+#the rename waits for queries still reading the old table, give up and retry instead of queueing readers behind it
+SWAP_LOCK_TIMEOUT = '2s'
+SWAP_ATTEMPTS = 10
+
+def replace_table(model, columns, rows):
+  #rows: tuples of values in columns order, id is left to the table default
+  if connection.vendor == 'postgresql':
+    _swap_table(model, columns, rows)
+  else:
+    with transaction.atomic():
+      model.objects.all().delete()
+      model.objects.bulk_create((model(**dict(zip(columns, row))) for row in rows), batch_size=LOAD_BATCH_SIZE)
+  data_changed()
+
+class _CopyStream:
+  #file-like view of rows in COPY text format, read by psycopg2's copy_expert
+  def __init__(self, rows):
+    self._lines = ('\t'.join(r'\N' if value is None else str(value) for value in row) + '\n' for row in rows)
+    self._buffer = ''
+
+  def read(self, size=-1):
+    chunks = [self._buffer]
+    length = len(self._buffer)
+    while size < 0 or length < size:
+      line = next(self._lines, None)
+      if line is None:
+        break
+      chunks.append(line)
+      length += len(line)
+    data = ''.join(chunks)
+    if size < 0:
+      self._buffer = ''
+      return data
+    self._buffer = data[size:]
+    return data[:size]
+
+CREATE_INDEX = re.compile(r'^CREATE (UNIQUE )?INDEX \S+ ON (?:ONLY )?\S+ (.*)$')
+
+def _swap_table(model, columns, rows):
+  qn = connection.ops.quote_name
+  table = model._meta.db_table
+  shadow = f'{table}_shadow'
+  old = f'{table}_old'
+  with connection.cursor() as cursor:
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype IN ('p', 'u') ORDER BY conname", [table])
+    constraints = cursor.fetchall()
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes "
+        "WHERE schemaname = current_schema() AND tablename = %s "
+        "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass) ORDER BY indexname", [table, table])
+    indexes = cursor.fetchall()
+
+    #load without indexes, then build them once
+    cursor.execute(f'DROP TABLE IF EXISTS {qn(shadow)}')
+    cursor.execute(f'CREATE TABLE {qn(shadow)} (LIKE {qn(table)} INCLUDING DEFAULTS INCLUDING IDENTITY)')
+    cursor.copy_expert(f'COPY {qn(shadow)} ({", ".join(qn(column) for column in columns)}) FROM STDIN', _CopyStream(rows))
+    renames = []
+    for i, (name, definition) in enumerate(constraints):
+      temporary = f'{shadow}_c{i}'
+      cursor.execute(f'ALTER TABLE {qn(shadow)} ADD CONSTRAINT {qn(temporary)} {definition}')
+      renames.append(f'ALTER TABLE {qn(table)} RENAME CONSTRAINT {qn(temporary)} TO {qn(name)}')
+    for i, (name, definition) in enumerate(indexes):
+      unique, rest = CREATE_INDEX.match(definition).groups()
+      temporary = f'{shadow}_i{i}'
+      cursor.execute(f'CREATE {unique or ""}INDEX {qn(temporary)} ON {qn(shadow)} {rest}')
+      renames.append(f'ALTER INDEX {qn(temporary)} RENAME TO {qn(name)}')
+    #VACUUM also sets the visibility map, without it the covering indexes can't give index only scans
+    cursor.execute(f'{"ANALYZE" if connection.in_atomic_block else "VACUUM ANALYZE"} {qn(shadow)}')
+
+  for attempt in range(SWAP_ATTEMPTS):
+    try:
+      with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'")
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        sequence = cursor.fetchone()[0]
+        cursor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(old)}')
+        cursor.execute(f'ALTER TABLE {qn(shadow)} RENAME TO {qn(table)}')
+        #a serial id default still points at the old table's sequence, keep it alive
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        if sequence is not None and cursor.fetchone()[0] is None:
+          cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {qn(table)}.id')
+        cursor.execute(f'DROP TABLE {qn(old)}')
+        for rename in renames:
+          cursor.execute(rename)
+      return
+    except OperationalError:
+      if attempt == SWAP_ATTEMPTS - 1:
+        raise
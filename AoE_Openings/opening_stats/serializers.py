@@ -1,5 +1,6 @@
 from opening_stats.models import Players, Openings, Matches, MatchPlayerActions, Patches
 from rest_framework import serializers
+from . import utils, validation
 
 class PlayersSerializer(serializers.ModelSerializer):
   id = serializers.IntegerField()
@@ -23,11 +24,20 @@ class MatchesSerializer(serializers.ModelSerializer):
   class Meta:
     model = Matches
     fields = "__all__"
+    #uploaders may send the 32 booleans per player, the packed word, or both
+    extra_kwargs = {
+      **{name:{'required':False} for player in range(1,3) for name in utils.opening_flag_field_names(player)},
+      **{f'player{player}_opening_flags':{'min_value':0, 'max_value':2**utils.OPENING_FLAG_COUNT - 1} for player in range(1,3)},
+    }
+
+  def validate(self, attrs):
+    return validation.resolve_opening_flags(attrs)
 
 class MatchPlayerActionsSerializer(serializers.ModelSerializer):
   class Meta:
     model = MatchPlayerActions
-    fields = "__all__"
+    #copied from the match on import
+    exclude = ['patch_number']
 
 class MatchInputSerializer(serializers.Serializer):
   matches = MatchesSerializer(many=True)
@@ -1,3 +1,1339 @@
-from django.test import TestCase
+import contextlib
+import datetime
+import importlib
+import io
+import json
+import pickle
+import random
+import threading
+import time
+import unittest
+import uuid
+from unittest import mock
 
-# Create your tests here.
+import django.utils.timezone
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, transaction, OperationalError
+from django.db.models import F, Sum
+from django.test import TestCase, TransactionTestCase, SimpleTestCase, RequestFactory, override_settings
+from django.urls import reverse
+from rest_framework.exceptions import ValidationError, ParseError
+from rest_framework_api_key.models import APIKey
+from opening_stats.models import Matches, MatchPlayerActions, Players, Patches, Techs, CivEloWins, OpeningEloWins, CivOpeningEloWins, OpeningEloTechs, OpeningMetaSnapshot, AdvancedQueryQueue, AdvancedQueryResults, MatchIndexLog
+from opening_stats.serializers import MatchesSerializer, MatchPlayerActionsSerializer
+from .AoE_Rec_Opening_Analysis.aoe_replay_stats import OpeningType
+from .cache_backends import TieredCache
+from . import utils, cubes, aggregation, rollups, versions, validation, importer, reference, query_builder, advanced_queue, notify, views, partitions, response_cache, rebuild, match_index
+
+#flag words classified as exactly one basic opening
+BASIC_WORDS = [OpeningType.PremillDrush.value, OpeningType.PostmillDrush.value,
+               OpeningType.Maa.value, OpeningType.FeudalScoutOpening.value]
+#followups, several openings per player and unknown too
+WORDS = BASIC_WORDS + [0, OpeningType.PremillDrushFC.value, OpeningType.PremillDrushArchers.value,
+                       OpeningType.PostmillDrushSkirms.value, OpeningType.MaaArchers.value,
+                       OpeningType.Maa.value | OpeningType.PremillDrush.value, OpeningType.ScoutsArchers.value,
+                       OpeningType.FeudalArcherOpening.value, OpeningType.FastCastle.value,
+                       OpeningType.FeudalScoutOpening.value | OpeningType.FeudalScoutFollowup.value]
+
+def match_fields(match_id, rng, words=BASIC_WORDS, civs=range(1, 5), patches=(1,)):
+  fields = {'id':match_id, 'average_elo':rng.randrange(500, 2500), 'map_id':rng.choice([9, 29]), 'time':None,
+            'patch_id':1.0, 'ladder_id':rng.choice([3, 4]), 'patch_number':rng.choice(patches)}
+  player1_victory = rng.randint(0, 1)
+  for player in range(1, 3):
+    word = rng.choice(words)
+    for i, flag in enumerate(utils.unpack_opening_flags(word)):
+      fields[f'player{player}_opening_flag{i}'] = flag
+    fields[f'player{player}_opening_flags'] = word
+    fields[f'player{player}_id'] = player
+    fields[f'player{player}_civilization'] = rng.choice(civs)
+    fields[f'player{player}_victory'] = player1_victory if player == 1 else 1 - player1_victory
+    fields[f'player{player}_parser_version'] = 1
+  return fields
+
+def match_payload(fields):
+  #as uploaded, foreign keys by field name
+  return {name[:-len('_id')] if name in ('player1_id', 'player2_id') else name:value for name, value in fields.items()}
+
+def query_data(**kwargs):
+  data = {'min_elo':0, 'max_elo':9000, 'include_ladder_ids':[-1], 'include_patch_ids':[-1],
+          'include_map_ids':[-1], 'include_civ_ids':[-1], 'exclude_civ_ids':[-1],
+          'clamp_civ_ids':[-1], 'include_opening_ids':[-1]}
+  data.update(kwargs)
+  return data
+
+PLAYER_IDS = range(1, 9)
+TECH_IDS = (101, 102)
+
+def seed_matches(count, seed=1, words=WORDS, civs=range(1, 7), patches=(1, 2), first_id=1):
+  #count matches between PLAYER_IDS with tech actions, returns the fields of each
+  rng = random.Random(seed)
+  Players.objects.bulk_create([Players(id=player_id, name=f'p{player_id}') for player_id in PLAYER_IDS], ignore_conflicts=True)
+  Patches.objects.bulk_create([Patches(id=patch_number) for patch_number in patches], ignore_conflicts=True)
+  Techs.objects.bulk_create([Techs(id=101, name='Feudal Age', duration=130), Techs(id=102, name='Castle Age', duration=160)],
+                            ignore_conflicts=True)
+  matches, actions = [], []
+  for match_id in range(first_id, first_id + count):
+    fields = match_fields(match_id, rng, words, civs, patches)
+    fields['player1_id'], fields['player2_id'] = rng.sample(PLAYER_IDS, 2)
+    matches.append(fields)
+    for player in range(1, 3):
+      for tech_id in TECH_IDS:
+        if rng.random() < 0.8:
+          actions.append(MatchPlayerActions(match_id=match_id, player_id=fields[f'player{player}_id'], event_type=3, event_id=tech_id,
+                                            time=rng.randrange(300000, 1500000), duration=0, patch_number=fields['patch_number']))
+  #like the importer, rows in the default partition would keep later imports from creating the patch's partitions
+  partitions.ensure(patches)
+  Matches.objects.bulk_create(Matches(**fields) for fields in matches)
+  MatchPlayerActions.objects.bulk_create(actions)
+  return matches
+
+def build_rollups():
+  #update_intermediary_tables without its progress output
+  with contextlib.redirect_stdout(io.StringIO()):
+    utils.update_intermediary_tables()
+
+#filters of the endpoint tests
+PARAMETER_SETS = [
+  query_data(),
+  query_data(min_elo=1000, max_elo=2000),
+  query_data(include_ladder_ids=[3], include_patch_ids=[2], include_map_ids=[9, 29]),
+  query_data(min_elo=500, max_elo=1500, include_patch_ids=[1], include_opening_ids=[0, 2, 6, 7, len(utils.OPENINGS) - 1]),
+]
+
+class CivOpeningTotalTests(TestCase):
+  def setUp(self):
+    rng = random.Random(3)
+    Players.objects.bulk_create([Players(id=1, name='p1'), Players(id=2, name='p2')])
+    Matches.objects.bulk_create([Matches(**match_fields(match_id, rng)) for match_id in range(1, 121)])
+    utils.build_opening_elo_wins()
+    utils.build_civ_opening_elo_wins()
+
+  def assert_player_games(self, data, player_games):
+    #total*2 is what the play rates divide by
+    rows = cubes.opening_rows(data)
+    self.assertEqual(aggregation.fold_opening_win_rates(rows, data['include_opening_ids'])['total'] * 2, player_games)
+    self.assertEqual(aggregation.fold_opening_matchups(rows, data['include_opening_ids'])['total'] * 2, player_games)
+
+  def test_no_filter(self):
+    self.assert_player_games(query_data(), Matches.objects.count() * 2)
+
+  def test_include_civ(self):
+    player_games = Matches.objects.filter(player1_civilization=3).count() + Matches.objects.filter(player2_civilization=3).count()
+    self.assert_player_games(query_data(include_civ_ids=[3]), player_games)
+
+  def test_exclude_civ(self):
+    player_games = Matches.objects.exclude(player1_civilization=3).count() + Matches.objects.exclude(player2_civilization=3).count()
+    self.assert_player_games(query_data(exclude_civ_ids=[3]), player_games)
+
+  def test_clamp_civ(self):
+    games = Matches.objects.filter(player1_civilization__in=[1, 2], player2_civilization__in=[1, 2]).count()
+    self.assert_player_games(query_data(clamp_civ_ids=[1, 2]), games * 2)
+
+class VersionTests(TestCase):
+  def test_changed_after_a_lost_token(self):
+    first = versions.changed(rollups.DATA_VERSION_KEY)
+    self.assertEqual(versions.get(rollups.DATA_VERSION_KEY), first)
+    #culled or cleared, the next change must still differ from anything seen before
+    caches[versions.ALIAS].delete(rollups.DATA_VERSION_KEY)
+    self.assertIsNone(versions.get(rollups.DATA_VERSION_KEY))
+    second = versions.changed(rollups.DATA_VERSION_KEY)
+    self.assertNotIn(second, (first, None))
+    self.assertEqual(versions.get(rollups.DATA_VERSION_KEY), second)
+
+class ValidationParityTests(TestCase):
+  #validation.MATCHES replaced MatchesSerializer on import and must accept and reject the same records
+  def setUp(self):
+    Players.objects.bulk_create([Players(id=1, name='p1'), Players(id=2, name='p2')])
+    match = Matches.objects.create(**match_fields(1, random.Random(5), WORDS))
+    self.match = dict(MatchesSerializer(match).data, id=2)
+    self.action = {'match':1, 'player':1, 'event_type':3, 'event_id':101, 'time':300000, 'duration':0}
+    MatchPlayerActions.objects.create(match_id=1, player_id=1, event_type=3, event_id=101, time=300000, duration=0, patch_number=1)
+
+  def validation_accepts(self, schema, record, label, unique=False):
+    try:
+      rows = schema.validate([record], label)
+      validation.check_foreign_keys(schema, rows, label)
+      if unique:
+        validation.check_unique_together(schema, rows, label)
+    except ValidationError:
+      return False
+    return True
+
+  def test_matches(self):
+    flags = {name for player in range(1,3) for name in utils.opening_flag_field_names(player)}
+    packed_only = {name:value for name, value in self.match.items() if name not in flags}
+    cases = {
+      'valid':{},
+      'numeric strings':{'average_elo':'1200', 'map_id':'9.0'},
+      'null ladder':{'ladder_id':None},
+      'boolean int':{'map_id':True},
+      'fractional int':{'average_elo':1200.5},
+      'null elo':{'average_elo':None},
+      'bad time':{'time':'yesterday'},
+      'string flag':{'player1_opening_flag3':'true'},
+      'bad flag':{'player1_opening_flag3':'maybe'},
+      'packed mismatch':{'player1_opening_flags':12345},
+      'negative packed':{'player1_opening_flags':-1},
+      'missing player':{'player1':3},
+    }
+    records = {name:dict(self.match, **values) for name, values in cases.items()}
+    records['packed only'] = packed_only
+    records['no flags'] = {name:value for name, value in packed_only.items() if not name.endswith('_opening_flags')}
+    records['partial flags'] = {name:value for name, value in self.match.items() if name != 'player2_opening_flag7'}
+    records['missing id'] = {name:value for name, value in self.match.items() if name != 'id'}
+    for name, record in records.items():
+      with self.subTest(name):
+        serializer = MatchesSerializer(data=record)
+        self.assertEqual(self.validation_accepts(validation.MATCHES, record, 'matches'), serializer.is_valid())
+        if serializer.is_valid():
+          rows = validation.MATCHES.validate([record], 'matches')
+          validated = {field.attname:getattr(value, 'pk', value) for field, value in
+                       ((Matches._meta.get_field(name), value) for name, value in serializer.validated_data.items())}
+          self.assertEqual(rows[0], validated)
+
+  def test_out_of_range(self):
+    #validation checks PostgreSQL's integer ranges everywhere, the serializer only on databases that have them
+    record = dict(self.match, average_elo=2**40)
+    self.assertFalse(self.validation_accepts(validation.MATCHES, record, 'matches'))
+    if connection.vendor == 'postgresql':
+      self.assertFalse(MatchesSerializer(data=record).is_valid())
+
+  def test_duplicate_ids(self):
+    #matches.id is unique through validation only once the table is partitioned
+    new = dict(self.match, id=3)
+    for name, records in {'existing':[new, dict(self.match, id=1)], 'in batch':[new, new]}.items():
+      with self.subTest(name):
+        rows = validation.MATCHES.validate(records, 'matches')
+        with self.assertRaises(ValidationError) as raised:
+          validation.check_unique_ids(validation.MATCHES, rows, 'matches')
+        self.assertEqual(list(raised.exception.detail['matches']), [1])
+    with self.assertRaises(ValidationError):
+      importer.import_batch([], [], [new, dict(self.match, id=1)], [])
+    self.assertFalse(Matches.objects.filter(id=3).exists())
+
+  def test_match_player_actions(self):
+    cases = {'valid':dict(self.action, event_id=102), 'duplicate':self.action,
+             'missing match':dict(self.action, match=3, event_id=102)}
+    for name, record in cases.items():
+      with self.subTest(name):
+        self.assertEqual(self.validation_accepts(validation.MATCH_PLAYER_ACTIONS, record, 'match_player_actions', True),
+                         MatchPlayerActionsSerializer(data=record).is_valid())
+
+def rollup_rows():
+  tables = [(CivEloWins, rollups.CIV_ELO_WINS_KEYS + ['victory_count', 'loss_count']),
+            (OpeningEloWins, rollups.OPENING_ELO_WINS_KEYS + ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']),
+            (CivOpeningEloWins, rollups.CIV_OPENING_ELO_WINS_KEYS + ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']),
+            (OpeningEloTechs, rollups.OPENING_ELO_TECHS_KEYS + ['average_time', 'count']),
+            (OpeningMetaSnapshot, rollups.OPENING_META_SNAPSHOT_KEYS + ['count'])]
+  #averages are folded in a different order
+  return {model.__name__:sorted(tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+                                for row in model.objects.values_list(*columns))
+          for model, columns in tables}
+
+class ImportRollupTests(TestCase):
+  #the deltas import_batch upserts must add up to the tables update_intermediary_tables builds
+  def setUp(self):
+    Techs.objects.bulk_create([Techs(id=101, name='Feudal Age', duration=130), Techs(id=102, name='Castle Age', duration=160)])
+    reference.invalidate()
+
+  def test_import_batches(self):
+    rng = random.Random(11)
+    matches = [match_fields(match_id, rng, WORDS, range(1, 7), (1, 2)) for match_id in range(1, 161)]
+    actions = [{'match':match['id'], 'player':match[f'player{player}_id'], 'event_type':3, 'event_id':tech,
+                'time':rng.randrange(300000, 1500000), 'duration':0}
+               for match in matches for player in range(1,3) for tech in (101, 102) if rng.random() < 0.8]
+    players = [{'id':1}, {'id':2}]
+    patches = [{'id':1}, {'id':2}]
+    #the second batch lands on rows the first one created
+    for batch in (matches[:80], matches[80:]):
+      ids = {match['id'] for match in batch}
+      importer.import_batch(players, patches, [match_payload(match) for match in batch],
+                            [action for action in actions if action['match'] in ids])
+    imported = rollup_rows()
+    self.assertTrue(all(imported.values()))
+    utils.update_intermediary_tables()
+    self.assertEqual(imported, rollup_rows())
+
+def rollup_tables():
+  return [(CivEloWins, rollups.CIV_ELO_WINS_KEYS, ['victory_count', 'loss_count']),
+          (OpeningEloWins, rollups.OPENING_ELO_WINS_KEYS, ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']),
+          (CivOpeningEloWins, rollups.CIV_OPENING_ELO_WINS_KEYS, ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']),
+          (OpeningEloTechs, rollups.OPENING_ELO_TECHS_KEYS, ['average_time', 'count'])]
+
+def table_rows(keys, values, count, value):
+  #count rows with distinct keys, every value column set to value
+  return [(i,) + (1,) * (len(keys) - 1) + (value,) * len(values) for i in range(count)]
+
+class Reader(threading.Thread):
+  #queries the table on its own connection until stopped, keeping every (count, sum) it saw
+  def __init__(self, table, column):
+    super().__init__()
+    self.sql = f'SELECT count(*), sum({connection.ops.quote_name(column)}) FROM {connection.ops.quote_name(table)}'
+    self.seen = set()
+    self.errors = []
+    self.stopped = threading.Event()
+
+  def run(self):
+    try:
+      while not self.stopped.is_set():
+        with connection.cursor() as cursor:
+          cursor.execute(self.sql)
+          self.seen.add(tuple(cursor.fetchone()))
+    except Exception as e:
+      self.errors.append(e)
+    finally:
+      connection.close()
+
+class LockHolder(threading.Thread):
+  #holds a read lock on the table for seconds, like a long running request
+  def __init__(self, table, seconds):
+    super().__init__()
+    self.table = table
+    self.seconds = seconds
+    self.locked = threading.Event()
+
+  def run(self):
+    try:
+      with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'SELECT count(*) FROM {connection.ops.quote_name(self.table)}')
+        self.locked.set()
+        time.sleep(self.seconds)
+    finally:
+      self.locked.set()
+      connection.close()
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'the shadow table swap is PostgreSQL only')
+class SwapTableTests(TransactionTestCase):
+  def schema(self, table):
+    with connection.cursor() as cursor:
+      cursor.execute('SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass', [table])
+      constraints = set(cursor.fetchall())
+      cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+      return constraints, {row[0] for row in cursor.fetchall()}
+
+  def test_replace_with_reader(self):
+    for model, keys, values in rollup_tables():
+      with self.subTest(model.__name__):
+        table = model._meta.db_table
+        rollups.replace_table(model, keys + values, table_rows(keys, values, 200, 1))
+        schema = self.schema(table)
+        reader = Reader(table, values[-1])
+        reader.start()
+        try:
+          for _ in range(3):
+            rollups.replace_table(model, keys + values, table_rows(keys, values, 300, 2))
+            rollups.replace_table(model, keys + values, table_rows(keys, values, 200, 1))
+        finally:
+          reader.stopped.set()
+          reader.join()
+        self.assertEqual(reader.errors, [])
+        #never a half loaded or missing table
+        self.assertTrue(reader.seen)
+        self.assertLessEqual(reader.seen, {(200, 200), (300, 600)})
+        self.assertEqual(self.schema(table), schema)
+        #the id sequence survived the swaps
+        model.objects.create(**dict(zip(keys + values, table_rows(keys, values, 201, 1)[-1])))
+        self.assertEqual(model.objects.count(), 201)
+
+  def test_retry_after_lock_timeout(self):
+    columns = rollups.CIV_ELO_WINS_KEYS + ['victory_count', 'loss_count']
+    rollups.replace_table(CivEloWins, columns, table_rows(rollups.CIV_ELO_WINS_KEYS, columns[-2:], 10, 1))
+    holder = LockHolder('civ_elo_wins', 0.5)
+    with mock.patch.object(rollups, 'SWAP_LOCK_TIMEOUT', '50ms'):
+      holder.start()
+      holder.locked.wait()
+      start = time.monotonic()
+      rollups.replace_table(CivEloWins, columns, table_rows(rollups.CIV_ELO_WINS_KEYS, columns[-2:], 20, 1))
+      waited = time.monotonic() - start
+    holder.join()
+    self.assertGreater(waited, 0.3)
+    self.assertEqual(CivEloWins.objects.count(), 20)
+
+  def test_gives_up_after_attempts(self):
+    columns = rollups.CIV_ELO_WINS_KEYS + ['victory_count', 'loss_count']
+    rollups.replace_table(CivEloWins, columns, table_rows(rollups.CIV_ELO_WINS_KEYS, columns[-2:], 10, 1))
+    holder = LockHolder('civ_elo_wins', 1)
+    with mock.patch.object(rollups, 'SWAP_LOCK_TIMEOUT', '50ms'), mock.patch.object(rollups, 'SWAP_ATTEMPTS', 2):
+      holder.start()
+      holder.locked.wait()
+      with self.assertRaises(OperationalError):
+        rollups.replace_table(CivEloWins, columns, table_rows(rollups.CIV_ELO_WINS_KEYS, columns[-2:], 20, 1))
+    holder.join()
+    self.assertEqual(CivEloWins.objects.count(), 10)
+    #the shadow table left behind is replaced by the next attempt
+    rollups.replace_table(CivEloWins, columns, table_rows(rollups.CIV_ELO_WINS_KEYS, columns[-2:], 20, 1))
+    self.assertEqual(CivEloWins.objects.count(), 20)
+
+# What the eval'd query strings query_builder replaced computed, in plain Python
+# over the rollup rows
+def old_filter(data, row):
+  #row: dict with ladder_id, patch_number, map_id and elo
+  for key, column in (('include_ladder_ids', 'ladder_id'), ('include_patch_ids', 'patch_number'), ('include_map_ids', 'map_id')):
+    ids = data.get(key, [-1])
+    if len(ids) and ids[0] != -1 and row[column] not in ids:
+      return False
+  return data['min_elo'] <= row['elo'] <= data['max_elo']
+
+def old_sums(keys):
+  sums = dict.fromkeys(keys)
+  def add(key, value):
+    sums[key] = value if sums[key] is None else sums[key] + value
+  return sums, add
+
+def old_opening_win_rates(rows, opening_ids):
+  basic, last_two = len(utils.Basic_Strategies), len(utils.OPENINGS) - 2
+  def is_basic(opening_id):
+    return opening_id < basic or opening_id >= last_two
+  strategies = opening_ids if opening_ids[0] != -1 else range(len(utils.OPENINGS))
+  names = [utils.OPENINGS[opening_id][0] for opening_id in strategies]
+  sums, add = old_sums(['total'] + [f'{name}_{column}' for name in names for column in ('total', 'wins', 'losses')])
+  for row in rows:
+    games1 = row['opening1_victory_count'] + row['opening1_loss_count']
+    games2 = row['opening2_victory_count'] + row['opening2_loss_count']
+    if is_basic(row['opening1_id']) and is_basic(row['opening2_id']):
+      add('total', games1)
+    for opening_id, name in zip(strategies, names):
+      #the first matching When of each Case
+      if row['opening1_id'] == opening_id and row['opening2_id'] == opening_id:
+        add(f'{name}_total', games1 + games2)
+        add(f'{name}_wins', 0)
+        add(f'{name}_losses', 0)
+      elif row['opening1_id'] == opening_id and is_basic(row['opening2_id']):
+        add(f'{name}_total', games1)
+        add(f'{name}_wins', row['opening1_victory_count'])
+        add(f'{name}_losses', row['opening1_loss_count'])
+      elif row['opening2_id'] == opening_id and is_basic(row['opening1_id']):
+        add(f'{name}_total', games2)
+        add(f'{name}_wins', row['opening2_victory_count'])
+        add(f'{name}_losses', row['opening2_loss_count'])
+  return sums
+
+def old_opening_matchups(rows, opening_ids):
+  basic = len(utils.Basic_Strategies)
+  strategies = list(opening_ids) if opening_ids[0] != -1 else list(range(basic))
+  pairs = [(i, j) for i in strategies for j in strategies[strategies.index(i):]]
+  names = {pair:f'{utils.OPENINGS[pair[0]][0]}_vs_{utils.OPENINGS[pair[1]][0]}' for pair in pairs}
+  sums, add = old_sums(['total'] + [f'{name}_{column}' for name in names.values() for column in ('total', 'wins')])
+  for row in rows:
+    opening1, opening2 = row['opening1_id'], row['opening2_id']
+    if opening1 < basic and opening2 < basic:
+      add('total', row['opening1_victory_count'] + row['opening1_loss_count'])
+    for (i, j), name in names.items():
+      if opening1 == i and opening2 == j:
+        add(f'{name}_total', row['opening1_victory_count'] + row['opening1_loss_count'])
+        add(f'{name}_wins', row['opening1_victory_count'])
+      elif i != j and opening2 == i and opening1 == j:
+        add(f'{name}_total', row['opening2_victory_count'] + row['opening2_loss_count'])
+        add(f'{name}_wins', row['opening2_victory_count'])
+  return sums
+
+class QueryBuilderTests(TestCase):
+  @classmethod
+  def setUpTestData(cls):
+    seed_matches(300, seed=7)
+    build_rollups()
+    cls.rows = list(OpeningEloWins.objects.values())
+
+  def test_filter(self):
+    for data in PARAMETER_SETS:
+      with self.subTest(data=data):
+        expected = {row['id'] for row in self.rows if old_filter(data, row)}
+        self.assertEqual(set(OpeningEloWins.objects.filter(query_builder.build_filter(data)).values_list('id', flat=True)), expected)
+
+  def test_match_filter(self):
+    data = query_data(min_elo=1000, max_elo=2000, include_ladder_ids=[3], exclude_civ_mirrors='True')
+    expected = {match.id for match in Matches.objects.all()
+                if old_filter(data, {'ladder_id':match.ladder_id, 'patch_number':match.patch_number, 'map_id':match.map_id, 'elo':match.average_elo})
+                and match.player1_civilization != match.player2_civilization}
+    actual = set(Matches.objects.filter(query_builder.build_filter(data, elo_string='average_elo')).values_list('id', flat=True))
+    self.assertEqual(actual, expected)
+
+  def test_opening_win_rates(self):
+    for data in PARAMETER_SETS:
+      with self.subTest(data=data):
+        rows = [row for row in self.rows if old_filter(data, row)]
+        actual = OpeningEloWins.objects.filter(query_builder.build_filter(data))\
+            .aggregate(**query_builder.opening_win_rate_aggregates(data['include_opening_ids']))
+        self.assertEqual(actual, old_opening_win_rates(rows, data['include_opening_ids']))
+
+  def test_opening_matchups(self):
+    for data in PARAMETER_SETS:
+      with self.subTest(data=data):
+        rows = [row for row in self.rows if old_filter(data, row)]
+        actual = OpeningEloWins.objects.filter(query_builder.build_filter(data))\
+            .aggregate(**query_builder.opening_matchup_aggregates(data['include_opening_ids']))
+        self.assertEqual(actual, old_opening_matchups(rows, data['include_opening_ids']))
+
+  def test_memoized(self):
+    #same trees for equal parameters, whatever the order of the ids
+    data = PARAMETER_SETS[2]
+    self.assertIs(query_builder.build_filter(data), query_builder.build_filter(dict(data, include_map_ids=[29, 9])))
+    self.assertIs(query_builder.opening_matchup_aggregates([0, 1]), query_builder.opening_matchup_aggregates([0, 1]))
+
+class FoldTests(TestCase):
+  @classmethod
+  def setUpTestData(cls):
+    seed_matches(300, seed=11)
+    build_rollups()
+
+  def test_civ_win_rates(self):
+    for data in PARAMETER_SETS:
+      with self.subTest(data=data):
+        queryset = CivEloWins.objects.filter(query_builder.build_filter(data))
+        self.assertEqual(aggregation.fold_civ_win_rates(aggregation.civ_rows(queryset)),
+                         queryset.aggregate(**query_builder.civ_win_rate_aggregates()))
+
+  def test_opening_win_rates(self):
+    for data in PARAMETER_SETS:
+      with self.subTest(data=data):
+        queryset = OpeningEloWins.objects.filter(query_builder.build_filter(data))
+        expected = queryset.aggregate(**query_builder.opening_win_rate_aggregates(data['include_opening_ids']))
+        actual = aggregation.fold_opening_win_rates(aggregation.opening_rows(queryset), data['include_opening_ids'])
+        self.assertEqual(list(actual.items()), list(expected.items()))
+
+  def test_opening_matchups(self):
+    for data in PARAMETER_SETS:
+      with self.subTest(data=data):
+        queryset = OpeningEloWins.objects.filter(query_builder.build_filter(data))
+        expected = queryset.aggregate(**query_builder.opening_matchup_aggregates(data['include_opening_ids']))
+        actual = aggregation.fold_opening_matchups(aggregation.opening_rows(queryset), data['include_opening_ids'])
+        self.assertEqual(list(actual.items()), list(expected.items()))
+
+  def test_opening_techs(self):
+    tech_ids_to_names = {101:'Feudal_Age', 102:'Castle_Age'}
+    for data in PARAMETER_SETS:
+      with self.subTest(data=data):
+        queryset = OpeningEloTechs.objects.filter(query_builder.build_filter(data))\
+            .filter(query_builder.opening_tech_filter(tech_ids_to_names))
+        expected = queryset.aggregate(**query_builder.opening_tech_aggregates(tech_ids_to_names, data['include_opening_ids']))
+        actual = aggregation.fold_opening_techs(aggregation.tech_rows(queryset), tech_ids_to_names, data['include_opening_ids'])
+        self.assertEqual(list(actual), list(expected))
+        self.assertTrue(any(value is not None for key, value in actual.items() if key != 'total'))
+        for key, value in actual.items():
+          if value is None or expected[key] is None:
+            self.assertEqual(value, expected[key], key)
+          else:
+            self.assertAlmostEqual(value, expected[key], places=6, msg=key)
+
+  def test_odd_player_games(self):
+    #a civ filter can keep one side of a match, total is then a half
+    Matches.objects.all().delete()
+    rng = random.Random(5)
+    Matches.objects.bulk_create([Matches(**match_fields(match_id, rng)) for match_id in range(1, 42)])
+    data = query_data(include_civ_ids=[3])
+    player_games = Matches.objects.filter(player1_civilization=3).count() + Matches.objects.filter(player2_civilization=3).count()
+    if player_games % 2 == 0:
+      match = Matches.objects.exclude(player1_civilization=3).exclude(player2_civilization=3).first()
+      Matches.objects.filter(id=match.id).update(player1_civilization=3)
+      player_games += 1
+    build_rollups()
+    rows = cubes.opening_rows(data)
+    for fold in (aggregation.fold_opening_win_rates, aggregation.fold_opening_matchups):
+      total = fold(rows, data['include_opening_ids'])['total']
+      self.assertIsInstance(total, float)
+      self.assertEqual(total, player_games / 2)
+
+class UpsertTests(TestCase):
+  def test_counts_added(self):
+    first = {(1, 9, 3, 1, 1200):{'victory_count':2, 'loss_count':1}, (2, 9, 3, 1, 1200):{'victory_count':0, 'loss_count':4}}
+    second = {(1, 9, 3, 1, 1200):{'victory_count':5, 'loss_count':3}, (1, 29, 3, 1, 1200):{'victory_count':1, 'loss_count':0}}
+    self.assertEqual(rollups.upsert_civ_elo_wins(first), 2)
+    self.assertEqual(rollups.upsert_civ_elo_wins(second), 2)
+    rows = {row[:5]:row[5:] for row in CivEloWins.objects.values_list(*rollups.CIV_ELO_WINS_KEYS, 'victory_count', 'loss_count')}
+    self.assertEqual(rows, {(1, 9, 3, 1, 1200):(7, 4), (2, 9, 3, 1, 1200):(0, 4), (1, 29, 3, 1, 1200):(1, 0)})
+
+  def test_batches(self):
+    counts = {'opening1_victory_count':1, 'opening1_loss_count':0, 'opening2_victory_count':0, 'opening2_loss_count':1}
+    data_dict = {(i % 7, i // 7, 9, 3, 1, 1000):counts for i in range(7 * 40)}
+    with mock.patch.object(rollups, 'UPSERT_BATCH_SIZE', 32):
+      rollups.upsert_opening_elo_wins(data_dict)
+      rollups.upsert_opening_elo_wins(data_dict)
+    self.assertEqual(OpeningEloWins.objects.count(), len(data_dict))
+    self.assertEqual(set(OpeningEloWins.objects.values_list('opening1_victory_count', 'opening2_loss_count')), {(2, 2)})
+
+  def test_weighted_average_time(self):
+    key = (1, 101, 9, 3, 1, 1200)
+    rollups.upsert_opening_elo_techs({key:{'average_time':600.0, 'research_count':1}})
+    rollups.upsert_opening_elo_techs({key:{'average_time':900.0, 'research_count':2}})
+    rollups.upsert_opening_elo_techs({(2, 101, 9, 3, 1, 1200):{'average_time':700.0, 'research_count':3}})
+    tech = OpeningEloTechs.objects.get(opening_id=1, tech_id=101)
+    self.assertEqual(tech.count, 3)
+    self.assertAlmostEqual(tech.average_time, 800.0)
+    self.assertEqual(OpeningEloTechs.objects.count(), 2)
+
+def per_bit_classify(flags):
+  #the per-bit walk over the flag columns the build_* helpers did before the bitmask classifier
+  valid_openings = []
+  for opening_index, (name, inclusions, exclusions) in enumerate(utils.OPENINGS):
+    valid_opening = any(all(flags[i] for i in range(32) if inclusion & 2**i) for inclusion in inclusions)
+    for exclusion in exclusions if len(exclusions) else [OpeningType.Unused.value]:
+      if any(flags[i] for i in range(32) if exclusion & 2**i):
+        valid_opening = False
+    if valid_opening:
+      valid_openings.append(opening_index)
+  return tuple(valid_openings) if len(valid_openings) else (len(utils.OPENINGS) - 1,)
+
+class ClassifierTests(unittest.TestCase):
+  def test_every_used_flag_word(self):
+    #the openings only use bits 0-9 and 31, so this is every distinct classification
+    bits = list(range(10)) + [31]
+    used = 0
+    for name, inclusions, exclusions in utils.OPENINGS:
+      for mask in inclusions + exclusions:
+        used |= mask
+    self.assertEqual(used, sum(1 << bit for bit in bits))
+    for combination in range(2 ** len(bits)):
+      word = sum(1 << bit for n, bit in enumerate(bits) if combination & (1 << n))
+      self.assertEqual(utils.classify_opening_flag_word(word), per_bit_classify(utils.unpack_opening_flags(word)), bin(word))
+
+  def test_classify_match_player(self):
+    rng = random.Random(2)
+    for word in WORDS:
+      fields = match_fields(1, rng, words=[word])
+      match = Matches(**fields)
+      for player in range(1, 3):
+        self.assertEqual(utils.classify_match_player(match, player),
+                         per_bit_classify([fields[f'player{player}_opening_flag{i}'] for i in range(32)]))
+
+class OpeningFlagTests(TestCase):
+  def setUp(self):
+    Players.objects.bulk_create([Players(id=1, name='p1'), Players(id=2, name='p2')])
+
+  def test_bit_lookups(self):
+    rng = random.Random(4)
+    Matches.objects.bulk_create([Matches(**match_fields(match_id, rng, WORDS)) for match_id in range(1, 61)])
+    words = dict(Matches.objects.values_list('id', 'player1_opening_flags'))
+    for mask in (0, OpeningType.PremillDrush.value, OpeningType.Maa.value | OpeningType.PremillDrush.value,
+                 OpeningType.FeudalScoutOpening.value | OpeningType.FeudalScoutFollowup.value, 2**31):
+      with self.subTest(mask=mask):
+        self.assertEqual(set(Matches.objects.filter(player1_opening_flags__hasbits=mask).values_list('id', flat=True)),
+                         {match_id for match_id, word in words.items() if word & mask == mask})
+        self.assertEqual(set(Matches.objects.filter(player1_opening_flags__hasnobits=mask).values_list('id', flat=True)),
+                         {match_id for match_id, word in words.items() if not word & mask})
+
+  def test_resolve_opening_flags(self):
+    fields = match_payload(match_fields(1, random.Random(6), [OpeningType.MaaArchers.value]))
+    word = fields['player1_opening_flags']
+    flags = {name for player in range(1,3) for name in utils.opening_flag_field_names(player)}
+    booleans_only = {name:value for name, value in fields.items() if not name.endswith('_opening_flags')}
+    packed_only = {name:value for name, value in fields.items() if name not in flags}
+    for name, record in {'booleans':booleans_only, 'packed':packed_only, 'both':fields}.items():
+      with self.subTest(name):
+        serializer = MatchesSerializer(data=record)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertEqual(serializer.validated_data['player1_opening_flags'], word)
+        self.assertEqual([serializer.validated_data[name] for name in utils.opening_flag_field_names(1)],
+                         utils.unpack_opening_flags(word))
+    errors = {
+      'mismatch':dict(fields, player1_opening_flags=word ^ 1),
+      'partial':{name:value for name, value in fields.items() if name != 'player2_opening_flag7'},
+      'missing':{name:value for name, value in packed_only.items() if name != 'player2_opening_flags'},
+    }
+    for name, record in errors.items():
+      with self.subTest(name):
+        serializer = MatchesSerializer(data=record)
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(len(serializer.errors), 1)
+
+  def test_pack_migration(self):
+    #0013 packs the boolean columns of existing rows
+    from django.apps import apps
+    migration = importlib.import_module('opening_stats.migrations.0013_matches_player_opening_flags')
+    rng = random.Random(8)
+    matches = [match_fields(match_id, rng, WORDS + [2**31 | 1]) for match_id in range(1, 31)]
+    Matches.objects.bulk_create(Matches(**dict(fields, player1_opening_flags=0, player2_opening_flags=0)) for fields in matches)
+    migration.pack_opening_flags(apps, connection.schema_editor())
+    packed = {row[0]:row[1:] for row in Matches.objects.values_list('id', 'player1_opening_flags', 'player2_opening_flags')}
+    self.assertEqual(packed, {fields['id']:(fields['player1_opening_flags'], fields['player2_opening_flags']) for fields in matches})
+
+class ClaimTests(TestCase):
+  def setUp(self):
+    self.rows = [AdvancedQueryQueue.objects.create(query=f'min_elo={i}') for i in range(3)]
+
+  def test_claims_in_order(self):
+    self.assertEqual([advanced_queue.claim_next(worker).id for worker in ('a', 'b', 'c')], [row.id for row in self.rows])
+    self.assertIsNone(advanced_queue.claim_next('d'))
+    self.assertEqual(list(AdvancedQueryQueue.objects.order_by('id').values_list('claimed_by', flat=True)), ['a', 'b', 'c'])
+
+  def test_reclaims_expired_lease(self):
+    first = advanced_queue.claim_next('a', lease_seconds=60)
+    advanced_queue.claim_next('b', lease_seconds=60)
+    advanced_queue.claim_next('c', lease_seconds=60)
+    #a stopped sending heartbeats
+    AdvancedQueryQueue.objects.filter(pk=first.id)\
+        .update(last_checkin=django.utils.timezone.now() - datetime.timedelta(seconds=61))
+    self.assertEqual(advanced_queue.claim_next('d', lease_seconds=60).id, first.id)
+    self.assertIsNone(advanced_queue.claim_next('e', lease_seconds=60))
+    #the result of the worker that lost the row is dropped
+    self.assertFalse(advanced_queue.complete(first.id, 'a', {'total':1}))
+    self.assertTrue(advanced_queue.complete(first.id, 'd', {'total':2}))
+    self.assertEqual(AdvancedQueryQueue.objects.get(pk=first.id).result.data, {'total':2})
+    self.assertEqual(AdvancedQueryResults.objects.count(), 1)
+
+class HeartbeatTests(TransactionTestCase):
+  def test_bumps_last_checkin(self):
+    AdvancedQueryQueue.objects.create(query='min_elo=0')
+    row = advanced_queue.claim_next('a')
+    old = django.utils.timezone.now() - datetime.timedelta(seconds=30)
+    AdvancedQueryQueue.objects.filter(pk=row.id).update(last_checkin=old)
+    with advanced_queue.Heartbeat(row.id, 'a', interval=0.01):
+      time.sleep(0.2)
+    self.assertGreater(AdvancedQueryQueue.objects.get(pk=row.id).last_checkin, old)
+    #not once another worker has the row
+    AdvancedQueryQueue.objects.filter(pk=row.id).update(claimed_by='b', last_checkin=old)
+    with advanced_queue.Heartbeat(row.id, 'a', interval=0.01):
+      time.sleep(0.1)
+    self.assertEqual(AdvancedQueryQueue.objects.get(pk=row.id).last_checkin, old)
+
+class SkipLockedClaimer(threading.Thread):
+  #claims on its own connection while the test holds a row lock
+  def __init__(self):
+    super().__init__()
+    self.claimed = None
+
+  def run(self):
+    try:
+      self.claimed = advanced_queue.claim_next('b')
+    finally:
+      connection.close()
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'SKIP LOCKED is PostgreSQL only')
+class SkipLockedTests(TransactionTestCase):
+  def test_skips_a_locked_row(self):
+    rows = [AdvancedQueryQueue.objects.create(query=f'min_elo={i}') for i in range(2)]
+    with transaction.atomic():
+      #a worker in the middle of claiming the first row
+      AdvancedQueryQueue.objects.select_for_update().get(pk=rows[0].id)
+      claimer = SkipLockedClaimer()
+      claimer.start()
+      claimer.join(10)
+      self.assertFalse(claimer.is_alive())
+    self.assertEqual(claimer.claimed.id, rows[1].id)
+    self.assertEqual(advanced_queue.claim_next('a').id, rows[0].id)
+
+@unittest.skipIf(connection.vendor == 'postgresql', 'PostgreSQL notifies through LISTEN')
+class LocalNotifyTests(TestCase):
+  def test_published_on_commit(self):
+    after = notify.position()
+    with self.captureOnCommitCallbacks(execute=True):
+      notify.notify(notify.QUEUE_CHANNEL, 5)
+      self.assertEqual(notify.wait(after, [notify.QUEUE_CHANNEL], 0)[1], [])
+    position, events = notify.wait(after, [notify.QUEUE_CHANNEL], 0)
+    self.assertEqual(events, [(notify.QUEUE_CHANNEL, '5')])
+    self.assertEqual(notify.wait(position, [notify.QUEUE_CHANNEL], 0)[1], [])
+    self.assertEqual(notify.wait(after, [notify.RESULT_CHANNEL], 0)[1], [])
+
+  def test_wait_is_capped(self):
+    #other processes can't wake this one, callers re-check the database every LOCAL_POLL_SECONDS
+    start = time.monotonic()
+    self.assertEqual(notify.wait(notify.position(), notify.CHANNELS, 30)[1], [])
+    self.assertLess(time.monotonic() - start, notify.LOCAL_POLL_SECONDS + 1)
+
+class AdvancedWaitTests(TestCase):
+  def setUp(self):
+    #no LISTEN connection to the test database, results are published in process
+    forwarder = mock.patch.object(notify, '_ensure_forwarder', return_value=False)
+    forwarder.start()
+    self.addCleanup(forwarder.stop)
+
+  def post(self, timeout):
+    start = time.monotonic()
+    response = self.client.post(f'{reverse("advanced-wait")}?timeout={timeout}', {'include_civ_ids_0':[1]}, content_type='application/json')
+    self.assertEqual(response.status_code, 200)
+    return json.loads(response.content), time.monotonic() - start
+
+  def test_timeout(self):
+    with mock.patch.object(views.advanced_queue, 'answer_or_enqueue', return_value=3) as answer:
+      body, elapsed = self.post(0.3)
+    self.assertEqual(body, {'position':3, 'result':''})
+    self.assertGreaterEqual(elapsed, 0.3)
+    self.assertLess(elapsed, views.AdvancedWait.RECHECK_SECONDS)
+    self.assertEqual(answer.call_count, 1)
+
+  def test_woken_by_result(self):
+    result_id = uuid.uuid4()
+    answers = [0, result_id]
+    publisher = threading.Timer(0.2, notify._publish, [notify.RESULT_CHANNEL, '1'])
+    publisher.start()
+    with mock.patch.object(views.advanced_queue, 'answer_or_enqueue', side_effect=lambda data: answers.pop(0)):
+      body, elapsed = self.post(views.AdvancedWait.MAX_TIMEOUT)
+    publisher.join()
+    self.assertEqual(body, {'position':-1, 'result':str(result_id)})
+    #before the database re-check would have found it
+    self.assertLess(elapsed, views.AdvancedWait.RECHECK_SECONDS)
+
+  def test_no_free_waiter(self):
+    waiters = threading.BoundedSemaphore(1)
+    waiters.acquire()
+    with mock.patch.object(views.AdvancedWait, 'waiters', waiters), \
+         mock.patch.object(views.advanced_queue, 'answer_or_enqueue', return_value=2):
+      body, elapsed = self.post(views.AdvancedWait.MAX_TIMEOUT)
+    self.assertEqual(body, {'position':2, 'result':''})
+    self.assertLess(elapsed, 1)
+
+class QueuePositionTests(TestCase):
+  def test_position(self):
+    #position counts the pending rows ahead, completed and stale ones drop out
+    datas = [query_data(min_elo=elo) for elo in (100, 200, 300, 400)]
+    self.assertEqual([utils.EnqueueOrCheckAdvancedRequest(data) for data in datas], [0, 1, 2, 3])
+    rows = list(AdvancedQueryQueue.objects.order_by('id'))
+    self.assertEqual(utils.EnqueueOrCheckAdvancedRequest(datas[3]), 3)
+    rows[0].result = AdvancedQueryResults.objects.create(data={'total':1})
+    rows[0].save()
+    AdvancedQueryQueue.objects.filter(pk=rows[1].id).update(stale=True)
+    self.assertEqual(utils.EnqueueOrCheckAdvancedRequest(datas[3]), 1)
+    self.assertEqual(utils.EnqueueOrCheckAdvancedRequest(datas[0]), rows[0].result.id)
+    #a stale row is queued again at the back
+    self.assertEqual(utils.EnqueueOrCheckAdvancedRequest(datas[1]), 2)
+    self.assertEqual(AdvancedQueryQueue.objects.count(), 5)
+
+def advanced_data(matchups, **kwargs):
+  #matchups of (left civ, left opening, right civ, right opening), -1 for none, as parsed from a queue row
+  data = {'min_elo':'0', 'max_elo':'9000', 'include_patch_ids':[-1], 'include_ladder_ids':[-1], 'include_map_ids':[-1]}
+  for row, ids in enumerate(matchups):
+    for key, value in zip((f'include_civ_ids_{2*row}', f'include_opening_ids_{2*row}', f'include_civ_ids_{2*row+1}', f'include_opening_ids_{2*row+1}'), ids):
+      data[key] = [value]
+  data.update(kwargs)
+  return data
+
+#opening ids: 0-3 basic, 6 a followup, 7 and the second to last ones with several inclusions
+ADVANCED_CASES = [
+  advanced_data([(-1, 0, -1, 1)]),
+  advanced_data([(-1, 0, -1, 1), (-1, 1, -1, 1), (-1, 2, -1, -1), (3, -1, 4, -1), (2, 6, -1, 7)]),
+  advanced_data([(-1, 0, -1, 0), (1, -1, 1, -1), (-1, 3, 2, 3), (5, 7, -1, 2)],
+                min_elo='1000', max_elo='2000', include_ladder_ids=[3, 4],
+                exclude_civ_mirrors='True', exclude_opening_mirrors='True'),
+  advanced_data([(-1, 1, -1, 2), (4, -1, -1, -1), (-1, -1, 3, 0)], left_player_id='3', include_map_ids=[9]),
+]
+
+class MatchupFanOutTests(TransactionTestCase):
+  def setUp(self):
+    seed_matches(300, seed=13)
+
+  def test_same_result_as_single_aggregate(self):
+    run_matchup = advanced_queue.run_matchup
+    def closing(*args, **kwargs):
+      #pool threads keep their connections, which would outlive the test database
+      try:
+        return run_matchup(*args, **kwargs)
+      finally:
+        connection.close()
+    with mock.patch.object(advanced_queue, 'run_matchup', closing):
+      for data in ADVANCED_CASES:
+        with self.subTest(data=data):
+          single = advanced_queue.run_query_single(data)
+          self.assertTrue(any(single.values()))
+          for threads in (0, 1, 3):
+            self.assertEqual(advanced_queue.run_query(data, threads), single)
+          self.assertEqual(list(advanced_queue.run_query(data, 3)), list(single))
+
+class ApplyImportTests(TestCase):
+  def setUp(self):
+    seed_matches(200, seed=17)
+    reference.invalidate()
+
+  def enqueue(self, data, claimed_by=None, completed=False):
+    query = utils.data_dict_to_query_string(data)
+    result = None
+    if completed:
+      result = AdvancedQueryResults.objects.create(data=advanced_queue.run_query_single(utils.query_string_to_data_dict(query)))
+    return AdvancedQueryQueue.objects.create(query=query, claimed_by=claimed_by, result=result)
+
+  def recompute(self, adv_query):
+    return advanced_queue.run_query_single(utils.query_string_to_data_dict(adv_query.query))
+
+  def test_import(self):
+    overlapping = self.enqueue(ADVANCED_CASES[1], completed=True)
+    other_patch = self.enqueue(dict(ADVANCED_CASES[1], include_patch_ids=[1]), completed=True)
+    claimed = self.enqueue(ADVANCED_CASES[0], claimed_by='a')
+    waiting = self.enqueue(ADVANCED_CASES[3])
+    before = overlapping.result.data
+    rng = random.Random(19)
+    matches = [match_payload(match_fields(match_id, rng, WORDS, range(1, 7), (2,))) for match_id in range(1001, 1061)]
+    with contextlib.redirect_stdout(io.StringIO()):
+      importer.import_batch([{'id':1}, {'id':2}], [{'id':2}], matches, [])
+    rows = {row.id:row for row in AdvancedQueryQueue.objects.select_related('result')}
+    #completed results get the counts over the new matches added
+    self.assertNotEqual(rows[overlapping.id].result.data, before)
+    self.assertEqual(rows[overlapping.id].result.data, self.recompute(overlapping))
+    self.assertFalse(rows[overlapping.id].stale)
+    #a filter the new matches miss is left alone
+    self.assertEqual(rows[other_patch.id].result.data, other_patch.result.data)
+    self.assertEqual(rows[other_patch.id].result.data, self.recompute(other_patch))
+    #started before the import, computed again by whoever asks next
+    self.assertTrue(rows[claimed.id].stale)
+    #not started yet, the claim sees the new matches
+    self.assertFalse(rows[waiting.id].stale)
+    self.assertIsNone(rows[waiting.id].result)
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'partitions are PostgreSQL only')
+class PartitionTests(TransactionTestCase):
+  def tearDown(self):
+    if 5 in partitions.existing():
+      partitions.detach(5, drop=True)
+
+  def test_created_before_the_batch(self):
+    seed_matches(20, seed=23)
+    rng = random.Random(29)
+    #match 1 already exists, the batch is rolled back
+    matches = [match_payload(match_fields(match_id, rng, WORDS, range(1, 7), (5,))) for match_id in (1, 1001)]
+    with self.assertRaises(ValidationError), contextlib.redirect_stdout(io.StringIO()):
+      importer.import_batch([], [{'id':5}], matches, [])
+    self.assertFalse(Patches.objects.filter(id=5).exists())
+    #the partitions were committed on their own, before the batch's transaction
+    self.assertIn(5, partitions.existing())
+    self.assertIn(5, partitions._known)
+    self.assertEqual(partitions.ensure([5]), [])
+
+@unittest.skipIf(match_index.BitMap is None, 'pyroaring is not installed')
+class MatchIndexTests(TestCase):
+  def setUp(self):
+    seed_matches(300, seed=37)
+
+  def assertMatchesSql(self, index):
+    for data in ADVANCED_CASES:
+      if int(data.get('left_player_id', 0)):
+        continue
+      with self.subTest(data=data):
+        expected = advanced_queue.run_query_single(data)
+        self.assertTrue(any(expected.values()))
+        self.assertEqual(index.run_query(data), expected)
+
+  def import_matches(self, first_id, count, seed):
+    rng = random.Random(seed)
+    matches = [match_payload(match_fields(match_id, rng, WORDS, range(1, 7), (2,))) for match_id in range(first_id, first_id + count)]
+    with contextlib.redirect_stdout(io.StringIO()):
+      importer.import_batch([], [], matches, [])
+
+  def test_matches_sql(self):
+    self.assertMatchesSql(match_index.build())
+
+  def test_left_player_is_queued(self):
+    index = match_index.build()
+    with override_settings(ADVANCED_QUERY_ENGINE='bitmap'), mock.patch.object(match_index, 'get', return_value=index):
+      self.assertIsNone(match_index.run_query(ADVANCED_CASES[3]))
+      self.assertEqual(match_index.run_query(ADVANCED_CASES[0]), advanced_queue.run_query_single(ADVANCED_CASES[0]))
+
+  def test_catch_up(self):
+    index = match_index.build()
+    self.import_matches(1001, 60, seed=41)
+    #the import logged its ids, the index adds them before answering
+    self.assertEqual(sorted(MatchIndexLog.objects.latest('id').match_ids), list(range(1001, 1061)))
+    self.assertTrue(index.catch_up())
+    self.assertEqual(index.log_id, MatchIndexLog.objects.latest('id').id)
+    self.assertMatchesSql(index)
+    #replaying again changes nothing
+    self.assertTrue(index.catch_up())
+    self.assertMatchesSql(index)
+
+  def test_reset_rebuilds(self):
+    index = match_index.build()
+    Matches.objects.filter(id__lte=30).delete()
+    MatchIndexLog.objects.create(reset=True)
+    self.assertFalse(index.catch_up())
+    with override_settings(ADVANCED_QUERY_ENGINE='bitmap'), mock.patch.object(match_index, 'get', return_value=index) as get, \
+        mock.patch.object(match_index, '_index', index):
+      #not answered from the stale index, the next get() loads a new one
+      self.assertIsNone(match_index.run_query(ADVANCED_CASES[0]))
+      self.assertIsNone(match_index._index)
+      self.assertEqual(get.call_count, 2)
+    self.assertMatchesSql(match_index.build())
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'the advisory lock is PostgreSQL only')
+class MatchIndexLockTests(TransactionTestCase):
+  def held(self, shared):
+    #whether this connection can't take the lock right now
+    with transaction.atomic(), connection.cursor() as cursor:
+      cursor.execute(f'SELECT pg_try_advisory_xact_lock{"_shared" if shared else ""}(%s)', [match_index.LOCK_KEY])
+      return not cursor.fetchone()[0]
+
+  def hold(self, shared, taken, release):
+    try:
+      with transaction.atomic():
+        match_index.lock(shared=shared)
+        taken.set()
+        release.wait(5)
+    finally:
+      connection.close()
+
+  def holding(self, shared):
+    taken, release = threading.Event(), threading.Event()
+    thread = threading.Thread(target=self.hold, args=(shared, taken, release))
+    thread.start()
+    self.assertTrue(taken.wait(5))
+    return thread, release
+
+  def test_import_excludes_answers(self):
+    #an import holds it exclusively, answers and claims wait
+    thread, release = self.holding(shared=False)
+    try:
+      self.assertTrue(self.held(shared=True))
+    finally:
+      release.set()
+      thread.join()
+    #released on commit
+    self.assertFalse(self.held(shared=True))
+
+  def test_answers_share_it(self):
+    #answers don't wait for each other, an import waits for them
+    thread, release = self.holding(shared=True)
+    try:
+      self.assertFalse(self.held(shared=True))
+      self.assertTrue(self.held(shared=False))
+    finally:
+      release.set()
+      thread.join()
+    self.assertFalse(self.held(shared=False))
+
+class ReferenceTests(TestCase):
+  def setUp(self):
+    Patches.objects.bulk_create([Patches(id=1), Patches(id=2)])
+    reference.invalidate()
+
+  def test_cached_between_checks(self):
+    registry = reference.get()
+    self.assertEqual(registry.latest_patch_id, 2)
+    Patches.objects.create(id=3)
+    self.assertIs(reference.get(), registry)
+    #the version check finds nothing changed
+    with mock.patch.object(reference, 'CHECK_SECONDS', 0):
+      self.assertIs(reference.get(), registry)
+
+  def test_invalidated_elsewhere(self):
+    registry = reference.get()
+    Patches.objects.create(id=3)
+    #what invalidate() in another process leaves behind
+    versions.changed(reference.VERSION_KEY)
+    self.assertIs(reference.get(), registry)
+    with mock.patch.object(reference, 'CHECK_SECONDS', 0):
+      self.assertEqual(reference.get().latest_patch_id, 3)
+
+  def test_max_age(self):
+    registry = reference.get()
+    with mock.patch.object(reference, 'CHECK_SECONDS', 0), mock.patch.object(reference, 'MAX_AGE_SECONDS', 0):
+      self.assertIsNot(reference.get(), registry)
+
+  def test_import_of_a_new_patch(self):
+    self.assertNotIn(3, reference.get().patch_ids)
+    match = match_payload(match_fields(1, random.Random(1), patches=(3,)))
+    with self.captureOnCommitCallbacks(execute=True), contextlib.redirect_stdout(io.StringIO()):
+      importer.import_batch([{'id':1}, {'id':2}], [{'id':3}], [match], [])
+    self.assertEqual(reference.get().latest_patch_id, 3)
+
+@override_settings(CACHES={'shared':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache', 'LOCATION':'tiered-tests'}})
+class TieredCacheTests(SimpleTestCase):
+  def cache(self, **options):
+    caches['shared'].clear()
+    return TieredCache(self.id(), {'OPTIONS':dict({'SHARED':'shared'}, **options)})
+
+  def test_lru_eviction(self):
+    entry = len(pickle.dumps('x' * 100, TieredCache.pickle_protocol))
+    cache = self.cache(L1_MAX_BYTES=3 * entry)
+    for key in 'abc':
+      cache.set(key, key * 100)
+    cache.get('a')
+    cache.set('d', 'd' * 100)
+    #b was the least recently used
+    self.assertEqual([key.split(':')[-1] for key in cache._store], ['c', 'a', 'd'])
+    self.assertEqual(cache.stats()['evictions'], 1)
+    self.assertEqual(cache.stats()['bytes'], 3 * entry)
+    #still in L2
+    self.assertEqual(cache.get('b'), 'b' * 100)
+    self.assertEqual(cache.stats()['l2_hits'], 1)
+    #too big for L1 at all
+    cache.set('e', 'e' * 10000)
+    self.assertNotIn(cache.make_key('e'), cache._store)
+    self.assertEqual(cache.get('e'), 'e' * 10000)
+
+  def test_fallthrough(self):
+    cache = self.cache()
+    #written by another process
+    caches['shared'].set('a', 1)
+    self.assertEqual(cache.get('a'), 1)
+    self.assertEqual(cache.get('a'), 1)
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(cache.get('b', 2), 2)
+    stats = cache.stats()
+    self.assertEqual((stats['l2_hits'], stats['l1_hits'], stats['misses']), (1, 1, 2))
+    self.assertEqual(stats['hit_rate'], 0.5)
+    #L1 serves its copy until it expires
+    caches['shared'].set('a', 3)
+    self.assertEqual(cache.get('a'), 1)
+    cache.delete('a')
+    self.assertIsNone(cache.get('a'))
+    self.assertIsNone(caches['shared'].get('a'))
+
+  def test_l1_timeout(self):
+    cache = self.cache(L1_TIMEOUT=0)
+    cache.set('a', 1)
+    caches['shared'].set('a', 2)
+    self.assertEqual(cache.get('a'), 2)
+    self.assertEqual(cache.stats().get('l1_hits', 0), 0)
+
+  def test_incr(self):
+    cache = self.cache()
+    cache.set('a', 1)
+    self.assertEqual(cache.incr('a', 2), 3)
+    self.assertEqual(cache.get('a'), 3)
+
+class ResponseCacheKeyTests(TestCase):
+  def setUp(self):
+    Patches.objects.bulk_create([Patches(id=1), Patches(id=2)])
+    reference.invalidate()
+
+  def key(self, query, name='opening_win_rates', keys=views.OPENING_PARAMETERS):
+    data, error = utils.parse_standard_query_parameters(RequestFactory().get(f'/?{query}'), True)
+    self.assertFalse(error)
+    return response_cache.cache_key(name, data, keys)
+
+  def test_equivalent_parameters(self):
+    for first, second in [
+      ('include_map_ids=29,9&include_ladder_ids=3', 'include_ladder_ids=3&include_map_ids=9,29,9'),
+      ('', 'min_elo=0&max_elo=9000&include_civ_ids=-1&include_patch_ids=2&exclude_mirrors=true'),
+      ('include_civ_ids=4,2&min_elo=1000', 'min_elo=1000&include_civ_ids=2,4'),
+      #not read by the endpoint
+      ('include_opening_ids=1,2', 'include_opening_ids=1,2&include_tech_ids=101&include_player_ids=5'),
+    ]:
+      with self.subTest(first=first, second=second):
+        self.assertEqual(self.key(first), self.key(second))
+
+  def test_different_parameters(self):
+    for first, second in [
+      ('min_elo=1000', 'min_elo=1025'),
+      ('include_patch_ids=1', 'include_patch_ids=1,2'),
+      ('include_map_ids=9', ''),
+      #the order of the openings is the order of the response
+      ('include_opening_ids=1,2', 'include_opening_ids=2,1'),
+    ]:
+      with self.subTest(first=first, second=second):
+        self.assertNotEqual(self.key(first), self.key(second))
+    self.assertNotEqual(self.key('', name='opening_win_rates'), self.key('', name='opening_matchups'))
+
+class MetaSnapshotTests(TestCase):
+  def test_deltas(self):
+    basic = len(utils.Basic_Strategies)
+    rows = [(0, 0, 3, 1, 1000, 4), (0, 1, 3, 1, 1000, 2), (1, basic, 3, 1, 1000, 7), (2, 3, 4, 2, 1050, 0), (2, 3, 4, 2, 1050, 1)]
+    #mirrors count for both sides, followups and empty rows are left out
+    self.assertEqual(rollups.meta_snapshot_deltas(rows, basic),
+                     {(1, 3, 1000, 0):10, (1, 3, 1000, 1):2, (2, 4, 1050, 2):1, (2, 4, 1050, 3):1})
+
+  def test_same_payload_as_the_aggregate(self):
+    seed_matches(400, seed=23)
+    build_rollups()
+    for bucket_size in (50, 100, 150):
+      with self.subTest(bucket_size=bucket_size):
+        matches = OpeningEloWins.objects.filter(patch_number=2, ladder_id=3)\
+            .aggregate(**query_builder.meta_snapshot_aggregates(500, 2500, bucket_size))
+        self.assertTrue(any(matches.values()))
+        expected = {'patch':2, 'meta_list':utils.count_response_to_dict(matches)}
+        self.assertEqual(json.loads(views.MetaSnapshot().content(bucket_size, 2)), json.loads(json.dumps(expected)))
+
+def ndjson(*records):
+  return b''.join(json.dumps(record).encode() + b'\n' for record in records)
+
+class NdjsonImportTests(TestCase):
+  def setUp(self):
+    rng = random.Random(29)
+    self.matches = [match_payload(match_fields(match_id, rng, WORDS)) for match_id in range(1, 6)]
+    self.actions = [{'match':match['id'], 'player':1, 'event_type':3, 'event_id':101, 'time':400000, 'duration':0} for match in self.matches]
+    self.stream = ndjson({'player':{'id':1}}, {'player':{'id':2}}, {'patch':{'id':1}},
+                         *[record for match, action in zip(self.matches, self.actions) for record in ({'match':match}, {'match_player_action':action})])
+
+  def test_bad_lines(self):
+    for name, line in [('array', b'[1]'), ('number', b'3'), ('string', b'"match"'), ('empty object', b'{}'),
+                       ('two records', json.dumps({'player':{'id':3}, 'patch':{'id':2}}).encode()),
+                       ('unknown kind', b'{"civ": {"id": 1}}'), ('invalid json', b'{"player": ')]:
+      with self.subTest(name):
+        records = importer.read_ndjson(io.BytesIO(ndjson({'player':{'id':1}}) + b'\n' + line + b'\n'))
+        self.assertEqual(next(records), ('player', {'id':1}))
+        with self.assertRaisesRegex(ParseError, '^line 3: '):
+          next(records)
+
+  def test_batches(self):
+    totals, batches = {}, []
+    import_batch = importer.import_batch
+    def counting(**batch):
+      #the lists are cleared after each flush
+      batches.append((len(batch['matches']), len(batch['match_player_actions'])))
+      return import_batch(**batch)
+    with contextlib.redirect_stdout(io.StringIO()), mock.patch.object(importer, 'import_batch', counting):
+      importer.import_stream(importer.read_ndjson(io.BytesIO(self.stream)), totals, batch_matches=2)
+    #every 2 matches, the second match's action goes with the next batch
+    self.assertEqual(batches, [(2, 1), (2, 2), (1, 2)])
+    self.assertEqual(totals, {'players':2, 'patches':1, 'matches':5, 'match_player_actions':5})
+    self.assertEqual(Matches.objects.count(), 5)
+    self.assertEqual(MatchPlayerActions.objects.count(), 5)
+
+  def test_endpoint(self):
+    api_key, key = APIKey.objects.create_key(name='tests')
+    def post(body):
+      with contextlib.redirect_stdout(io.StringIO()):
+        return self.client.post(reverse('import_matches-stream'), body, content_type='application/x-ndjson', HTTP_AUTHORIZATION=f'Api-Key {key}')
+    response = post(self.stream + b'[1]\n')
+    #everything before the bad line was one batch that never got flushed
+    self.assertEqual(response.status_code, 400)
+    self.assertEqual(response.json()['imported'], {})
+    self.assertEqual(Matches.objects.count(), 0)
+    response = post(self.stream)
+    self.assertEqual(response.status_code, 201)
+    self.assertEqual(response.json()['imported']['matches'], 5)
+
+class TechRollupImportTests(TestCase):
+  def setUp(self):
+    Techs.objects.bulk_create([Techs(id=101, name='Feudal Age', duration=130), Techs(id=102, name='Castle Age', duration=160)])
+    reference.invalidate()
+
+  def test_actions_of_earlier_batches(self):
+    rng = random.Random(31)
+    matches = [match_fields(match_id, rng, WORDS, range(1, 7), (1, 2)) for match_id in range(1, 61)]
+    actions = {match['id']:[{'match':match['id'], 'player':match[f'player{player}_id'], 'event_type':3, 'event_id':tech,
+                             'time':rng.randrange(300000, 1500000), 'duration':0}
+                            for player in range(1,3) for tech in (101, 102)]
+               for match in matches}
+    batches = [(matches[:30], [action for match_id in range(1, 21) for action in actions[match_id]]),
+               #actions of the first batch's last 10 matches arrive with the next one
+               (matches[30:], [action for match_id in range(21, 61) for action in actions[match_id]])]
+    build_match_index = utils.build_match_index
+    indexed = []
+    def counting(matches):
+      matches = list(matches)
+      indexed.append(len(matches))
+      return build_match_index(matches)
+    with contextlib.redirect_stdout(io.StringIO()), mock.patch.object(utils, 'build_match_index', counting):
+      for batch_matches, batch_actions in batches:
+        importer.import_batch([{'id':1}, {'id':2}], [{'id':1}, {'id':2}], [match_payload(match) for match in batch_matches], batch_actions)
+    #the saved batch once, then only the earlier batch's matches that have actions
+    self.assertEqual(indexed, [30, 30, 10])
+    imported = rollup_rows()['OpeningEloTechs']
+    self.assertTrue(imported)
+    with contextlib.redirect_stdout(io.StringIO()):
+      utils.build_opening_elo_techs()
+    self.assertEqual(imported, rollup_rows()['OpeningEloTechs'])
+
+class RebuildMergeTests(unittest.TestCase):
+  def test_merge_counts(self):
+    total = {(1,):{'victory_count':1, 'loss_count':2}}
+    rebuild.merge_counts(total, {(1,):{'victory_count':3, 'loss_count':0}, (2,):{'victory_count':0, 'loss_count':1}})
+    self.assertEqual(total, {(1,):{'victory_count':4, 'loss_count':2}, (2,):{'victory_count':0, 'loss_count':1}})
+
+  def test_merge_techs(self):
+    total = {(1,):{'average_time':600.0, 'research_count':1}}
+    rebuild.merge_techs(total, {(1,):{'average_time':900.0, 'research_count':2}, (2,):{'average_time':700.0, 'research_count':3}})
+    self.assertAlmostEqual(total[(1,)]['average_time'], 800.0)
+    self.assertEqual(total[(1,)]['research_count'], 3)
+    self.assertEqual(total[(2,)], {'average_time':700.0, 'research_count':3})
+
+class ParallelRebuildTests(TransactionTestCase):
+  #the workers are forked processes reading committed rows
+  def test_same_tables_as_update_intermediary_tables(self):
+    seed_matches(300, seed=37, patches=(1, 2, 3))
+    reference.invalidate()
+    build_rollups()
+    expected = rollup_rows()
+    CivEloWins.objects.all().delete()
+    OpeningEloTechs.objects.all().delete()
+    out = io.StringIO()
+    call_command('rebuild_rollups', workers=2, partitions=5, stdout=out)
+    self.assertIn('rows: civ_elo_wins', out.getvalue())
+    self.assertEqual(rollup_rows(), expected)
+
+class SinglePassRebuildTests(TestCase):
+  def test_merge_join(self):
+    matches = seed_matches(300, seed=41)
+    #id gaps, matches without tech actions and actions that are not techs
+    Matches.objects.filter(id__in=range(1, 301, 3)).delete()
+    MatchPlayerActions.objects.filter(match_id__in=range(2, 301, 7)).delete()
+    MatchPlayerActions.objects.bulk_create([MatchPlayerActions(match_id=fields['id'], player_id=fields['player1_id'], event_type=1, event_id=101,
+                                                               time=1000, duration=0, patch_number=fields['patch_number'])
+                                            for fields in matches[1::5]])
+    reference.invalidate()
+    build_rollups()
+    expected = rollup_rows()
+    self.assertTrue(all(expected.values()))
+    #partitions cut the patches into several id ranges
+    counts = rebuild.rebuild_rollups(1, 7, log=lambda message: None)
+    self.assertEqual(rollup_rows(), expected)
+    self.assertEqual(counts, (len(expected['CivEloWins']), len(expected['OpeningEloWins']),
+                              len(expected['CivOpeningEloWins']), len(expected['OpeningEloTechs'])))
+
+  def test_one_pass(self):
+    seed_matches(100, seed=43)
+    reference.invalidate()
+    techs = sorted(reference.get().techs_by_id)
+    with mock.patch.object(utils, 'match_record', wraps=utils.match_record) as match_record:
+      with self.assertNumQueries(2):
+        rebuild.build_partition(1, (1, 100), techs)
+    #each match classified once for all four rollups
+    self.assertEqual(match_record.call_count, Matches.objects.filter(patch_number=1).count())
+
+@unittest.skipIf(cubes.numpy is None, 'NumPy is not installed')
+class CubesTests(TestCase):
+  @classmethod
+  def setUpTestData(cls):
+    seed_matches(300, seed=47)
+    build_rollups()
+
+  def test_same_rows_as_sql(self):
+    engine = cubes.Cubes(None)
+    for data in PARAMETER_SETS + [query_data(min_elo=5000), query_data(include_map_ids=[9], include_patch_ids=[1, 2])]:
+      with self.subTest(data=data):
+        queryset_filter = query_builder.build_filter(data)
+        self.assertEqual(sorted(engine.civ_rows(data)), sorted(aggregation.civ_rows(CivEloWins.objects.filter(queryset_filter))))
+        self.assertEqual(sorted(engine.opening_rows(data)), sorted(aggregation.opening_rows(OpeningEloWins.objects.filter(queryset_filter))))
+        for tech_ids in ([101], [101, 102, 103]):
+          expected = sorted(aggregation.tech_rows(OpeningEloTechs.objects.filter(queryset_filter).filter(query_builder.opening_tech_filter(tech_ids))))
+          actual = sorted(engine.tech_rows(data, tech_ids))
+          self.assertEqual([row[:2] + row[3:] for row in actual], [row[:2] + row[3:] for row in expected])
+          for actual_row, expected_row in zip(actual, expected):
+            self.assertAlmostEqual(actual_row[2], expected_row[2], delta=1e-6 * abs(expected_row[2]))
+
+  def test_reload_on_data_change(self):
+    with override_settings(OPENING_STATS_ENGINE='numpy'), mock.patch.object(cubes, '_cubes', None), mock.patch.object(cubes, 'CHECK_SECONDS', 0):
+      self.assertTrue(cubes.enabled())
+      engine = cubes.get()
+      self.assertIs(cubes.get(), engine)
+      rows = cubes.civ_rows(query_data())
+      CivEloWins.objects.update(victory_count=F('victory_count') + 1)
+      self.assertEqual(cubes.civ_rows(query_data()), rows)
+      rollups.data_changed()
+      self.assertIsNot(cubes.get(), engine)
+      self.assertEqual([wins for civ, wins, losses in cubes.civ_rows(query_data())],
+                       [wins + CivEloWins.objects.filter(civilization=civ).count() for civ, wins, losses in rows])
+
+class IndexTests(TestCase):
+  def test_indexes_exist(self):
+    for model in (Matches, CivEloWins, OpeningEloWins, CivOpeningEloWins, OpeningEloTechs, AdvancedQueryQueue):
+      with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+      for index in model._meta.indexes:
+        with self.subTest(index=index.name):
+          self.assertIn(index.name, constraints)
+          columns = [model._meta.get_field(field).column for field in index.fields]
+          if connection.vendor == 'postgresql':
+            #SQLite ignores INCLUDE
+            columns += [model._meta.get_field(field).column for field in index.include]
+          self.assertEqual(constraints[index.name]['columns'], columns)
+
+  @unittest.skipUnless(connection.vendor == 'postgresql', 'query plans are checked on PostgreSQL')
+  def test_standard_filters_use_the_patch_indexes(self):
+    data = query_data(min_elo=1000, max_elo=2000, include_patch_ids=[2], include_ladder_ids=[3])
+    #rows over several patches and fresh statistics, on empty tables the planner may pick any index matching the filter
+    seed_matches(300, seed=31, patches=(1, 2, 3, 4))
+    build_rollups()
+    with connection.cursor() as cursor:
+      for model in (CivEloWins, OpeningEloWins, OpeningEloTechs):
+        cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+      #the tables are still small, a sequential scan would win otherwise
+      cursor.execute('SET LOCAL enable_seqscan = off')
+    queries = {
+      'civ_elo_wins_patch_idx':CivEloWins.objects.filter(query_builder.build_filter(data)).values('civilization')
+          .annotate(wins=Sum('victory_count')).order_by(),
+      'opening_elo_wins_patch_idx':OpeningEloWins.objects.filter(query_builder.build_filter(data)).values('opening1_id', 'opening2_id')
+          .annotate(wins=Sum('opening1_victory_count')).order_by(),
+      'opening_elo_techs_patch_idx':OpeningEloTechs.objects.filter(query_builder.build_filter(data)).values('opening_id', 'tech_id')
+          .annotate(total=Sum('count')).order_by(),
+    }
+    for name, queryset in queries.items():
+      with self.subTest(index=name):
+        self.assertIn(name, queryset.explain())
@@ -13,7 +13,10 @@ urlpatterns = [
     path('opening_techs/', views.OpeningTechs.as_view(), name='opening_techs-list'),
     path('meta_snapshot/', views.MetaSnapshot.as_view(), name='meta_snapshot-list'),
     path('last_uploaded_match/', views.LastUploadedMatch.as_view(), name='last_uploaded_match-list'),
+    path('cache_stats/', views.CacheStats.as_view(), name='cache_stats'),
     path('advanced/', csrf_exempt(views.Advanced.as_view()), name='advanced-list'),
+    path('advanced/wait/', csrf_exempt(views.AdvancedWait.as_view()), name='advanced-wait'),
     #POST
     path('import_matches/', views.ImportMatches.as_view(), name='import_matches-list'),
+    path('import_matches/stream/', views.ImportMatchesStream.as_view(), name='import_matches-stream'),
 ]
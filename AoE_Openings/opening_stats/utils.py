@@ -1,13 +1,17 @@
 import time
 import math
+import collections
+import functools
 import gc
 import os
 import json
 import urllib
+import hashlib
 
 from django.db.models import F, Count, Case, When, Q, Sum, Avg, Value, FloatField
 from .AoE_Rec_Opening_Analysis.aoe_replay_stats import OpeningType
-from opening_stats.models import Matches, Techs, MatchPlayerActions, CivEloWins, OpeningEloWins, OpeningEloTechs, Patches, AdvancedQueryQueue, AdvancedQueryResults
+from opening_stats.models import Matches, Techs, MatchPlayerActions, CivEloWins, OpeningEloWins, CivOpeningEloWins, OpeningEloTechs, OpeningMetaSnapshot, Patches, AdvancedQueryQueue, AdvancedQueryResults, MatchIndexLog
+from . import notify, reference, rollups
 import django.utils.timezone
 
 ELO_DELTA = 50
@@ -121,6 +125,61 @@ Followups = [
 
 OPENINGS = Basic_Strategies + Followups
 
+OPENING_FLAG_COUNT = 32
+
+# Opening classification works on the 32 opening flags of a player packed into
+# one int. Each opening is valid if every bit of any of its inclusions is set
+# and no bit of any of its exclusions is set, so precompute the masks once.
+def build_opening_masks():
+  flag_mask = 2**OPENING_FLAG_COUNT - 1
+  masks = []
+  for opening_info in OPENINGS:
+    exclusions = opening_info[2]
+    if not len(exclusions):
+      exclusions = [OpeningType.Unused.value]
+    exclusion_mask = 0
+    for exclusion in exclusions:
+      exclusion_mask |= exclusion & flag_mask
+    masks.append((tuple(inclusion & flag_mask for inclusion in opening_info[1]), exclusion_mask))
+  return masks
+
+OPENING_MASKS = build_opening_masks()
+
+def opening_flag_field_names(player):
+  return [f'player{player}_opening_flag{i}' for i in range(OPENING_FLAG_COUNT)]
+
+def pack_opening_flags(flags):
+  word = 0
+  for i, flag in enumerate(flags):
+    if flag:
+      word |= 1 << i
+  return word
+
+def unpack_opening_flags(word):
+  return [bool(word & (1 << i)) for i in range(OPENING_FLAG_COUNT)]
+
+def opening_flag_word(match, player):
+  return getattr(match, f'player{player}_opening_flags')
+
+#Few distinct flag words exist in practice, so memoize on the word
+@functools.lru_cache(maxsize=None)
+def classify_opening_flag_word(word):
+  valid_openings = []
+  for opening_index, (inclusions, exclusion_mask) in enumerate(OPENING_MASKS):
+    if word & exclusion_mask:
+      continue
+    for inclusion in inclusions:
+      if word & inclusion == inclusion:
+        valid_openings.append(opening_index)
+        break
+  if not len(valid_openings):
+    # Append the unknown opening
+    valid_openings.append(len(OPENINGS)-1)
+  return tuple(valid_openings)
+
+def classify_match_player(match, player):
+  return classify_opening_flag_word(opening_flag_word(match, player))
+
 CIV_IDS_TO_NAMES = {}
 
 with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'AoE_Rec_Opening_Analysis', 'aoe2techtree', 'data','data.json')) as json_file:
@@ -168,7 +227,7 @@ def parse_standard_query_parameters(request, default_exclude_mirrors) :
   data['exclude_mirrors'] = request.GET.get('exclude_mirrors', str(default_exclude_mirrors)).split(",")[0].lower() == "true"
   data['include_ladder_ids'] = list(map(int, request.GET.get('include_ladder_ids', "-1").split(",")))
   #default to newest patch if none selected
-  data['include_patch_ids'] = list(map(int, request.GET.get('include_patch_ids', str(Patches.objects.all().last().id)).split(",")))
+  data['include_patch_ids'] = list(map(int, request.GET.get('include_patch_ids', str(reference.get().latest_patch_id)).split(",")))
 
   data['include_map_ids'] = list(map(int, request.GET.get('include_map_ids', "-1").split(",")))
   data['include_civ_ids'] = list(map(int, request.GET.get('include_civ_ids', "-1").split(",")))
@@ -186,6 +245,31 @@ def parse_standard_query_parameters(request, default_exclude_mirrors) :
   #TODO Add more db level validations
   return data, error_code
 
+#lists that only filter rows, the order of the others decides the order of the response
+UNORDERED_PARAMETERS = ('include_ladder_ids', 'include_patch_ids', 'include_map_ids', 'include_civ_ids', 'exclude_civ_ids', 'clamp_civ_ids')
+
+def canonical_ids(ids):
+  #-1 first means no selection
+  if not len(ids) or ids[0] == -1:
+    return [-1]
+  return sorted(set(ids))
+
+# Same request, same dict: filter lists sorted and deduped. With keys, only
+# those parameters are kept, so parameters an endpoint ignores do not change it.
+def canonical_query_parameters(data, keys=None):
+  keys = data.keys() if keys is None else keys
+  canonical = {}
+  for key in keys:
+    if key in data:
+      canonical[key] = canonical_ids(data[key]) if key in UNORDERED_PARAMETERS else data[key]
+  return canonical
+
+def query_parameters_hash(data):
+  #unlike data_dict_to_query_string, keeps the order of the lists canonical_query_parameters left ordered
+  string = '&'.join(f'{key}={",".join(map(str, value)) if type(value) is list else value}'
+                    for key, value in sorted(data.items()))
+  return hashlib.sha1(string.encode()).hexdigest()
+
 def check_list_of_ints(value):
   if not isinstance(value, list):
     return False
@@ -299,7 +383,7 @@ def count_tech_response_to_dict(sql_response, aoe_data) :
       tech_id = components[2].replace('_',' ')
       if not name in data:
         data[name] = {}
-      data[name][type] = value  + Techs.objects.filter(id=tech_id).first().duration * 1000 if value is not None else value
+      data[name][type] = value  + reference.get().techs_by_id[int(tech_id)]['duration'] * 1000 if value is not None else value
       data[name]["name"] = name
   return list(data.values())
 
@@ -333,113 +417,14 @@ def EnqueueOrCheckAdvancedRequest(data):
     #doesnt exist add a new one to the queue
     adv_query = AdvancedQueryQueue(query=query)
     adv_query.save()
+    notify.notify(notify.QUEUE_CHANNEL, adv_query.id)
   else:
     if adv_query.result is not None:
       return adv_query.result.id
-  #now report depth in queue or return result id if complete
-  ids_in_queue = AdvancedQueryQueue.objects.filter(stale=False, result__isnull=True).order_by('id').values('id')
-  ids_in_queue = [i['id'] for i in ids_in_queue]
-  position_in_queue = list(ids_in_queue).index(adv_query.id)
+  #now report depth in queue, the number of pending requests ahead of this one
+  position_in_queue = AdvancedQueryQueue.objects.filter(stale=False, result__isnull=True, id__lt=adv_query.id).count()
   return position_in_queue
 
-def ProcessNextElementInAdvancedQueue():
-  start = time.time()
-  adv_query = AdvancedQueryQueue.objects.filter(stale=False, result__isnull=True).order_by('id').values('id', 'query').first()
-  if adv_query is None:
-    #Nothing to process, queue is empty
-    return False
-  # process element in queue
-  data = query_string_to_data_dict(adv_query['query'])
-  aggregate_string = "Matches.objects"
-  aggregate_string += generate_filter_statements_from_parameters(data, elo_string="average_elo")
-  aggregate_string += generate_aggregate_statements_for_advanced_queue(data)
-  matches = eval(aggregate_string)
-  #we have a valid search result, so update the queue element with the result
-  result = AdvancedQueryResults(data=matches)
-  result.save()
-  #get queue object so we can update with new foreign key
-  adv_query =  AdvancedQueryQueue.objects.get(pk=adv_query['id'])
-  adv_query.time_completed = django.utils.timezone.now()
-  adv_query.result = result
-  adv_query.save()
-  end = time.time()
-  print(end - start)
-  return True
-
-def generate_q_parameters_for_player(player_id, opening_ids, civ_ids, profile_id):
-  #remove any invalid sets
-  if opening_ids == [-1]:
-    opening_ids.clear()
-  if civ_ids == [-1]:
-    civ_ids.clear()
-   #if no valid sets return
-  if not len(opening_ids) and not len(civ_ids) and not profile_id:
-    return ""
-  ret_string = "("
-  if profile_id:
-    ret_string += f'Q(player{player_id}_id={profile_id})'
-    if opening_ids or civ_ids:
-      ret_string += '&'
-    else:
-      #no other params so close and return
-      ret_string += ")"
-      return ret_string
-  ret_string += "(("
-  for opening_id in opening_ids:
-    ret_string += "("
-    opening = OPENINGS[opening_id]
-    inclusions = opening[1]
-    exclusions = opening[2]
-    if not len(exclusions):
-      exclusions = exclusions + [OpeningType.Unused.value]
-    #convert inclusions to flags
-    for i in range(len(inclusions)):
-      ret_string += '('
-      found = False
-      for j in range(32):
-        if inclusions[i] & 2**j:
-          if found:
-            ret_string += '&'
-          found = True
-          ret_string += f'Q(player{player_id}_opening_flag{j}=True)'
-      # close inclusion
-      ret_string += ')'
-      if i < len(inclusions) - 1:
-        ret_string += '|'
-    # close inclusions
-    ret_string += ')&('
-
-    #convert exclusions to flags
-    for i in range(len(exclusions)):
-      ret_string += '('
-      found = False
-      for j in range(32):
-        if exclusions[i] & 2**j:
-          if found:
-            ret_string += '&'
-          found = True
-          ret_string += f'Q(player{player_id}_opening_flag{j}=False)'
-      # close inclusion
-      ret_string += ')'
-      if i < len(exclusions) - 1:
-        ret_string += '&'
-    # close exclusion
-    ret_string += ')'
-    if not opening_id == opening_ids[-1]:
-      ret_string += '&'
-  if opening_ids and civ_ids:
-    #close openings
-    ret_string += ')&('
-  if civ_ids:
-    for civ_id in civ_ids:
-      ret_string += f'Q(player{player_id}_civilization={civ_id})'
-      if not civ_id == civ_ids[-1]:
-        ret_string += '|'
-
-  ret_string += ')))'
-  return ret_string
-
-
 def civ_and_opening_ids_to_string(civ_ids, opening_ids) :
   ret_string = ""
   if len(civ_ids):
@@ -451,239 +436,24 @@ def civ_and_opening_ids_to_string(civ_ids, opening_ids) :
     ret_string += f'{OPENINGS[opening_ids[0]][0]}'
   return ret_string
 
-
-
-def generate_aggregate_statements_for_advanced_queue(data):
-  aggregate_string = f'.aggregate('
-  for i in range(0, ADVANCED_QUERY_COUNT*2, 2):
-    #Skip row if it doesnt have all data and give blank array so we dont hit a value not exists error
-    if f'include_opening_ids_{i}' not in data and f'include_civ_ids_{i}' not in data and f'include_opening_ids_{i+1}' not in data and f'include_civ_ids_{i+1}' not in data:
-      continue
-    if f'include_opening_ids_{i}' not in data:
-      data[f'include_opening_ids_{i}'] = []
-    if f'include_civ_ids_{i}' not in data:
-      data[f'include_civ_ids_{i}'] = []
-    if f'include_opening_ids_{i+1}' not in data:
-      data[f'include_opening_ids_{i+1}'] = []
-    if f'include_civ_ids_{i+1}' not in data:
-      data[f'include_civ_ids_{i+1}'] = []
-    #enforce that all lists are length 1! - cant just use the validator, need to enforce
-    if len(data[f'include_opening_ids_{i}']) > 1:
-      data[f'include_opening_ids_{i}'] = [data[f'include_opening_ids_{i}'][0]]
-    if len(data[f'include_civ_ids_{i}']) > 1:
-      data[f'include_civ_ids_{i}'] = [data[f'include_civ_ids_{i}'][0]]
-    if len(data[f'include_opening_ids_{i+1}']) > 1:
-      data[f'include_opening_ids_{i+1}'] = [data[f'include_opening_ids_{i+1}'][0]]
-    if len(data[f'include_civ_ids_{i+1}']) > 1:
-      data[f'include_civ_ids_{i+1}'] = [data[f'include_civ_ids_{i+1}'][0]]
-    profile_id = int(data.get('left_player_id',0))
-    if (data[f'include_opening_ids_{i}'] == [-1]
-        and data[f'include_civ_ids_{i}'] == [-1]
-        and data[f'include_opening_ids_{i+1}'] == [-1]
-        and data[f'include_civ_ids_{i+1}'] == [-1]):
-      #if neither has any selections, skip
-      continue
-    left_strings_p1 = generate_q_parameters_for_player(1, data[f'include_opening_ids_{i}'], data[f'include_civ_ids_{i}'], profile_id)
-    left_strings_p2 = generate_q_parameters_for_player(2, data[f'include_opening_ids_{i}'], data[f'include_civ_ids_{i}'], profile_id)
-    right_strings_p1 = generate_q_parameters_for_player(1, data[f'include_opening_ids_{i+1}'], data[f'include_civ_ids_{i+1}'], 0)
-    right_strings_p2 = generate_q_parameters_for_player(2, data[f'include_opening_ids_{i+1}'], data[f'include_civ_ids_{i+1}'], 0)
-
-    # Remove opening mirrors
-    if 'exclude_opening_mirrors' in data and data['exclude_opening_mirrors'] == 'True':
-      left_strings_openings_p1 = generate_q_parameters_for_player(1, data[f'include_opening_ids_{i}'], [], 0)
-      left_strings_openings_p2 = generate_q_parameters_for_player(2, data[f'include_opening_ids_{i}'], [], 0)
-      if left_strings_openings_p1:
-        if right_strings_p1:
-          right_strings_p1 += '&'
-        right_strings_p1 += '~(' + left_strings_openings_p1 + ')'
-      if left_strings_openings_p2:
-        if right_strings_p2:
-          right_strings_p2 += '&'
-        right_strings_p2 += '~(' + left_strings_openings_p2 + ')'
-
-    matchup_name = civ_and_opening_ids_to_string(data[f'include_civ_ids_{i}'], data[f'include_opening_ids_{i}'])
-    matchup_name += '__vs__'
-    matchup_name += civ_and_opening_ids_to_string(data[f'include_civ_ids_{i+1}'], data[f'include_opening_ids_{i+1}'])
-    suffix = f'___{i}'
-    #total matches
-    aggregate_string += f'{matchup_name}_total_{suffix}=Count(Case(When('
-    if left_strings_p1:
-      aggregate_string += left_strings_p1
-    if left_strings_p1 and right_strings_p2:
-      aggregate_string += '&'
-    if right_strings_p2:
-      aggregate_string += right_strings_p2
-    aggregate_string += ',then=1),'
-    #close when, do other side
-    aggregate_string += 'When('
-    if left_strings_p2:
-      aggregate_string += left_strings_p2
-    if left_strings_p2 and right_strings_p1:
-      aggregate_string += '&'
-    if right_strings_p1:
-      aggregate_string += right_strings_p1
-    aggregate_string += ',then=1))),'
-
-    #p1 wins
-    aggregate_string += f'{matchup_name}_wins_{suffix}=Count(Case(When('
-    if left_strings_p1:
-      aggregate_string += left_strings_p1
-    if left_strings_p1 and right_strings_p2:
-      aggregate_string += '&'
-    if right_strings_p2:
-      aggregate_string += right_strings_p2
-    aggregate_string += '& Q(player1_victory=True)'
-    aggregate_string += ',then=1),'
-    #close when, do other side
-    aggregate_string += 'When('
-    if left_strings_p2:
-      aggregate_string += left_strings_p2
-    if left_strings_p2 and right_strings_p1:
-      aggregate_string += '&'
-    if right_strings_p1:
-      aggregate_string += right_strings_p1
-    aggregate_string += '& Q(player2_victory=True)'
-    aggregate_string += ',then=1))),'
-
-    #p1 losses
-    aggregate_string += f'{matchup_name}_losses_{suffix}=Count(Case(When('
-    if left_strings_p1:
-      aggregate_string += left_strings_p1
-    if left_strings_p1 and right_strings_p2:
-      aggregate_string += '&'
-    if right_strings_p2:
-      aggregate_string += right_strings_p2
-    aggregate_string += '& Q(player1_victory=False)'
-    aggregate_string += ',then=1),'
-    #close when, do other side
-    aggregate_string += 'When('
-    if left_strings_p2:
-      aggregate_string += left_strings_p2
-    if left_strings_p2 and right_strings_p1:
-      aggregate_string += '&'
-    if right_strings_p1:
-      aggregate_string += right_strings_p1
-    aggregate_string += '& Q(player2_victory=False)'
-    aggregate_string += ',then=1))),'
-
-  #close aggregate
-  aggregate_string += ')'
-  return aggregate_string
-
-
-def generate_aggregate_statements_from_basic_openings(data):
-  #Have to compare counts against basic strategies to enforce uniqueness
-  aggregate_string = f'.aggregate(total=Sum(Case(When((Q(opening1_id__lt={len(Basic_Strategies)}) | Q(opening1_id__gte={len(OPENINGS)-2}))' \
-                     f' & (Q(opening2_id__lt={len(Basic_Strategies)}) | Q(opening2_id__gte={len(OPENINGS)-2})), then=F("opening1_victory_count") + F("opening1_loss_count")))),'
-  #If user defined openings, then use those, otherwise use the basics
-  if len(data['include_opening_ids']) and data['include_opening_ids'][0] != -1:
-    strategies = data['include_opening_ids']
-  else:
-    strategies = range(len(Basic_Strategies + Followups))
-  for opening_id in strategies:
-      opening_name = OPENINGS[opening_id][0]
-      aggregate_string+=f'{opening_name}_total=Sum(Case('
-      #need to count each player twice In the case of mirrors
-      aggregate_string+=f'When(Q(opening1_id={opening_id}) & Q(opening2_id={opening_id}), then=F("opening1_victory_count") + F("opening1_loss_count") + F("opening2_victory_count") + F("opening2_loss_count")),'
-      aggregate_string+=f'When(Q(opening1_id={opening_id}) & (Q(opening2_id__lt={len(Basic_Strategies)}) | Q(opening2_id__gte={len(OPENINGS)-2})), then=F("opening1_victory_count") + F("opening1_loss_count")),'
-      aggregate_string+=f'When(Q(opening2_id={opening_id}) & (Q(opening1_id__lt={len(Basic_Strategies)}) | Q(opening1_id__gte={len(OPENINGS)-2})), then=F("opening2_victory_count") + F("opening2_loss_count")))),'
-
-      aggregate_string+=f'{opening_name}_wins=Sum(Case('
-      #ignore mirror wins
-      aggregate_string+=f'When(Q(opening1_id={opening_id}) & Q(opening2_id={opening_id}), then=0),'
-      aggregate_string+=f'When(Q(opening1_id={opening_id}) & (Q(opening2_id__lt={len(Basic_Strategies)}) | Q(opening2_id__gte={len(OPENINGS)-2})), then=F("opening1_victory_count")),'
-      aggregate_string+=f'When(Q(opening2_id={opening_id}) & (Q(opening1_id__lt={len(Basic_Strategies)}) | Q(opening1_id__gte={len(OPENINGS)-2})), then=F("opening2_victory_count")))),'
-
-      aggregate_string+=f'{opening_name}_losses=Sum(Case('
-      #ignore mirror wins
-      aggregate_string+=f'When(Q(opening1_id={opening_id}) & Q(opening2_id={opening_id}), then=0),'
-      aggregate_string+=f'When(Q(opening1_id={opening_id}) & (Q(opening2_id__lt={len(Basic_Strategies)}) | Q(opening2_id__gte={len(OPENINGS)-2})), then=F("opening1_loss_count")),'
-      aggregate_string+=f'When(Q(opening2_id={opening_id}) & (Q(opening1_id__lt={len(Basic_Strategies)}) | Q(opening1_id__gte={len(OPENINGS)-2})), then=F("opening2_loss_count")))),'
-
-
-      opening_id += 1
-  #close aggregate
-  aggregate_string+=')'
-  return aggregate_string
-
-def generate_aggregate_statements_from_opening_matchups(data):
-  aggregate_string = f'.aggregate(total=Sum(Case(When(Q(opening1_id__lt={len(Basic_Strategies)}) & Q(opening2_id__lt={len(Basic_Strategies)}), then=F("opening1_victory_count") + F("opening1_loss_count")))),'
-  #If user defined openings, then use those, otherwise use the basics
-  if len(data['include_opening_ids']) and data['include_opening_ids'][0] != -1:
-    strategies = data['include_opening_ids']
-  else:
-    strategies = range(len(Basic_Strategies));
-  for i in strategies:
-    opening1_name = OPENINGS[i][0]
-    for j in strategies[strategies.index(i):]:
-      opening2_name = OPENINGS[j][0]
-      aggregate_string+=f'{opening1_name}_vs_{opening2_name}_total=Sum(Case('
-      aggregate_string+=f'When(Q(opening1_id={i}) & Q(opening2_id={j}), then=F("opening1_victory_count") + F("opening1_loss_count")),'
-      if i != j:
-        aggregate_string+=f'When(Q(opening2_id={i}) & Q(opening1_id={j}), then=F("opening2_victory_count") + F("opening2_loss_count")))),'
-      else:
-        aggregate_string+=')),'
-
-      aggregate_string+=f'{opening1_name}_vs_{opening2_name}_wins=Sum(Case('
-      aggregate_string+=f'When(Q(opening1_id={i}) & Q(opening2_id={j}), then=F("opening1_victory_count")),'
-      if i != j:
-        aggregate_string+=f'When(Q(opening2_id={i}) & Q(opening1_id={j}), then=F("opening2_victory_count")))),'
-      else:
-        aggregate_string+=')),'
-
-  #close aggregate
-  aggregate_string+=')'
-  return aggregate_string
-
-def generate_filter_statements_from_parameters(data, table_prefix = "", include_opening_ids = True, elo_string = "elo"):
-    filter_string = ".filter("
-
-    if 'include_ladder_ids' in data and len(data['include_ladder_ids']) and data['include_ladder_ids'][0] != -1:
-        count = 0
-        for ladder_id in data['include_ladder_ids']:
-            if count >0 and count < len(data['include_ladder_ids']):
-                filter_string += ' | '
-            filter_string += f'Q({table_prefix}ladder_id={ladder_id})'
-            count += 1
-        filter_string += ","
-
-    if 'include_patch_ids' in data and len(data['include_patch_ids']) and data['include_patch_ids'][0] != -1:
-        count = 0
-        for patch_id in data['include_patch_ids']:
-            if count >0 and count < len(data['include_patch_ids']):
-                filter_string += ' | '
-            filter_string += f'Q({table_prefix}patch_number={patch_id})'
-            count += 1
-        filter_string += ","
-
-    if 'include_map_ids' in data and len(data['include_map_ids']) and data['include_map_ids'][0] != -1:
-        count = 0
-        for map_id in data['include_map_ids']:
-            if count >0 and count < len(data['include_map_ids']):
-                filter_string += ' | '
-            filter_string += f'Q({table_prefix}map_id={map_id})'
-            count += 1
-        filter_string += ","
-    if 'exclude_civ_mirrors' in data and data['exclude_civ_mirrors'] == 'True':
-      filter_string += f'~Q({table_prefix}player1_civilization=F("{table_prefix}player2_civilization")),'
-
-    filter_string += f'{table_prefix}{elo_string}__gte={data["min_elo"]},'
-    filter_string += f'{table_prefix}{elo_string}__lte={data["max_elo"]}'
-    filter_string += ')'
-    return filter_string
-
 def clear_intermediary_tables():
   CivEloWins.objects.all().delete()
   OpeningEloWins.objects.all().delete()
+  CivOpeningEloWins.objects.all().delete()
   OpeningEloTechs.objects.all().delete()
+  OpeningMetaSnapshot.objects.all().delete()
 
 def clear_main_tables():
   Matches.objects.all().delete()
   MatchPlayerActions.objects.all().delete()
+  #match indexes rebuild, see match_index.py
+  MatchIndexLog.objects.create(reset=True)
 
 def update_intermediary_tables():
   build_civ_elo_wins()
   build_opening_elo_wins()
+  build_civ_opening_elo_wins()
+  build_opening_meta_snapshot()
   build_opening_elo_techs()
 
 def build_civ_elo_win_for_match(match, data_dict):
@@ -741,79 +511,19 @@ def build_civ_elo_wins():
           continue
         build_civ_elo_win_for_match(match, data_dict)
 
-    # Now insert records into db
-    print("Creating db objects")
-    count = 0
-    objects = []
-    for k,v in data_dict.items():
-        if count % 100 == 0:
-          print (f'({count} / {len(data_dict)})')
-        count += 1
-        objects.append(CivEloWins(civilization=k[0],
-                                  map_id=k[1],
-                                  ladder_id=k[2],
-                                  patch_number=k[3],
-                                  elo=k[4],
-                                  victory_count=v['victory_count'],
-                                  loss_count=v['loss_count']))
-
-    # drop all previous records and rebuild
-    CivEloWins.objects.all().delete()
-
+    # Now swap in the new records
     print("Inserting Objects")
-    CivEloWins.objects.bulk_create(objects)
+    rollups.replace_table(CivEloWins, rollups.CIV_ELO_WINS_KEYS + ['victory_count', 'loss_count'],
+                          (k + (v['victory_count'], v['loss_count']) for k,v in data_dict.items()))
     end = time.time()
     print("build_civ_elo_wins - elapsed time", end - start)
 
-def build_opening_elo_win_for_match(match, data_dict):
-    #round down to nearest delta
-    elo = ELO_DELTA * math.floor(match.average_elo/ELO_DELTA)
-    player_openings = []
-    #Get players! 1-indexed
-    for player in range(1,3):
-        valid_openings = []
-        opening_index = 0
-        #Get openings!
-        for opening_info in OPENINGS:
-            valid_opening = False
-            #opening inclusions
-            for inclusion in opening_info[1]:
-                valid_inclusion = True
-                if not valid_inclusion:
-                    break
-                #for each bit in bit set
-                for i in range(32):
-                    #if true bit
-                    if inclusion & 2**i:
-                        if eval(f'match.player{player}_opening_flag{i}') == False:
-                            valid_inclusion = False
-                            break
-                #Opening is valid if any inclusions are true
-                valid_opening |= valid_inclusion
-            exclusions = opening_info[2]
-
-            if not len(exclusions):
-               exclusions = [OpeningType.Unused.value]
-            #opening exclusions
-            for exclusion in exclusions:
-                if not valid_opening:
-                    break
-                #for each bit in bit set
-                for i in range(32):
-                    #if true bit
-                    if exclusion & 2**i:
-                        if eval(f'match.player{player}_opening_flag{i}') == True:
-                            valid_opening = False
-                            break
-            if valid_opening:
-                valid_openings.append(opening_index)
-            opening_index += 1
-        if not len(valid_openings):
-          # Append the unknown opening
-          valid_openings.append(len(OPENINGS)-1)
-        player_openings.append(valid_openings)
+def build_opening_elo_win_for_match(match, data_dict, player_openings=None):
     #round down to nearest delta
     elo = ELO_DELTA * math.floor(match.average_elo/ELO_DELTA)
+    #Get players! 1-indexed, unless already classified (MatchRecord.openings)
+    if player_openings is None:
+        player_openings = [classify_match_player(match, player) for player in range(1,3)]
     #Every player 1 opening played against every player 2 opening
     for p1_opening in player_openings[0]:
         for p2_opening in player_openings[1]:
@@ -868,91 +578,118 @@ def build_opening_elo_wins():
           continue
         build_opening_elo_win_for_match(match, data_dict)
 
-    # Now insert records into db
-    print("Creating db objects")
-    count = 0
-    objects = []
-    def generator():
-        for k,v in data_dict.items():
-            (yield OpeningEloWins(opening1_id=k[0],
-                                  opening2_id=k[1],
-                                  map_id=k[2],
-                                  ladder_id=k[3],
-                                  patch_number=k[4],
-                                  elo=k[5],
-                                  opening1_victory_count=v['opening1_victory_count'],
-                                  opening1_loss_count=v['opening1_loss_count'],
-                                  opening2_victory_count=v['opening2_victory_count'],
-                                  opening2_loss_count=v['opening2_loss_count']))
-
-    # drop all records and rebuild
-    OpeningEloWins.objects.all().delete()
-    OpeningEloWins.objects.bulk_create(generator())
+    # Now swap in the new records
+    print("Inserting Objects")
+    value_columns = ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']
+    rollups.replace_table(OpeningEloWins, rollups.OPENING_ELO_WINS_KEYS + value_columns,
+                          (k + tuple(v[column] for column in value_columns) for k,v in data_dict.items()))
     end = time.time()
     print("build_civ_elo_wins - elapsed time", end - start)
 
-def build_opening_elo_techs_for_match_and_action(match, action, data_dict, previous_match_id, previous_match_openings):
-    #round down to nearest delta
+def build_civ_opening_elo_win_for_match(match, data_dict, player_openings=None):
+    #same pairs and sides as build_opening_elo_win_for_match, each opening keyed with its player's civ
     elo = ELO_DELTA * math.floor(match.average_elo/ELO_DELTA)
-    if match.id == previous_match_id and action.player_id in previous_match_openings:
-        player_openings = previous_match_openings
-    else:
-        player_openings = {}
-        #Get players! 1-indexed
-        for player in range(1,3):
-            opening_index = 0
-            player_id = eval(f'match.player{player}_id')
-            if player_id not in player_openings:
-                player_openings[player_id] = []
-            #Get openings!
-            for opening_info in OPENINGS:
-                valid_opening = False
-                #opening inclusions
-                for inclusion in opening_info[1]:
-                    valid_inclusion = True
-                    if not valid_inclusion:
-                        break
-                    #for each bit in bit set
-                    for i in range(32):
-                        #if true bit
-                        if inclusion & 2**i:
-                            if eval(f'match.player{player}_opening_flag{i}') == False:
-                                valid_inclusion = False
-                                break
-                    #Opening is valid if any inclusions are true
-                    valid_opening |= valid_inclusion
-                exclusions = opening_info[2]
-
-                if not len(exclusions):
-                   exclusions = [OpeningType.Unused.value]
-                #opening exclusions
-                for exclusion in exclusions:
-                    if not valid_opening:
-                        break
-                    #for each bit in bit set
-                    for i in range(32):
-                        #if true bit
-                        if exclusion & 2**i:
-                            if eval(f'match.player{player}_opening_flag{i}') == True:
-                                valid_opening = False
-                                break
-                if valid_opening:
-                    player_openings[player_id].append(opening_index)
-                opening_index += 1
-            if not len(player_openings[player_id]):
-                # Append the unknown opening
-                player_openings[player_id].append(len(OPENINGS)-1)
+    if player_openings is None:
+        player_openings = [classify_match_player(match, player) for player in range(1,3)]
+    for p1_opening in player_openings[0]:
+        for p2_opening in player_openings[1]:
+            #greater opening second, its civ goes with it
+            if p1_opening > p2_opening:
+                key = (p2_opening,
+                       match.player2_civilization,
+                       p1_opening,
+                       match.player1_civilization)
+                p1_win = match.player2_victory
+            else:
+                key = (p1_opening,
+                       match.player1_civilization,
+                       p2_opening,
+                       match.player2_civilization)
+                p1_win = match.player1_victory
+            key += (match.map_id,
+                    match.ladder_id,
+                    match.patch_number,
+                    elo)
+            if key not in data_dict:
+                data_dict[key] = {'opening1_victory_count':0,
+                                  "opening1_loss_count":0,
+                                  "opening2_victory_count":0,
+                                  "opening2_loss_count":0}
+            if p1_win:
+                data_dict[key]['opening1_victory_count'] += 1
+                data_dict[key]['opening2_loss_count'] += 1
+            else:
+                data_dict[key]['opening1_loss_count'] += 1
+                data_dict[key]['opening2_victory_count'] += 1
+
+# Run this function to build the civ opening elo wins table for civ filtered opening stats
+def build_civ_opening_elo_wins():
+    start = time.time()
+
+    #Use tuples as key to store data in the interim
+    # (opening1_id, opening1_civilization, opening2_id, opening2_civilization, map_id, ladder_id, patch_number, elo)
+    # ["opening1_victory_count", "opening1_loss_count"]
+    data_dict = {}
+
+    print("Reading from db")
+    total = Matches.objects.all().count()
+    count = 0
+    for match in Matches.objects.all().iterator():
+        if count % 5000 == 0:
+          print (f'({count} / {total})')
+          gc.collect()
+        count += 1
+        if type(match.average_elo) == str:
+          #at least one element has a string elo???? throw it away
+          continue
+        build_civ_opening_elo_win_for_match(match, data_dict)
+
+    # Now swap in the new records
+    print("Inserting Objects")
+    value_columns = ['opening1_victory_count', 'opening1_loss_count', 'opening2_victory_count', 'opening2_loss_count']
+    rollups.replace_table(CivOpeningEloWins, rollups.CIV_OPENING_ELO_WINS_KEYS + value_columns,
+                          (k + tuple(v[column] for column in value_columns) for k,v in data_dict.items()))
+    end = time.time()
+    print("build_civ_opening_elo_wins - elapsed time", end - start)
+
+# Derived from opening_elo_wins, run after build_opening_elo_wins
+def build_opening_meta_snapshot():
+    start = time.time()
+    count = rollups.rebuild_opening_meta_snapshot(len(Basic_Strategies))
+    end = time.time()
+    print(f"build_opening_meta_snapshot - {count} rows, elapsed time", end - start)
+
+# Compact copy of what the tech rollup needs from a match, with the openings
+# of both players classified once instead of on every action
+#openings: per player, 1-indexed order; player_openings: by player id
+MatchRecord = collections.namedtuple('MatchRecord', ['map_id', 'ladder_id', 'patch_number', 'elo', 'openings', 'player_openings'])
+
+#columns match_record reads, for .only()
+MATCH_RECORD_FIELDS = ['id', 'map_id', 'ladder_id', 'patch_number', 'average_elo',
+                       'player1_id', 'player1_opening_flags', 'player2_id', 'player2_opening_flags']
+
+def match_record(match):
     #round down to nearest delta
     elo = ELO_DELTA * math.floor(match.average_elo/ELO_DELTA)
-    #get techs for match id
+    openings = [classify_match_player(match, player) for player in range(1,3)]
+    player_openings = {}
+    #Get players! 1-indexed
+    for player in range(1,3):
+        player_id = getattr(match, f'player{player}_id')
+        player_openings.setdefault(player_id, []).extend(openings[player - 1])
+    return MatchRecord(match.map_id, match.ladder_id, match.patch_number, elo, openings, player_openings)
+
+def build_match_index(matches):
+    return {match.id:match_record(match) for match in matches}
 
-    for opening in player_openings[action.player_id]: #1 indexed, remember
+def build_opening_elo_techs_for_record_and_action(record, action, data_dict):
+    for opening in record.player_openings[action.player_id]: #1 indexed, remember
         key = (opening,
                action.event_id,
-               match.map_id,
-               match.ladder_id,
-               match.patch_number,
-               elo)
+               record.map_id,
+               record.ladder_id,
+               record.patch_number,
+               record.elo)
         if key not in data_dict:
             data_dict[key] = {'research_count':0,
                               "average_time":0}
@@ -961,7 +698,6 @@ def build_opening_elo_techs_for_match_and_action(match, action, data_dict, previ
             ((data_dict[key]['average_time'] * data_dict[key]['research_count']) + action.time) /\
             (data_dict[key]['research_count']+1)
         data_dict[key]['research_count'] += 1
-    return player_openings
 
 def build_opening_elo_techs_for_mpa_match(match, match_player_action, data_dict, previous_match_id, previous_match_openings):
     #round down to nearest delta
@@ -972,50 +708,8 @@ def build_opening_elo_techs_for_mpa_match(match, match_player_action, data_dict,
         player_openings = {}
         #Get players! 1-indexed
         for player in range(1,3):
-            opening_index = 0
-            player_id = eval(f'match.player{player}_id')
-            if player_id not in player_openings:
-                player_openings[player_id] = []
-            #Get openings!
-            for opening_info in OPENINGS:
-                valid_opening = False
-                #opening inclusions
-                for inclusion in opening_info[1]:
-                    valid_inclusion = True
-                    if not valid_inclusion:
-                        break
-                    #for each bit in bit set
-                    for i in range(32):
-                        #if true bit
-                        if inclusion & 2**i:
-                            if eval(f'match.player{player}_opening_flag{i}') == False:
-                                valid_inclusion = False
-                                break
-                    #Opening is valid if any inclusions are true
-                    valid_opening |= valid_inclusion
-                exclusions = opening_info[2]
-
-                if not len(exclusions):
-                   exclusions = [OpeningType.Unused.value]
-                #opening exclusions
-                for exclusion in exclusions:
-                    if not valid_opening:
-                        break
-                    #for each bit in bit set
-                    for i in range(32):
-                        #if true bit
-                        if exclusion & 2**i:
-                            if eval(f'match.player{player}_opening_flag{i}') == True:
-                                valid_opening = False
-                                break
-                if valid_opening:
-                    player_openings[player_id].append(opening_index)
-                opening_index += 1
-            if not len(player_openings[player_id]):
-                # Append the unknown opening
-                player_openings[player_id].append(len(OPENINGS)-1)
-    #round down to nearest delta
-    elo = ELO_DELTA * math.floor(match.average_elo/ELO_DELTA)
+            player_id = getattr(match, f'player{player}_id')
+            player_openings.setdefault(player_id, []).extend(classify_match_player(match, player))
     #get techs for match id
 
     for opening in player_openings[match_player_action.player_id]: #1 indexed, remember
@@ -1068,23 +762,9 @@ def build_opening_elo_techs():
         previous_match_openings = build_opening_elo_techs_for_mpa_match(match, match_player_action, data_dict, previous_match_id, previous_match_openings)
         previous_match_id = match.id
 
-    # Now insert records into db
-    print("Creating db objects")
-    count = 0
-    objects = []
-    def generator():
-        for k,v in data_dict.items():
-            (yield OpeningEloTechs(opening_id=k[0],
-                                   tech_id=k[1],
-                                   map_id=k[2],
-                                   ladder_id=k[3],
-                                   patch_number=k[4],
-                                   elo=k[5],
-                                   average_time=v['average_time'],
-                                   count=v['research_count']))
-
-    # drop all records and rebuild
-    OpeningEloTechs.objects.all().delete()
-    OpeningEloTechs.objects.bulk_create(generator(), batch_size=10000)
+    # Now swap in the new records
+    print("Inserting Objects")
+    rollups.replace_table(OpeningEloTechs, rollups.OPENING_ELO_TECHS_KEYS + ['average_time', 'count'],
+                          (k + (v['average_time'], v['research_count']) for k,v in data_dict.items()))
     end = time.time()
     print("build_opening_elo_techs - elapsed time", end - start)
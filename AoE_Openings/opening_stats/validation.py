@@ -0,0 +1,240 @@
+import datetime
+import re
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import BooleanField
+from opening_stats.models import Matches, MatchPlayerActions, Players, Patches
+from . import utils
+
+# Schema driven validation of the import payload. A Schema is built once from
+# the model's concrete fields and checks plain dicts against it: types and
+# ranges per field, then an optional clean() for cross field rules. It accepts
+# the same input as the ModelSerializers (numeric strings, DRF's boolean
+# spellings, ISO datetimes) and reports errors in the same words, but returns
+# dicts of column values ready for bulk_create. Checks that need the database
+# (foreign keys, unique ids and unique_together) are done per batch by check_* with one query
+# each instead of one query per row and field.
+
+INTEGER_RANGES = {
+  models.IntegerField:(-2**31, 2**31 - 1),
+  models.AutoField:(-2**31, 2**31 - 1),
+  models.BigIntegerField:(-2**63, 2**63 - 1),
+  models.BigAutoField:(-2**63, 2**63 - 1),
+  models.ForeignKey:(-2**63, 2**63 - 1),
+}
+RE_DECIMAL = re.compile(r'\.0*\s*$')
+MAX_STRING_LENGTH = 1000
+
+def parse_integer(value):
+  if type(value) is int:
+    return value
+  #DRF IntegerField: integral floats and numeric strings, no booleans
+  if isinstance(value, bool) or (isinstance(value, str) and len(value) > MAX_STRING_LENGTH):
+    raise ValueError('A valid integer is required.')
+  try:
+    return int(RE_DECIMAL.sub('', str(value)))
+  except (ValueError, TypeError):
+    raise ValueError('A valid integer is required.')
+
+def parse_float(value):
+  if type(value) is float:
+    return value
+  if isinstance(value, str) and len(value) > MAX_STRING_LENGTH:
+    raise ValueError('A valid number is required.')
+  try:
+    return float(value)
+  except (ValueError, TypeError):
+    raise ValueError('A valid number is required.')
+
+def parse_boolean(value):
+  try:
+    if value in BooleanField.TRUE_VALUES:
+      return True
+    if value in BooleanField.FALSE_VALUES:
+      return False
+  except TypeError:
+    #unhashable
+    pass
+  raise ValueError('Must be a valid boolean.')
+
+def parse_datetime_value(value):
+  if isinstance(value, datetime.datetime):
+    parsed = value
+  else:
+    try:
+      parsed = parse_datetime(value)
+    except (ValueError, TypeError):
+      parsed = None
+    if parsed is None:
+      raise ValueError('Datetime has wrong format.')
+  if settings.USE_TZ and timezone.is_naive(parsed):
+    parsed = timezone.make_aware(parsed)
+  return parsed
+
+PARSERS = {
+  models.BooleanField:parse_boolean,
+  models.IntegerField:parse_integer,
+  models.AutoField:parse_integer,
+  models.BigIntegerField:parse_integer,
+  models.BigAutoField:parse_integer,
+  models.ForeignKey:parse_integer,
+  models.FloatField:parse_float,
+  models.DateTimeField:parse_datetime_value,
+}
+
+class Schema:
+  def __init__(self, model, fields=None, optional=(), clean=None):
+    #fields: names to accept, every concrete non auto field if None; optional: names not required
+    self.model = model
+    self.clean = clean
+    self.fields = []
+    self.foreign_keys = []
+    for field in model._meta.concrete_fields:
+      if fields is not None and field.name not in fields:
+        continue
+      if fields is None and isinstance(field, models.AutoField):
+        continue
+      field_type = type(field)
+      min_value, max_value = INTEGER_RANGES.get(field_type, (None, None))
+      #a listed primary key is the id given by the uploader
+      required = field.primary_key or not (field.null or field.blank or field.has_default() or field.name in optional)
+      self.fields.append((field.name, field.attname, PARSERS[field_type], min_value, max_value, required, field.null))
+      if field.is_relation:
+        self.foreign_keys.append((field.name, field.attname, field.related_model))
+
+  def validate(self, records, label):
+    #returns a list of {attname: value}, raises ValidationError({label: {index: errors}})
+    rows = []
+    errors = {}
+    for index, record in enumerate(records):
+      if not isinstance(record, dict):
+        errors[index] = {'non_field_errors':[f'Invalid data. Expected a dictionary, but got {type(record).__name__}.']}
+        continue
+      row = {}
+      row_errors = {}
+      for name, attname, parse, min_value, max_value, required, nullable in self.fields:
+        if name not in record:
+          if required:
+            row_errors[name] = ['This field is required.']
+          continue
+        value = record[name]
+        if value is None:
+          if nullable:
+            row[attname] = None
+          else:
+            row_errors[name] = ['This field may not be null.']
+          continue
+        try:
+          value = parse(value)
+        except ValueError as e:
+          row_errors[name] = [str(e)]
+          continue
+        if min_value is not None and value < min_value:
+          row_errors[name] = [f'Ensure this value is greater than or equal to {min_value}.']
+        elif max_value is not None and value > max_value:
+          row_errors[name] = [f'Ensure this value is less than or equal to {max_value}.']
+        else:
+          row[attname] = value
+      if not row_errors and self.clean is not None:
+        try:
+          self.clean(row)
+        except ValidationError as e:
+          row_errors = e.detail
+      if row_errors:
+        errors[index] = row_errors
+      else:
+        rows.append(row)
+    if errors:
+      raise ValidationError({label:errors})
+    return rows
+
+def resolve_opening_flags(attrs):
+  #uploaders may send the 32 booleans per player, the packed word, or both
+  for player in range(1,3):
+    names = utils.opening_flag_field_names(player)
+    packed_name = f'player{player}_opening_flags'
+    present = [name in attrs for name in names]
+    if all(present):
+      word = utils.pack_opening_flags(attrs[name] for name in names)
+      if packed_name in attrs and attrs[packed_name] != word:
+        raise ValidationError({packed_name:f'Does not match player{player}_opening_flag0-31.'})
+      attrs[packed_name] = word
+    elif any(present):
+      raise ValidationError({packed_name:f'Send all of player{player}_opening_flag0-31 or none of them.'})
+    elif packed_name in attrs:
+      #keep the boolean columns filled for older readers
+      attrs.update(zip(names, utils.unpack_opening_flags(attrs[packed_name])))
+    else:
+      raise ValidationError({packed_name:'This field is required.'})
+  return attrs
+
+def check_packed_flags(attrs):
+  for player in range(1,3):
+    packed_name = f'player{player}_opening_flags'
+    if attrs.get(packed_name, 0) < 0:
+      raise ValidationError({packed_name:['Ensure this value is greater than or equal to 0.']})
+    if attrs.get(packed_name, 0) > 2**utils.OPENING_FLAG_COUNT - 1:
+      raise ValidationError({packed_name:[f'Ensure this value is less than or equal to {2**utils.OPENING_FLAG_COUNT - 1}.']})
+  return resolve_opening_flags(attrs)
+
+PLAYERS = Schema(Players, fields=['id'])
+PATCHES = Schema(Patches, fields=['id'])
+MATCHES = Schema(Matches,
+                 fields=[field.name for field in Matches._meta.concrete_fields],
+                 optional=[name for player in range(1,3) for name in utils.opening_flag_field_names(player)],
+                 clean=check_packed_flags)
+#patch_number is copied from the match by the importer
+MATCH_PLAYER_ACTIONS = Schema(MatchPlayerActions,
+                              fields=[field.name for field in MatchPlayerActions._meta.concrete_fields
+                                      if field.name not in ('id', 'patch_number')])
+
+def check_foreign_keys(schema, rows, label, known=None):
+  #known: {field name: ids that exist but are not committed yet}, one query per foreign key
+  errors = {}
+  for name, attname, related_model in schema.foreign_keys:
+    ids = {row[attname] for row in rows}
+    ids -= (known or {}).get(name, set())
+    if ids:
+      ids -= set(related_model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+    if not ids:
+      continue
+    for index, row in enumerate(rows):
+      if row[attname] in ids:
+        errors.setdefault(index, {})[name] = [f'Invalid pk "{row[attname]}" - object does not exist.']
+  if errors:
+    raise ValidationError({label:errors})
+
+def check_unique_together(schema, rows, label):
+  #duplicates within the batch and against existing rows, one query per constraint
+  errors = {}
+  for fields in schema.model._meta.unique_together:
+    attnames = [schema.model._meta.get_field(field).attname for field in fields]
+    keys = [tuple(row[attname] for attname in attnames) for row in rows]
+    existing = set(schema.model.objects
+                   .filter(**{f'{attnames[0]}__in':{key[0] for key in keys}})
+                   .values_list(*attnames))
+    seen = set()
+    for index, key in enumerate(keys):
+      if key in existing or key in seen:
+        errors.setdefault(index, {})['non_field_errors'] = [f'The fields {", ".join(fields)} must make a unique set.']
+      seen.add(key)
+  if errors:
+    raise ValidationError({label:errors})
+
+def check_unique_ids(schema, rows, label):
+  #ids given by the uploader, within the batch and against existing rows. The primary key of
+  #partitioned tables is (id, patch_number) (see partitions.py), so the database no longer does this
+  ids = [row['id'] for row in rows]
+  existing = set(schema.model.objects.filter(id__in=set(ids)).values_list('id', flat=True))
+  errors = {}
+  seen = set()
+  for index, id in enumerate(ids):
+    if id in existing or id in seen:
+      errors.setdefault(index, {})['id'] = [f'{schema.model._meta.verbose_name} with this id already exists.']
+    seen.add(id)
+  if errors:
+    raise ValidationError({label:errors})
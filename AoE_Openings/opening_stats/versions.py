@@ -0,0 +1,21 @@
+import uuid
+
+from django.core.cache import caches
+
+# Version tokens of the data processes keep in memory (reference registry,
+# cubes), read and written straight through the 'versions' cache alias. They
+# stay out of the tiered default cache: its L1 would hand out a stale token
+# for up to L1_TIMEOUT and the shared file cache culls keys once it's full.
+# Every change writes a new uuid rather than bumping a counter, so a token that
+# went missing reads as a change, never as an older version coming back.
+
+ALIAS = 'versions'
+
+def get(key):
+  #None until the first change
+  return caches[ALIAS].get(key)
+
+def changed(key):
+  token = uuid.uuid4().hex
+  caches[ALIAS].set(key, token, None)
+  return token
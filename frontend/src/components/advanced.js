@@ -326,7 +326,8 @@ class Advanced extends Component {
     }
     //Update page name
     this.props.history.push(`${window.location.pathname}`)
-    fetch('/api/v1/advanced/', {
+    // Long-poll, the server holds the request until the result is ready or it times out
+    fetch('/api/v1/advanced/wait/', {
       method: 'POST',
       headers: {
           Accept: 'application/json',
@@ -352,7 +353,7 @@ class Advanced extends Component {
           // We are waiting in queue for a response
           this.setState({ position: json.position});
           this.setState({data:{}})
-          // Try again after 500 ms
+          // Server already waited (or was busy), ask again after a short backoff
           setTimeout(this.handleSubmit.bind(this, event), 1000);
         }
 